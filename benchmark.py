@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+
+#Stage-level benchmarks of the supernova pipeline.
+#Runs offline in a scratch copy of the repository (inputs symlinked, out/, supernova.glb
+#and fluxes/td_fluxes private) and times each stage separately:
+#   startup      starting Python and importing supernova.py (a subprocess)
+#   glb          supernova.write_glb (building supernova.glb)
+#   globes       bin/supernova on that supernova.glb
+#   numpy        the in-process rate engine
+#   weights      rate_engine.apply_weights on the unweighted output
+#   interpolate  interpolate.interpolate_series on synthetic Chimera luminosity files
+#   td           the td_supernova.py loop over the interpolated fluences
+#Every stage but startup, globes and td is timed in-process, so interpreter start-up does not hide it.
+#Results are saved as JSON and compared with a stored baseline; a stage that is
+#slower than the baseline by more than the tolerance is reported as a regression.
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import contextlib
+import argparse
+import subprocess
+import numpy as np
+import rate_engine
+import supernova
+import preflight
+import interpolate
+
+root = os.path.dirname(os.path.realpath(__file__))
+
+default_pairs = ["argon/ar17kt", "water/wc100kt30prct", "lead/halo2"]
+default_fluxes = ["livermore", "gvkm"]
+td_fluxname = "benchmark"
+
+#Entries of the repository root the benchmark must not share with it
+private_entries = ("out", "supernova.glb", "fluxes", "benchmarks")
+
+#Scratch copy of the repository: inputs are symlinked, outputs and time-dependent fluxes are private
+def make_scratch():
+    scratch = tempfile.mkdtemp(prefix="snowglobes_benchmark_")
+    for name in os.listdir(root):
+        if name not in private_entries:
+            os.symlink(os.path.join(root, name), os.path.join(scratch, name))
+    os.makedirs(os.path.join(scratch, "fluxes", "td_fluxes", "timesteps"))
+    os.makedirs(os.path.join(scratch, "fluxes", "td_fluxes", td_fluxname))
+    for name in os.listdir(os.path.join(root, "fluxes")):
+        if name != "td_fluxes":
+            os.symlink(os.path.join(root, "fluxes", name), os.path.join(scratch, "fluxes", name))
+    os.makedirs(os.path.join(scratch, "out", "td_fluxes", td_fluxname))
+    return scratch
+
+#Write count synthetic luminosity files in the Chimera layout read by interpolate.py:
+#8 header lines, "<overall time> <post bounce time>" on line 9, 3 column headers and
+#20 rows of energy (MeV) and nue, nuebar, nux, nuxbar number luminosities
+def write_lumspecs(directory, count, seed=0):
+    rng = np.random.default_rng(seed)
+    energies = np.geomspace(2., 300., 20)
+    for i in range(count):
+        pb_time = 0.001 * i
+        temperature = 3. + 2. * i / max(count - 1, 1)
+        shape = energies**2 / (1. + np.exp(energies / temperature))
+        lum = 1e55 * shape[:, None] * rng.uniform(0.9, 1.1, (len(energies), 4))
+        lines = ["# header %d\n" % k for k in range(8)]
+        lines.append("  %e  %e\n" % (0.3 + pb_time, pb_time))
+        lines += ["# col header\n"] * 3
+        lines += ["  %e  %e %e %e %e\n" % ((energy,) + tuple(row)) for energy, row in zip(energies, lum)]
+        lines.append("# trailer\n")
+        with open(os.path.join(directory, "lum%05d.dat" % i), 'w') as LUMFILE:
+            LUMFILE.write("".join(lines))
+
+#Time one call of func, returning (seconds, result)
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+#Run a command in the scratch directory; a non-zero exit status is returned, not raised
+def run_command(cmd, scratch):
+    result = subprocess.run(cmd, cwd=scratch, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    return result.returncode, result.stdout
+
+#Time every stage repeat times. Returns {stage name: {"times": [...]} or {"skipped": reason}}.
+def run_benchmarks(pairs, fluxes, lumspec_count, repeat, jobs, td_engine):
+    scratch = make_scratch()
+    cwd = os.getcwd()
+    stages = {}
+
+    def record(name, seconds):
+        stages.setdefault(name, {"times": []})["times"].append(seconds)
+
+    def skip(name, reason):
+        stages[name] = {"skipped": reason.strip().splitlines()[-1] if reason.strip() else "failed"}
+
+    try:
+        os.chdir(scratch)
+        for i in range(repeat):
+            seconds, (returncode, log) = timed(run_command, [sys.executable, "-c", "import supernova"], scratch)
+            if returncode != 0:
+                skip("startup", log)
+                break
+            record("startup", seconds)
+
+        for pair in pairs:
+            channame, expt_config = pair.split("/")
+            chanfilename = "channels/channels_" + channame + ".dat"
+            target_mass = float(preflight.registry().target_mass(expt_config))
+            for fluxname in fluxes:
+                tag = "/" + channame + "/" + expt_config + "/" + fluxname
+                for i in range(repeat):
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        seconds, result = timed(supernova.write_glb, fluxname, channame, expt_config)
+                    record("glb" + tag, seconds)
+
+                    if not stages.get("globes" + tag, {}).get("skipped"):
+                        seconds, (returncode, log) = timed(run_command, ["bin/supernova", fluxname, chanfilename, expt_config], scratch)
+                        if returncode != 0:
+                            skip("globes" + tag, log or "bin/supernova exited with status %d" % returncode)
+                        else:
+                            record("globes" + tag, seconds)
+
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        seconds, results = timed(rate_engine.run, fluxname, chanfilename, expt_config, target_mass)
+                    record("numpy" + tag, seconds)
+
+                    seconds, results = timed(rate_engine.apply_weights, fluxname, chanfilename, expt_config, ["", "_smeared"])
+                    record("weights" + tag, seconds)
+
+        rawdir = os.path.join(scratch, "lumspecs")
+        os.makedirs(rawdir)
+        write_lumspecs(rawdir, lumspec_count)
+        tag = "/" + str(lumspec_count)
+        for i in range(repeat):
+            with contextlib.redirect_stdout(io.StringIO()):
+                seconds, result = timed(interpolate.interpolate_series, td_fluxname, rawdir, "/fluxes/td_fluxes/" + td_fluxname)
+            record("interpolate" + tag, seconds)
+
+        if "times" in stages.get("interpolate" + tag, {}):
+            for pair in pairs:
+                channame, expt_config = pair.split("/")
+                name = "td/" + channame + "/" + expt_config + "/" + td_engine + tag
+                for i in range(repeat):
+                    seconds, (returncode, log) = timed(run_command, [sys.executable, "td_supernova.py", channame, expt_config, td_fluxname, rawdir,
+                                                                     "--engine", td_engine, "--jobs", str(jobs), "--no-cache"], scratch)
+                    if returncode != 0:
+                        skip(name, log)
+                        break
+                    record(name, seconds)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch)
+    for stage in stages.values():
+        if "times" in stage:
+            stage["best"] = min(stage["times"])
+    return stages
+
+#Compare with a baseline: returns [(stage, baseline, current, ratio, regressed)] for stages timed in both.
+#A stage regresses when it is slower by more than tolerance (relative) and min_delta seconds.
+def compare(results, baseline, tolerance, min_delta=0.):
+    rows = []
+    for name, stage in sorted(results["stages"].items()):
+        base = baseline["stages"].get(name, {})
+        if "best" not in stage or "best" not in base:
+            continue
+        ratio = stage["best"] / base["best"]
+        rows.append((name, base["best"], stage["best"], ratio, ratio > 1. + tolerance and stage["best"] - base["best"] > min_delta))
+    return rows
+
+def print_results(results, rows=None):
+    print("{0:<44} {1:>12}".format("stage", "best (s)"))
+    for name, stage in sorted(results["stages"].items()):
+        if "best" in stage:
+            print("{0:<44} {1:12.4f}".format(name, stage["best"]))
+        else:
+            print("{0:<44} {1:>12}  ({2})".format(name, "skipped", stage["skipped"]))
+    if rows is not None:
+        print("\n{0:<44} {1:>12} {2:>12} {3:>8}".format("stage", "baseline (s)", "current (s)", "ratio"))
+        for name, base, current, ratio, regressed in rows:
+            print("{0:<44} {1:12.4f} {2:12.4f} {3:8.2f}{4}".format(name, base, current, ratio, "  REGRESSION" if regressed else ""))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Times each stage of the supernova pipeline and compares with a stored baseline')
+    parser.add_argument('--pairs', type=str, default=",".join(default_pairs), help='Comma-separated channel/experiment pairs. \n (eg. argon/ar17kt,water/wc100kt30prct)')
+    parser.add_argument('--fluxes', type=str, default=",".join(default_fluxes), help='Comma-separated bundled fluxes. \n (eg. livermore,gvkm)')
+    parser.add_argument('--lumspecs', type=int, default=20, help='Number of synthetic Chimera luminosity files for the interpolate and td stages')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of times each stage is run; the best time is compared')
+    parser.add_argument('--jobs', type=int, default=1, help='--jobs passed to td_supernova.py')
+    parser.add_argument('--td-engine', type=str, choices=['globes', 'numpy'], default='globes', help='--engine passed to td_supernova.py. \n (numpy only once it matches the reference output, see reference/README)')
+    parser.add_argument('--output', type=str, default="benchmarks/results.json", help='Where to save the results')
+    parser.add_argument('--baseline', type=str, default="benchmarks/baseline.json", help='Baseline to compare with, if it exists')
+    parser.add_argument('--save-baseline', action='store_true', help='Also save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown relative to the baseline. \n (eg. 0.25 = 25%%)')
+    parser.add_argument('--min-delta', type=float, default=0.01, help='Slowdowns smaller than this many seconds are never regressions. \n (timer noise on the fast stages)')
+    args = parser.parse_args()
+
+    results = {"date": time.strftime("%Y-%m-%d %H:%M:%S"), "machine": platform.platform(), "python": platform.python_version(),
+               "cpus": os.cpu_count(), "options": {"lumspecs": args.lumspecs, "repeat": args.repeat, "jobs": args.jobs, "td_engine": args.td_engine}}
+    results["stages"] = run_benchmarks(args.pairs.split(","), args.fluxes.split(","), args.lumspecs, args.repeat, args.jobs, args.td_engine)
+
+    outputs = [args.output] + ([args.baseline] if args.save_baseline else [])
+    for filename in outputs:
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w') as OUTFILE:
+            json.dump(results, OUTFILE, indent=1)
+
+    rows = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as BASEFILE:
+            rows = compare(results, json.load(BASEFILE), args.tolerance, args.min_delta)
+    print_results(results, rows)
+    print("Saved " + " and ".join(outputs))
+    if rows is not None and any(row[4] for row in rows):
+        raise SystemExit(1)
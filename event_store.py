@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+
+#Columnar output store for time-dependent runs.
+#One store per (flux series, channel file, detector configuration) replaces the
+#four out/*_events[_smeared][_unweighted].dat files per channel per timestep.
+#A store is a directory holding
+#   meta.json    channels, timesteps, energies and a stamp per row, renewed whenever the row is written
+#   events.npy   (time x kind x channel x energy bin) spectra
+#   totals.npy   (time x kind x channel) "Total:" lines of the .dat files
+#The .npy files are memory-mapped, grown by doubling as timesteps are appended,
+#and can be exported back to the .dat layout.
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+from numpy.lib.format import open_memmap
+import rate_engine
+import preflight
+
+#Slices along the kind axis, and the .dat suffix each one comes from
+kinds = ("unsmeared_unweighted", "smeared_unweighted", "unsmeared", "smeared")
+suffixes = {"unsmeared_unweighted": "_unweighted", "smeared_unweighted": "_smeared_unweighted",
+            "unsmeared": "", "smeared": "_smeared"}
+
+#Store directory of a time-dependent run
+def store_path(fluxname, channame, expt_config, outdir="out"):
+    return outdir + "/td_fluxes/" + fluxname + "/" + fluxname + "_" + channame + "_" + expt_config + ".store"
+
+def read_meta(path):
+    with open(os.path.join(path, "meta.json")) as METAFILE:
+        return json.load(METAFILE)
+
+def write_meta(path, meta):
+    tmp = os.path.join(path, "meta.json.tmp")
+    with open(tmp, 'w') as METAFILE:
+        json.dump(meta, METAFILE)
+    os.replace(tmp, os.path.join(path, "meta.json"))
+
+#Channels of a run (plus the background channel when the configuration has one) and the
+#energies of the unsmeared and smeared spectra
+def layout(chanfilename, expt_config):
+    settings = rate_engine.read_glb_settings()
+    channels = [channel[0] for channel in preflight.registry().require_channels(chanfilename)]
+    if os.path.exists("backgrounds/" + rate_engine.bg_chan_name + "_" + expt_config + ".dat"):
+        channels.append(rate_engine.bg_chan_name)
+    samp_energies = rate_engine.bin_centers(int(settings["sampling_points"]), settings["sampling_min"], settings["sampling_max"])
+    energies = rate_engine.bin_centers(int(settings["bins"]), settings["emin"], settings["emax"])
+    return channels, {"unsmeared": samp_energies.tolist(), "smeared": energies.tolist()}
+
+#Create an empty store for the given channels
+def create(path, chanfilename, expt_config, capacity=64):
+    channels, energies = layout(chanfilename, expt_config)
+    nbins = max(len(e) for e in energies.values())
+
+    os.makedirs(path, exist_ok=True)
+    events = open_memmap(os.path.join(path, "events.npy"), mode='w+', shape=(capacity, len(kinds), len(channels), nbins))
+    events[:] = np.nan
+    del events
+    totals = open_memmap(os.path.join(path, "totals.npy"), mode='w+', shape=(capacity, len(kinds), len(channels)))
+    totals[:] = np.nan
+    del totals
+    meta = {"channels": channels, "kinds": list(kinds), "timesteps": [], "energies": energies, "stamps": []}
+    write_meta(path, meta)
+    return meta
+
+#Double the time axis of an array file
+def grow(filename, capacity):
+    old = np.load(filename, mmap_mode='r')
+    tmp = filename + ".tmp"
+    new = open_memmap(tmp, mode='w+', shape=(capacity,) + old.shape[1:])
+    new[:] = np.nan
+    new[:len(old)] = old
+    del new, old
+    os.replace(tmp, filename)
+
+#Append (or replace) one timestep. spectra is (kind x channel x bin), totals is (kind x channel).
+def append(path, timestep, spectra, totals):
+    meta = read_meta(path)
+    timesteps = meta["timesteps"]
+    row = timesteps.index(timestep) if timestep in timesteps else len(timesteps)
+    events_file = os.path.join(path, "events.npy")
+    totals_file = os.path.join(path, "totals.npy")
+    capacity = np.load(events_file, mmap_mode='r').shape[0]
+    if row >= capacity:
+        grow(events_file, 2 * capacity)
+        grow(totals_file, 2 * capacity)
+    events = np.load(events_file, mmap_mode='r+')
+    events[row, :, :, :spectra.shape[2]] = spectra
+    events.flush()
+    stored_totals = np.load(totals_file, mmap_mode='r+')
+    stored_totals[row] = totals
+    stored_totals.flush()
+    del events, stored_totals
+    if row == len(timesteps):
+        timesteps.append(timestep)
+    #Stores written before stamps existed get none for their old rows
+    stamps = meta.setdefault("stamps", [])
+    stamps += [None] * (len(timesteps) - len(stamps))
+    stamps[row] = time.time_ns()
+    #The metadata is replaced last, so a reader never sees a row that is not written yet
+    write_meta(path, meta)
+
+#(kind x channel x bin) spectra and (kind x channel) totals of one timestep from the texts of its
+#output files, {output file name: glbShowChannelRates text} with names under outdir as bin/supernova
+#writes them. Files that are not given (e.g. weighted background) stay NaN.
+def texts_spectra(meta, texts, outdir, fluxfile, expt_config):
+    channels = meta["channels"]
+    nbins = max(len(e) for e in meta["energies"].values())
+    spectra = np.full((len(kinds), len(channels), nbins), np.nan)
+    totals = np.full((len(kinds), len(channels)), np.nan)
+    for k, kind in enumerate(kinds):
+        for c, chan_name in enumerate(channels):
+            filename = outdir + "/" + fluxfile + "_" + chan_name + "_" + expt_config + "_events" + suffixes[kind] + ".dat"
+            if filename not in texts:
+                continue
+            rates, total = parse_rates(texts[filename])
+            spectra[k, c, :len(rates)] = rates
+            totals[k, c] = total
+    return spectra, totals
+
+#Spectra and totals of one timestep from rate_engine results {chan_name: (pre, post)}, at full precision.
+#The weighted kinds are the unweighted ones times factors {chan_name: num_target_factor}, as
+#supernova.py --weight writes them; the background is not in factors and is only stored unweighted.
+def results_spectra(meta, results, factors):
+    channels = meta["channels"]
+    nbins = max(len(e) for e in meta["energies"].values())
+    spectra = np.full((len(kinds), len(channels), nbins), np.nan)
+    totals = np.full((len(kinds), len(channels)), np.nan)
+    for c, chan_name in enumerate(channels):
+        if chan_name not in results:
+            continue
+        for k, kind in enumerate(kinds):
+            rates = results[chan_name][0 if kind.startswith("unsmeared") else 1]
+            if not kind.endswith("unweighted"):
+                if chan_name not in factors:
+                    continue
+                rates = rates * factors[chan_name]
+            spectra[k, c, :len(rates)] = rates
+            totals[k, c] = rates.sum()
+    return spectra, totals
+
+#Read the .dat files one timestep left in outdir into (kind x channel x bin) spectra and
+#(kind x channel) totals. Files that do not exist (e.g. weighted background) stay NaN.
+def read_timestep(meta, outdir, fluxfile, expt_config):
+    texts = {}
+    for kind in kinds:
+        for chan_name in meta["channels"]:
+            filename = outdir + "/" + fluxfile + "_" + chan_name + "_" + expt_config + "_events" + suffixes[kind] + ".dat"
+            if os.path.exists(filename):
+                with open(filename) as RATEFILE:
+                    texts[filename] = RATEFILE.read()
+    spectra, totals = texts_spectra(meta, texts, outdir, fluxfile, expt_config)
+    return spectra, totals, list(texts)
+
+#Rates and "Total:" value of the text of an output file
+def parse_rates(text):
+    rates = []
+    total = np.nan
+    for line in text.splitlines():
+        stuff = line.split()
+        if not stuff or stuff[0].startswith("#") or stuff[0].startswith("---"):
+            continue
+        if stuff[0] == "Total:":
+            total = float(stuff[1])
+        else:
+            rates.append(float(stuff[1]))
+    return np.array(rates), total
+
+#Value of the "Total:" line of an output file
+def read_total(filename):
+    with open(filename) as RATEFILE:
+        for line in RATEFILE:
+            stuff = line.split()
+            if stuff and stuff[0] == "Total:":
+                return float(stuff[1])
+    return np.nan
+
+#Move one timestep's .dat output from outdir into the store
+def ingest(path, outdir, fluxfile, expt_config, remove=True):
+    meta = read_meta(path)
+    spectra, totals, filenames = read_timestep(meta, outdir, fluxfile, expt_config)
+    append(path, os.path.basename(fluxfile), spectra, totals)
+    if remove:
+        for filename in filenames:
+            os.remove(filename)
+
+#Add one timestep from the in-memory texts of its output files (see texts_spectra), without touching out/
+def ingest_texts(path, texts, outdir, fluxfile, expt_config):
+    spectra, totals = texts_spectra(read_meta(path), texts, outdir, fluxfile, expt_config)
+    append(path, os.path.basename(fluxfile), spectra, totals)
+
+#Add one timestep from the arrays rate_engine.run/compute_rates return (see results_spectra)
+def ingest_results(path, fluxfile, results, factors):
+    spectra, totals = results_spectra(read_meta(path), results, factors)
+    append(path, os.path.basename(fluxfile), spectra, totals)
+
+#Read-only view of a store. Arrays are memory-mapped, so slicing only touches the requested data.
+class EventStore:
+    def __init__(self, path):
+        self.path = path
+        meta = read_meta(path)
+        self.channels = meta["channels"]
+        self.timesteps = meta["timesteps"]
+        self.stamps = meta.get("stamps", [])
+        self.energies = {kind: np.array(e) for kind, e in meta["energies"].items()}
+        self._events = np.load(os.path.join(path, "events.npy"), mmap_mode='r')
+        self._totals = np.load(os.path.join(path, "totals.npy"), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.timesteps)
+
+    def _energy_key(self, kind):
+        return "smeared" if kind.startswith("smeared") else "unsmeared"
+
+    #(time x channel x bin) spectra of one kind, or (time x bin) for one channel
+    def events(self, kind="smeared", channel=None):
+        nbins = len(self.energies[self._energy_key(kind)])
+        view = self._events[:len(self.timesteps), kinds.index(kind), :, :nbins]
+        if channel is not None:
+            view = view[:, self.channels.index(channel)]
+        return view
+
+    #Spectrum of one channel at one timestep
+    def spectrum(self, timestep, channel, kind="smeared"):
+        return self.events(kind, channel)[self.timesteps.index(timestep)]
+
+    #(time x channel) totals of one kind, or (time,) for one channel
+    def totals(self, kind="smeared", channel=None):
+        view = self._totals[:len(self.timesteps), kinds.index(kind)]
+        if channel is not None:
+            view = view[:, self.channels.index(channel)]
+        return view
+
+#Write the store back out in the original out/<fluxdir>/<timestep>_<chan>_<config>_events*.dat layout
+def export_dat(path, fluxdir, expt_config, outdir="out"):
+    store = EventStore(path)
+    os.makedirs(os.path.join(outdir, fluxdir), exist_ok=True)
+    count = 0
+    for t, timestep in enumerate(store.timesteps):
+        for kind in kinds:
+            energies = store.energies[store._energy_key(kind)]
+            spectra = store.events(kind)[t]
+            totals = store.totals(kind)[t]
+            for c, chan_name in enumerate(store.channels):
+                if np.isnan(totals[c]):
+                    continue
+                if kind.endswith("unweighted"):
+                    lines = ["%12.6g \t %12.6g \n" % (e, r) for e, r in zip(energies, spectra[c])]
+                    lines.append("----------------------\n")
+                    lines.append("Total:\t%12.6g\n" % totals[c])
+                else:
+                    lines = ["{0} {1}\n".format("%.6g" % e, r) for e, r in zip(energies, spectra[c].tolist())]
+                    lines.append("----------------------\n")
+                    lines.append("Total: {0}\n".format(float(totals[c])))
+                filename = outdir + "/" + fluxdir + "/" + timestep + "_" + chan_name + "_" + expt_config + "_events" + suffixes[kind] + ".dat"
+                with open(filename, 'w') as OUTFILE:
+                    OUTFILE.write("".join(lines))
+                count += 1
+    print("Exported {0} files from {1}".format(count, path))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Exports or summarizes a time-dependent event store')
+    parser.add_argument('channelname', type=str, help='Name of channel. \n (eg. argon)')
+    parser.add_argument('experimentname', type=str, help='Name of experiment. \n (eg. ar17kt)')
+    parser.add_argument('fluxname', type=str, help='Name of flux. \n (eg. chimera)')
+    parser.add_argument('--export', action='store_true', help='Write the store back out as out/td_fluxes/<flux>/*.dat files')
+    args = parser.parse_args()
+
+    path = store_path(args.fluxname, args.channelname, args.experimentname)
+    if args.export:
+        export_dat(path, "td_fluxes/" + args.fluxname, args.experimentname)
+    else:
+        store = EventStore(path)
+        print("{0}: {1} timesteps, {2} channels".format(path, len(store), len(store.channels)))
+        totals = store.totals("smeared")
+        for c, chan_name in enumerate(store.channels):
+            print("{0:<24} {1:14.6g}".format(chan_name, np.nansum(totals[:, c])))
@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+
+#Client for the persistent GLoBES worker (bin/supernova --worker).
+#The worker parses supernova.glb once for a (channel file, detector config) and
+#then computes the rates of one flux file after another, streaming the
+#glbShowChannelRates output back over a pipe. See run_worker in src/supernova.c.
+
+import os
+import io
+import shutil
+import subprocess
+import contextlib
+import argparse
+import numpy as np
+import rate_engine
+import supernova
+import scratch
+import event_store
+import preflight
+
+exename = "bin/supernova"
+
+#Flux the worker's supernova.glb is built with: 1 in every column on the fluxes/*.dat energy grid
+unit_flux_name = "worker_unit_flux"
+
+def write_unit_flux(filename):
+    energies = np.arange(501) * 0.0002
+    np.savetxt(filename, np.column_stack([energies] + [np.ones(501)] * 6), fmt="%g")
+
+#Private directory for the workers of one run (see scratch.py), with fluxes/ made private so the
+#unit flux can be added to it, and supernova.glb built for the unit flux, channels and detector
+def make_rundir(channame, expt_config, scratch_root=None):
+    rundir = scratch.make(scratch_root, "globes_worker_", linked_dirs=("fluxes",))
+    write_unit_flux(os.path.join(rundir, "fluxes", unit_flux_name + ".dat"))
+    with contextlib.redirect_stdout(io.StringIO()):
+        supernova.write_glb(unit_flux_name, channame, expt_config, os.path.join(rundir, "supernova.glb"))
+    return rundir
+
+class GlobesWorker:
+    #The worker runs in rundir (make_rundir), where it reads supernova.glb and the flux files
+    def __init__(self, chanfilename, expt_config, rundir):
+        self.process = subprocess.Popen([exename, "--worker", chanfilename, expt_config], cwd=rundir,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+        line = self.process.stdout.readline()
+        if line.strip() != "#READY":
+            self.close()
+            raise RuntimeError("GLoBES worker failed to start")
+
+    #Compute the rates of fluxes/<fluxname>.dat: returns {output file name: glbShowChannelRates text}
+    def run(self, fluxname):
+        self.process.stdin.write(fluxname + "\n")
+        self.process.stdin.flush()
+        texts = {}
+        filename = None
+        lines = []
+        for line in self.process.stdout:
+            if line.startswith("#ERROR"):
+                raise RuntimeError(line[len("#ERROR"):].strip())
+            if line.startswith("#FILE") or line.startswith("#DONE"):
+                if filename is not None:
+                    texts[filename] = "".join(lines)
+                if line.startswith("#DONE"):
+                    return texts
+                filename = line.split(None, 1)[1].strip()
+                lines = []
+            else:
+                lines.append(line)
+        raise RuntimeError("GLoBES worker exited while processing " + fluxname)
+
+    def close(self):
+        if self.process.stdin:
+            self.process.stdin.close()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+#Texts of the output files of one flux, {out/ file name: text}, weighting the channels like
+#supernova.py --weight. The background channel is kept unweighted, as bin/supernova leaves it.
+def output_texts(texts, fluxname, chanfilename, expt_config, weight=True, keep_unweighted=True):
+    channels = preflight.registry().require_channels(chanfilename)
+    unweighted = []
+    weighted = []
+    factors = []
+    for chan_name, index, cpstate, inflav, num_target_factor in channels:
+        for suffix in ("", "_smeared"):
+            unweighted.append("out/" + fluxname + "_" + chan_name + "_" + expt_config + "_events" + suffix + "_unweighted.dat")
+            weighted.append("out/" + fluxname + "_" + chan_name + "_" + expt_config + "_events" + suffix + ".dat")
+            factors.append(num_target_factor)
+
+    outputs = {}
+    if weight:
+        outputs.update(zip(weighted, rate_engine.weight_texts([texts[name] for name in unweighted], factors)))
+    for filename, text in texts.items():
+        if keep_unweighted or not weight or filename not in unweighted:
+            outputs[filename] = text
+    return outputs
+
+#Write the output texts of one flux to out/
+def write_outputs(outputs, fluxname):
+    os.makedirs(os.path.dirname("out/" + fluxname), exist_ok=True)
+    for filename, text in outputs.items():
+        with open(filename, 'w') as OUTFILE:
+            OUTFILE.write(text)
+
+#Run a flux through a worker and through bin/supernova on its own, each in a private directory,
+#and compare the unweighted spectra within rtol (see rate_engine.compare_rates)
+def validate(fluxname, channame, expt_config, rtol=1e-6):
+    chanfilename = "channels/channels_" + channame + ".dat"
+    rundir = make_rundir(channame, expt_config)
+    single = scratch.make(prefix="globes_single_")
+    cwd = os.getcwd()
+    try:
+        with GlobesWorker(chanfilename, expt_config, rundir) as worker:
+            texts = worker.run(fluxname)
+        os.makedirs(os.path.dirname(os.path.join(single, "out", fluxname)), exist_ok=True)
+        os.chdir(single)
+        with contextlib.redirect_stdout(io.StringIO()):
+            returncode = supernova.run_flux(fluxname, channame, expt_config, engine="globes")
+        os.chdir(cwd)
+        if returncode != 0:
+            print("bin/supernova failed with exit code {0}".format(returncode))
+            return False
+        results = {}
+        for chan_name in [channel[0] for channel in preflight.registry().require_channels(chanfilename)] + [rate_engine.bg_chan_name]:
+            outfile = "out/" + fluxname + "_" + chan_name + "_" + expt_config + "_events"
+            if outfile + "_unweighted.dat" in texts:
+                results[chan_name] = (event_store.parse_rates(texts[outfile + "_unweighted.dat"])[0],
+                                      event_store.parse_rates(texts[outfile + "_smeared_unweighted.dat"])[0])
+        return rate_engine.compare_rates(results, fluxname, expt_config, os.path.join(single, "out"), rtol)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(rundir)
+        shutil.rmtree(single)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Checks the persistent GLoBES worker against a single bin/supernova run of the same flux')
+    parser.add_argument('fluxname', type=str, help='Name of flux. \n (eg. livermore)')
+    parser.add_argument('channelname', type=str, help='Name of channel. \n (eg. argon)')
+    parser.add_argument('experimentname', type=str, help='Name of experiment. \n (eg. ar17kt)')
+    parser.add_argument('--rtol', type=float, default=1e-6, help='Relative tolerance per bin (relative to the spectrum peak) and in total. \n (both runs print the same 6 significant digits)')
+    args = parser.parse_args()
+
+    if not preflight.supports_worker(exename):
+        raise SystemExit(exename + " was built without worker mode: rebuild it with make -C src install")
+    if not validate(args.fluxname, args.channelname, args.experimentname, args.rtol):
+        raise SystemExit(1)
+    print("The GLoBES worker matches bin/supernova within {0:g}".format(args.rtol))
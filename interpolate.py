@@ -2,135 +2,161 @@
 
 import numpy as np
 import pandas as pd
-import linecache as lc
 import os
-from scipy import interpolate
 import argparse
+import profiling
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 
-parser = argparse.ArgumentParser(description = 'Interpolates Chimera data and converts the Luminosity to Fluence')
-parser.add_argument('fluxname', type=str, help='Name of flux. \n (eg. chimera)')
-parser.add_argument('path', type=str, help='Directory containing the Luminosity files.\n (eg. /lustre/atlas1/stf006/proj-shared/bronson/2D_lumspec)')
-parser.add_argument('path1', type=str, help='Directory to output the Fluence files to.\n (eg. /fluxes/td_fluxes/chimera)')
+#10 kpc in cm
+R = 3.086*10**22
+#distance modulus
+factor = 1/(4*np.pi*pow(R,2))
 
-args = parser.parse_args()
-fluxname = args.fluxname
-path = args.path
-path1 = args.path1
+#Output energy grid in GeV (0-0.1 GeV in 0.2 MeV steps)
+bins = np.arange(0,.1002,0.0002)
 
+#Read one luminosity file in a single pass: the times on line 9 and the 20 spectrum rows after the 12 header lines
+def read_lumspec(filename):
+    with open(filename) as LUMFILE:
+        lines = LUMFILE.readlines()
+    split_time = lines[8].split()
+    spectrum = np.array([line.split()[:5] for line in lines[12:32]], dtype=float)
+    return split_time[0], split_time[1], spectrum
 
-#path = '/ccs/home/justinscot/spectob1300'
-#path = '/lustre/atlas1/stf006/proj-shared/bronson/2D_lumspec'
-#path = '/lustre/atlas1/stf006/proj-shared/bronson/2D_lumspec/oscillated/inverted'
+#Read many luminosity files on a thread or process pool, keeping their order
+def read_lumspecs(filenames, workers=1, pool="thread"):
+    if workers <= 1:
+        return [read_lumspec(filename) for filename in filenames]
+    Executor = ProcessPoolExecutor if pool == "process" else ThreadPoolExecutor
+    with Executor(max_workers=workers) as executor:
+        return list(executor.map(read_lumspec, filenames, chunksize=16 if pool == "process" else 1))
 
-overall_time = []
-pb_time = []
+#Log-space interpolation of every timestep and flavor onto the output grid in one pass.
+#energygev is (time x energy), numflux is (time x flavor x energy); returns (time x flavor x bin).
+#Below the first energy the flux is extrapolated as exp(alpha*log(F[0])), as before.
+def interpolate_fluxes(energygev, numflux):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lognumflux = np.log(np.abs(numflux))
+        nenergy = energygev.shape[1]
+        #p+1 is the first tabulated energy at or above each bin
+        upper = (energygev[:, None, :] < bins[None, :, None]).sum(axis=2)
+        upper = np.clip(upper, 1, nenergy - 1)
+        e_hi = np.take_along_axis(energygev, upper, axis=1)
+        e_lo = np.take_along_axis(energygev, upper - 1, axis=1)
+        alpha = np.abs(1/(1+(e_hi-bins)/(bins-e_lo)))
+        log_hi = np.take_along_axis(lognumflux, upper[:, None, :].repeat(numflux.shape[1], axis=1), axis=2)
+        log_lo = np.take_along_axis(lognumflux, (upper - 1)[:, None, :].repeat(numflux.shape[1], axis=1), axis=2)
+        logflux = alpha[:, None, :] * log_hi + (1-alpha[:, None, :]) * log_lo
 
-i = 0
-#10 kpc in cm 
-R = 3.086*10**22
-#distance modulus
-factor = 1/(4*np.pi*pow(R,2))
+        #Extrapolate the fluxes for below the first energy
+        below = bins[None, :] <= energygev[:, :1]
+        alpha0 = np.abs(1/(1+(energygev[:, :1]-bins)/(bins-0.0001)))
+        logflux0 = alpha0[:, None, :] * lognumflux[:, :, :1]
+        logflux = np.where(below[:, None, :], logflux0, logflux)
+    return np.exp(logflux)
+
+#Time step of each file: the first two use pb[1]-pb[0], the rest pb[i]-pb[i-1]
+def time_steps(pb_time_array):
+    dt = np.diff(pb_time_array)
+    return np.concatenate([dt[:1], dt])
+
+#Write one fluence file in the six-flavor SNOwGLoBES layout (nux is used for both numu and nutau)
+def write_fluence(outputfile, fluence):
+    nue_num_fluence, nuebar_num_fluence, nux_num_fluence, nuxbar_num_fluence = fluence
+    d_out = {'"Energy (GeV)"':bins, '"Nue Fluence"':nue_num_fluence, '"Numu Fluence"':nux_num_fluence, '"Nutau Fluence"':nux_num_fluence, '"Nuebar Fluence"':nuebar_num_fluence, '"Numubar Fluence"':nuxbar_num_fluence, '"Nutaubar Fluence"':nuxbar_num_fluence}
+    df_out = pd.DataFrame(data=d_out, columns = ['"Energy (GeV)"', '"Nue Fluence"', '"Numu Fluence"', '"Nutau Fluence"', '"Nuebar Fluence"', '"Numubar Fluence"', '"Nutaubar Fluence"'])
+    with open(outputfile, 'w+') as fo, pd.option_context('display.precision', 6):
+        df_out.to_string(fo, index=False, header=False)
+
+#Convert luminosity spectra to fluences with the given time steps: (time x flavor x bin)
+def convert_steps(spectra, dt):
+    data = np.array(spectra)
+    #Convert energy to GeV
+    energygev = data[:, :, 0] * 0.001
+    numflux = np.abs(data[:, :, 1:]).transpose(0, 2, 1)
+    flux = interpolate_fluxes(energygev, numflux)
+    #Convert the fluxes into fluences by multiplying by dt
+    return flux * factor * np.asarray(dt)[:, None, None]
+
+#Convert the luminosity spectra of all timesteps to fluences: (time x flavor x bin)
+def convert(spectra, pb_time_array):
+    return convert_steps(spectra, time_steps(pb_time_array))
+
+#Overall and post-bounce time of a luminosity file, from line 9 only
+def read_times(filename):
+    with open(filename) as LUMFILE:
+        for i, line in enumerate(LUMFILE):
+            if i == 8:
+                split_time = line.split()
+                return split_time[0], split_time[1]
+
+def write_timesteps(time_outputfile, overall_time, pb_time):
+    d = {"Overall Time (s)": overall_time, "Post Bounce Time (s)": pb_time}
+    df = pd.DataFrame(data=d, columns = ["Overall Time (s)", "Post Bounce Time (s)"])
+    txt = df.to_string(index=False)
+    with open(time_outputfile, 'w') as fo:
+        print (txt, file=fo)
+
+#Fluence of one timestep as the table rate_engine.read_flux returns: energy, then nue, numu, nutau, nuebar, numubar, nutaubar
+def fluence_table(fluence):
+    nue_num_fluence, nuebar_num_fluence, nux_num_fluence, nuxbar_num_fluence = fluence
+    return np.column_stack([bins, nue_num_fluence, nux_num_fluence, nux_num_fluence, nuebar_num_fluence, nuxbar_num_fluence, nuxbar_num_fluence])
+
+#Generate (file index, fluence) for the luminosity files, parsing and converting chunk files at a time.
+#The time steps need every post-bounce time up front, so pb_time_array covers all the files.
+def iter_fluences(filenames, pb_time_array, chunk=64, workers=1, pool="thread"):
+    dt = time_steps(np.asarray(pb_time_array, dtype=float))
+    for start in range(0, len(filenames), chunk):
+        lumspecs = read_lumspecs(filenames[start:start + chunk], workers, pool)
+        fluences = convert_steps([lumspec[2] for lumspec in lumspecs], dt[start:start + chunk])
+        for i, fluence in enumerate(fluences, start):
+            yield i, fluence
+
+#Convert every luminosity file in path to a fluence file in "." + path1 (e.g. /fluxes/td_fluxes/chimera)
+#and write the times to fluxes/td_fluxes/timesteps/<fluxname>_timesteps.dat
+def interpolate_series(fluxname, path, path1, workers=1, pool="thread"):
+    #path = '/ccs/home/justinscot/spectob1300'
+    #path = '/lustre/atlas1/stf006/proj-shared/bronson/2D_lumspec'
+    #path = '/lustre/atlas1/stf006/proj-shared/bronson/2D_lumspec/oscillated/inverted'
+
+    fluxfiles = sorted(flux for flux in os.listdir(path) if flux.endswith(".dat"))
+    lumspecs = read_lumspecs([path + '/' + flux for flux in fluxfiles], workers, pool)
+    profiling.checkpoint("read", files = len(fluxfiles))
+
+    #Collect the times
+    overall_time = [lumspec[0] for lumspec in lumspecs]
+    pb_time = [lumspec[1] for lumspec in lumspecs]
+
+    time_outputfile = "./fluxes/td_fluxes/timesteps/"+ fluxname + "_timesteps.dat"
+
+    write_timesteps(time_outputfile, overall_time, pb_time)
+
+    pb_time_array = np.array(pb_time, dtype=float)
+
+    profiling.checkpoint("timesteps_file")
+
+    fluences = convert([lumspec[2] for lumspec in lumspecs], pb_time_array)
+    profiling.checkpoint("convert")
+
+    #Print to output files
+    outputfiles = ["." + path1 + "/" + flux for flux in fluxfiles]
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        list(executor.map(write_fluence, outputfiles, fluences))
+    profiling.checkpoint("write", files = len(outputfiles))
+    return outputfiles
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Interpolates Chimera data and converts the Luminosity to Fluence')
+    parser.add_argument('fluxname', type=str, help='Name of flux. \n (eg. chimera)')
+    parser.add_argument('path', type=str, help='Directory containing the Luminosity files.\n (eg. /lustre/atlas1/stf006/proj-shared/bronson/2D_lumspec)')
+    parser.add_argument('path1', type=str, help='Directory to output the Fluence files to.\n (eg. /fluxes/td_fluxes/chimera)')
+    parser.add_argument('--workers', type=int, default=1, help='Number of workers for reading and writing files')
+    parser.add_argument('--pool', type=str, choices=['thread', 'process'], default='thread', help='Worker pool type for parsing the Luminosity files')
+    parser.add_argument('--profile', type=str, default=None, help='Append per-stage timing and I/O records to this JSON lines file. \n (eg. profile.jsonl; also set by SNOWGLOBES_PROFILE)')
+    parser.add_argument('--pstats', type=str, default=None, help='Dump cProfile statistics into this directory. \n (eg. pstats; also set by SNOWGLOBES_PSTATS)')
 
-#Collect the times
-fluxfiles = os.listdir(path)
-fluxfiles.sort()
-for flux in fluxfiles:
-        if flux.endswith(".dat"):
-                filename = path + '/' +flux
-                time = lc.getline(filename, 9).rstrip('\n')
-                split_time = time.split()
-                overall_time.append(split_time[0])
-                pb_time.append(split_time[1])
-
-time_outputfile = "./fluxes/td_fluxes/timesteps/"+ fluxname + "_timesteps.dat"
-
-d = {"Overall Time (s)": overall_time, "Post Bounce Time (s)": pb_time}	
-df = pd.DataFrame(data=d, columns = ["Overall Time (s)", "Post Bounce Time (s)"])
-txt = df.to_string(index=False)
-with open(time_outputfile, 'w') as fo:
-	print (txt, file=fo)
-
-pb_time_array = np.array(pb_time, dtype=float)
-#print(len(pb_time_array))
-
-
-for flux in fluxfiles:
-    nue_flux = []
-    nuebar_flux = []
-    nux_flux = []
-    nuxbar_flux = []    
-    if flux.endswith(".dat"):
-	
-		#Read in DATA
-                filename = path + '/' +flux
-                columns = ['Energy', 'Nue.Num.Flux', 'Nuebar.Num.Flux', 'Nux.Num.Flux', 'Nuxbar.Num.Flux']
-                df = pd.read_table(filename, sep="\s+", skiprows = 12, nrows = 20, header = None, names = columns)
- #               print(filename)
-  #              print(df)
-                energy = df['Energy'].values
-                nue_numflux = np.abs( df['Nue.Num.Flux'].values)
-                nuebar_numflux = np.abs(df['Nuebar.Num.Flux'].values)
-                nux_numflux = np.abs(df['Nux.Num.Flux'].values)
-                nuxbar_numflux = np.abs(df['Nuxbar.Num.Flux'].values)
-		
-		#Convert energy to GeV               
-                energygev = energy * 0.001
-                bins = np.arange(0,.1002,0.0002)
-                np.set_printoptions(precision=6)
-
-		#Extrapolate the fluxes for below the first energy
-                f=0
-                while bins[f] <= energygev[0]:
-                    alpha = np.abs(1/(1+(energygev[0]-bins[f])/(bins[f]-0.0001)))
-                    nue_flux.append(np.exp(alpha * np.log(nue_numflux[0])))
-                    nuebar_flux.append(np.exp(alpha * np.log(nuebar_numflux[0])))
-                    nux_flux.append(np.exp(alpha * np.log(nux_numflux[0])))
-                    nuxbar_flux.append(np.exp(alpha * np.log(nuxbar_numflux[0])))
-                    f=f+1
-                    
-		#Populate the rest of the fluxes
-                for p in range(0,19):
-                    while f<501:
-                            if bins[f] <= energygev[p+1]:
-                                alpha = np.abs(1/(1+(energygev[p+1]-bins[f])/(bins[f]-energygev[p])))
-                                nue_flux.append(np.exp(alpha * np.log(nue_numflux[p+1])+(1-alpha) * np.log(nue_numflux[p])))
-                                nuebar_flux.append(np.exp(alpha * np.log(nuebar_numflux[p+1])+(1-alpha) * np.log(nuebar_numflux[p])))
-                                nux_flux.append(np.exp(alpha * np.log(nux_numflux[p+1])+(1-alpha)*np.log(nux_numflux[p])))
-                                nuxbar_flux.append(np.exp(alpha * np.log(nuxbar_numflux[p+1])+(1-alpha)*np.log(nuxbar_numflux[p])))
-                                f=f+1
-                                
-                            elif bins[f] > energygev[p+1]:
-                                p=p+1
-    
-                nue_flux_array = np.array(nue_flux, dtype=float)
-                nuebar_flux_array = np.array(nuebar_flux, dtype=float)
-                nux_flux_array = np.array(nux_flux, dtype=float)
-                nuxbar_flux_array = np.array(nuxbar_flux, dtype=float)                
-		
-		#Convert the fluxes into fluences by multiplying by dt
-                if i==0 or i==1:
-                    nue_num_fluence = nue_flux_array * factor * (pb_time_array[1] - pb_time_array[0])
-                    nuebar_num_fluence = nuebar_flux_array * factor * (pb_time_array[1] - pb_time_array[0])
-                    nux_num_fluence = nux_flux_array * factor * (pb_time_array[1] - pb_time_array[0])
-                    nuxbar_num_fluence = nuxbar_flux_array * factor * (pb_time_array[1] - pb_time_array[0])
-                else: 
-                    nue_num_fluence = nue_flux_array * factor * (pb_time_array[i] - pb_time_array[i-1])
-                    nuebar_num_fluence = nuebar_flux_array * factor * (pb_time_array[i] - pb_time_array[i-1])
-                    nux_num_fluence = nux_flux_array * factor * (pb_time_array[i] - pb_time_array[i-1])
-                    nuxbar_num_fluence = nuxbar_flux_array * factor * (pb_time_array[i] - pb_time_array[i-1])
-                        
-		#Prepare data for output
-                d_out = {'"Energy (GeV)"':bins, '"Nue Fluence"':nue_num_fluence, '"Numu Fluence"':nux_num_fluence, '"Nutau Fluence"':nux_num_fluence, '"Nuebar Fluence"':nuebar_num_fluence, '"Numubar Fluence"':nuxbar_num_fluence, '"Nutaubar Fluence"':nuxbar_num_fluence}
-                df_out = pd.DataFrame(data=d_out, columns = ['"Energy (GeV)"', '"Nue Fluence"', '"Numu Fluence"', '"Nutau Fluence"', '"Nuebar Fluence"', '"Numubar Fluence"', '"Nutaubar Fluence"'])
-                outputfile = "." + path1 + "/"  + flux
-                #os.makedirs(os.path.dirname(outputfile), exist_ok=True)
-                pd.set_option('precision',6)
-               #txt = df_out.to_string(index = False, header=False)
-                
-		#Print to output files
-                with open(outputfile, 'w+') as fo:
-                    df_out.to_string(fo, index=False, header=False)
-                    #print(txt, file=fo)
-                i = i + 1
-                
+    args = parser.parse_args()
+    profiling.init("interpolate.py", args.profile, args.pstats, flux = args.fluxname)
+    interpolate_series(args.fluxname, args.path, args.path1, args.workers, args.pool)
@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+
+#Preflight checks for supernova.py and td_supernova.py runs.
+#The detector configurations and channel files are parsed once into a registry, every
+#file a run will read is resolved from it (GLoBES templates, fluxes, cross sections,
+#smearing and efficiency files, and the bg_chan background when the configuration has
+#one) and checked before any rates are computed. The result can be written out as a
+#JSON job manifest listing the run, its channels and every input file with its size.
+
+import os
+import sys
+import json
+import time
+import argparse
+import rate_engine
+
+glb_templates = ("glb/preamble.glb", "glb/flux.glb", "glb/postamble.glb")
+detfilename = "detector_configurations.dat"
+exename = "bin/supernova"
+
+#Raised by require() with every problem found, one per line
+class PreflightError(Exception):
+    pass
+
+#Parsed detector configurations and channel files. Malformed lines are collected in
+#problems instead of raising, so one check reports everything that is wrong; the
+#require_* accessors are for code that needs the values and raise PreflightError instead.
+class Registry:
+    def __init__(self, detfilename=detfilename):
+        self.detfilename = detfilename
+        self.configs = {}
+        self.config_problems = []
+        self._channels = {}
+        if not os.path.exists(detfilename):
+            self.config_problems.append("Detector file name " + detfilename + " not found")
+            return
+        with open(detfilename) as DETFILE:
+            for number, line in enumerate(DETFILE, 1):
+                stuff = line.split()
+                #Skip comments and blank lines
+                if not stuff or stuff[0].startswith("#"):
+                    continue
+                where = "{0}:{1}".format(detfilename, number)
+                try:
+                    mass, normfactor = float(stuff[1]), float(stuff[2])
+                except (IndexError, ValueError):
+                    self.config_problems.append(where + ": expected <name> <mass in kton> <target normalization>")
+                    continue
+                if stuff[0] in self.configs:
+                    self.config_problems.append(where + ": detector configuration " + stuff[0] + " defined twice")
+                self.configs[stuff[0]] = (mass, normfactor)
+
+    #(channels, problems) of channels/channels_<channame>.dat; channels are (name, index, cpstate, inflav, num_target_factor)
+    def channels(self, channame):
+        return self.channel_file("channels/channels_" + channame + ".dat")
+
+    #(channels, problems) of a channel file given by path
+    def channel_file(self, chanfilename):
+        if chanfilename not in self._channels:
+            self._channels[chanfilename] = self._read_channels(chanfilename)
+        return self._channels[chanfilename]
+
+    #Channels of a channel file given by path, raising PreflightError if it has any problem
+    def require_channels(self, chanfilename):
+        channels, problems = self.channel_file(chanfilename)
+        if problems:
+            raise PreflightError("\n".join(problems))
+        return channels
+
+    #(mass in kton, target normalization) of a detector configuration, raising PreflightError
+    #if it is not defined or the detector file has any problem
+    def require_config(self, expt_config):
+        if self.config_problems:
+            raise PreflightError("\n".join(self.config_problems))
+        if expt_config not in self.configs:
+            raise PreflightError("Detector configuration " + expt_config + " not found in " + self.detfilename)
+        return self.configs[expt_config]
+
+    def _read_channels(self, chanfilename):
+        channels = []
+        problems = []
+        if not os.path.exists(chanfilename):
+            return channels, ["Channel file name " + chanfilename + " not found"]
+        with open(chanfilename) as CHANFILE:
+            for number, line in enumerate(CHANFILE, 1):
+                stuff = line.split()
+                if not stuff or stuff[0].startswith("#"):
+                    continue
+                where = "{0}:{1}".format(chanfilename, number)
+                try:
+                    channel = (stuff[0], int(stuff[1]), stuff[2], stuff[3], float(stuff[4]))
+                except (IndexError, ValueError):
+                    problems.append(where + ": expected <name> <index> <cpstate> <flavor> <target factor>")
+                    continue
+                if (channel[2], channel[3]) not in rate_engine.flavor_columns:
+                    problems.append(where + ": unknown cpstate/flavor " + channel[2] + " " + channel[3])
+                #supernova.py looks the channels up by index, so the indices have to count from 0
+                if channel[1] != len(channels):
+                    problems.append(where + ": channel index {0}, expected {1}".format(channel[1], len(channels)))
+                channels.append(channel)
+        if not channels and not problems:
+            problems.append(chanfilename + ": no channels")
+        return channels, problems
+
+    #Target mass as written to supernova.glb, formatted like $target_mass
+    def target_mass(self, expt_config):
+        masses, normfactor = self.require_config(expt_config)
+        return '{:13.6f}'.format(masses * normfactor)
+
+_registry = None
+
+#Registry of this process, parsed on first use
+def registry():
+    global _registry
+    if _registry is None:
+        _registry = Registry()
+    return _registry
+
+#Whether an executable was built with worker mode (run_worker in src/supernova.c prints #READY)
+def supports_worker(filename=exename):
+    with open(filename, 'rb') as EXEFILE:
+        return b"#READY" in EXEFILE.read()
+
+#Files a run of the given fluxes reads, as [(path, kind)]; the GLoBES executable is included for the globes and worker engines
+def run_files(fluxnames, channame, expt_config, channels, engine="globes"):
+    files = [(filename, "glb") for filename in glb_templates]
+    files.append((detfilename, "detector"))
+    files.append(("channels/channels_" + channame + ".dat", "channels"))
+    if engine in ("globes", "worker"):
+        files.append((exename, "executable"))
+    for channel in channels:
+        files.append(("xscns/xs_" + channel[0] + ".dat", "xscns"))
+        files.append(("smear/smear_" + channel[0] + "_" + expt_config + ".dat", "smear"))
+        files.append(("effic/effic_" + channel[0] + "_" + expt_config + ".dat", "effic"))
+    bg_file = "backgrounds/" + rate_engine.bg_chan_name + "_" + expt_config + ".dat"
+    if os.path.exists(bg_file):
+        files.append((bg_file, "backgrounds"))
+        files.append(("smear/smear_" + rate_engine.bg_chan_name + "_" + expt_config + ".dat", "smear"))
+        files.append(("xscns/xs_zero.dat", "xscns"))
+    for fluxname in fluxnames:
+        files.append(("fluxes/" + fluxname + ".dat", "fluxes"))
+    return files
+
+#Check a run of the fluxes (names relative to fluxes/, without .dat) and return its manifest.
+#manifest["problems"] lists everything that would make the run fail; it is empty when the run can go ahead.
+#extra_files are further [(path, kind)] inputs to check, e.g. the luminosity files of a streamed run.
+def check(fluxnames, channame, expt_config, engine="globes", reg=None, extra_files=()):
+    reg = reg or registry()
+    problems = list(reg.config_problems)
+    channels, channel_problems = reg.channels(channame)
+    problems += channel_problems
+    manifest = {"created": time.strftime("%Y-%m-%d %H:%M:%S"), "engine": engine, "channels": channame,
+                "config": expt_config, "target_mass": None, "background": False,
+                "channel_list": [{"name": channel[0], "index": channel[1], "cpstate": channel[2], "flavor": channel[3], "factor": channel[4]}
+                                 for channel in channels],
+                "fluxes": list(fluxnames), "files": []}
+    if expt_config in reg.configs:
+        manifest["mass"], manifest["normalization"] = reg.configs[expt_config]
+        manifest["target_mass"] = float(reg.target_mass(expt_config))
+    else:
+        problems.append("Detector configuration " + expt_config + " not found in " + reg.detfilename)
+
+    for filename, kind in run_files(fluxnames, channame, expt_config, channels, engine) + list(extra_files):
+        size = os.path.getsize(filename) if os.path.isfile(filename) else None
+        manifest["files"].append({"path": filename, "kind": kind, "bytes": size})
+        if kind == "backgrounds":
+            manifest["background"] = True
+        if size is None:
+            problems.append(kind + " file " + filename + " not found")
+        elif size == 0:
+            problems.append(kind + " file " + filename + " is empty")
+        elif kind == "executable" and not os.access(filename, os.X_OK):
+            problems.append(filename + " is not executable")
+        elif kind == "executable" and engine == "worker" and not supports_worker(filename):
+            problems.append(filename + " was built without worker mode (--worker): rebuild it from src/supernova.c with make -C src install")
+    manifest["problems"] = problems
+    return manifest
+
+#Check a run and raise PreflightError listing every problem
+def require(fluxnames, channame, expt_config, engine="globes", reg=None):
+    manifest = check(fluxnames, channame, expt_config, engine, reg)
+    if manifest["problems"]:
+        raise PreflightError("Preflight check failed for {0} {1}:\n  {2}".format(channame, expt_config, "\n  ".join(manifest["problems"])))
+    return manifest
+
+def write_manifest(manifest, filename):
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w') as OUTFILE:
+        json.dump(manifest, OUTFILE, indent=1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Checks every input of a run before it starts and writes its job manifest')
+    parser.add_argument('fluxname', type=str, help='Name of flux, or of a directory of time-dependent fluxes. \n (eg. livermore or td_fluxes/chimera)')
+    parser.add_argument('channelname', type=str, help='Name of channel. \n (eg. argon)')
+    parser.add_argument('experimentname', type=str, help='Name of experiment. \n (eg. ar17kt)')
+    parser.add_argument('--engine', type=str, choices=['globes', 'numpy', 'worker'], default='globes', help='Rate engine the run will use. \n (globes and worker also need bin/supernova)')
+    parser.add_argument('--manifest', type=str, default=None, help='Write the job manifest to this JSON file. \n (eg. manifest.json)')
+    args = parser.parse_args()
+
+    import scenarios
+    manifest = check(scenarios.flux_names(args.fluxname), args.channelname, args.experimentname, args.engine)
+    if args.manifest:
+        write_manifest(manifest, args.manifest)
+        print("Saved " + args.manifest)
+    print("{0} fluxes, {1} channels{2}, {3} files checked".format(len(manifest["fluxes"]), len(manifest["channel_list"]),
+          " + background" if manifest["background"] else "", len(manifest["files"])))
+    for problem in manifest["problems"]:
+        print("  " + problem)
+    if manifest["problems"]:
+        sys.exit("Preflight check failed: {0} problems".format(len(manifest["problems"])))
+    print("Preflight check passed")
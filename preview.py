@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+
+#Coarse-resolution preview of the NumPy engine for quick parameter scans.
+#The bins and sampling points of glb/preamble.glb are merged in groups so there are
+#--bins of each (the counts have to divide the full ones, e.g. 50 or 100 of 200).
+#Every input is rebinned to match and cached through table_cache:
+#  flux:          mean and slope of the flux over the fine sampling points of a coarse one
+#  cross section: zeroth and first moment (about the coarse energy) of the fine presmear
+#                 weights of a coarse sampling point, at target mass 1
+#  smearing and   the same two moments of the fine smearing matrix times the weights, with
+#  efficiency:    the efficiency of each fine bin folded in before the bins are summed
+#The coarse rates are then exact for a flux that is linear within each coarse sampling
+#point, so totals are conserved up to the curvature of the flux. The background rates
+#are block sums and stay exact. The spectra are written like rate_engine.run, to
+#out/preview_<bins>/ by default, and the totals are compared with the full-resolution
+#NumPy engine unless --no-check is given.
+
+import os
+import time
+import argparse
+import numpy as np
+import rate_engine
+import smearing
+import table_cache
+import preflight
+import scenarios
+
+#Stated tolerance on the relative difference of the totals to the full-resolution run
+default_tolerance = 0.01
+
+def block_sum(x, factor, axis=-1):
+    x = np.moveaxis(np.asarray(x, dtype=float), axis, -1)
+    x = x.reshape(x.shape[:-1] + (x.shape[-1] // factor, factor)).sum(axis=-1)
+    return np.moveaxis(x, -1, axis)
+
+#Ratio a/b, with fallback where b is 0 (coarse points no fine point contributes to)
+def safe_ratio(a, b, fallback):
+    return np.where(b > 0, a / np.where(b > 0, b, 1.), fallback)
+
+#(mtime, size) of files, so the cache key of a rebinned table follows every file it is built from
+def stamp(*filenames):
+    stats = [os.stat(filename) for filename in filenames]
+    return tuple((st.st_mtime_ns, st.st_size) for st in stats)
+
+#Grouping of the full settings for nbins coarse bins: (bin factor, sampling factor)
+def factors(settings, nbins):
+    full_bins = int(settings["bins"])
+    full_samp = int(settings["sampling_points"])
+    if nbins <= 0 or full_bins % nbins or full_samp % nbins:
+        valid = [n for n in range(1, full_bins + 1) if not full_bins % n and not full_samp % n]
+        raise ValueError("{0} preview bins do not divide {1} bins and {2} sampling points; choose one of {3}".format(
+            nbins, full_bins, full_samp, ", ".join(str(n) for n in valid)))
+    return full_bins // nbins, full_samp // nbins
+
+#Offsets of the fine sampling energies from the centre of their coarse sampling point, (coarse x factor)
+def offsets(settings, factor):
+    nsamp = int(settings["sampling_points"])
+    energies = rate_engine.bin_centers(nsamp, settings["sampling_min"], settings["sampling_max"]).reshape(-1, factor)
+    return energies - energies.mean(axis=1)[:, None]
+
+#Flux table on the coarse sampling points: energies, the mean of the six flavor columns
+#and their least-squares slope in 1/GeV (columns 7-12) over each coarse sampling point
+def read_coarse_flux(filename, factor, key):
+    settings = rate_engine.read_glb_settings()
+    nsamp = int(settings["sampling_points"])
+    energies = rate_engine.bin_centers(nsamp, settings["sampling_min"], settings["sampling_max"])
+    delta = offsets(settings, factor)
+    flux = rate_engine.read_flux(filename)
+    phi = [np.interp(energies, flux[:, 0], flux[:, column], left=0., right=0.).reshape(-1, factor) for column in range(1, 7)]
+    means = [p.mean(axis=1) for p in phi]
+    slopes = [safe_ratio((p * delta).sum(axis=1), (delta**2).sum(axis=1), 0.) for p in phi]
+    coarse = rate_engine.bin_centers(nsamp // factor, settings["sampling_min"], settings["sampling_max"])
+    return np.column_stack([coarse] + means + slopes)
+
+#Coarse response of one channel, packed into one array for the cache: the zeroth and first moments
+#of the presmear weights (coarse sampling points each) and of the smeared, efficiency-weighted
+#response (coarse bins x coarse sampling points each). weightfile is the cross section, or the
+#background rates when cpstate is None (the background has no efficiency file).
+def read_coarse_channel(smearfile, weightfile, efficfile, cpstate, inflav, factor_bins, factor_samp, key):
+    settings = rate_engine.read_glb_settings()
+    nbins = int(settings["bins"])
+    nsamp = int(settings["sampling_points"])
+    if cpstate is None:
+        weights = rate_engine.read_list(weightfile)
+    else:
+        samp_energies = rate_engine.bin_centers(nsamp, settings["sampling_min"], settings["sampling_max"])
+        unit_flux = np.column_stack([samp_energies] + [np.ones(nsamp)] * 6)
+        xsec = table_cache.load(weightfile, rate_engine.read_xsec)
+        weights = rate_engine.presmear_rates(unit_flux, xsec, cpstate, inflav, 1., settings)
+    effic = np.ones(nbins)
+    if efficfile is not None:
+        effic = np.asarray(table_cache.load(efficfile, rate_engine.read_list))
+    #Efficiency per fine bin times smearing times weight per fine sampling point
+    folded = smearing.load(smearfile, nbins, nsamp).todense() * effic[:, None] * weights[None, :]
+    delta = offsets(settings, factor_samp).ravel()
+
+    moments = []
+    for moment in (weights, weights * delta):
+        moments.append(block_sum(moment, factor_samp))
+    for moment in (folded, folded * delta[None, :]):
+        moments.append(block_sum(block_sum(moment, factor_bins, axis=0), factor_samp, axis=1).ravel())
+    return np.concatenate(moments)
+
+#Coarse responses of the channels of one (channel file, detector configuration)
+class Preview:
+    def __init__(self, chanfilename, expt_config, nbins):
+        self.settings = rate_engine.read_glb_settings()
+        self.factor_bins, self.factor_samp = factors(self.settings, nbins)
+        self.nbins = int(self.settings["bins"]) // self.factor_bins
+        self.nsamp = int(self.settings["sampling_points"]) // self.factor_samp
+        self.channels = preflight.registry().require_channels(chanfilename)
+        self.target_mass = float(preflight.registry().target_mass(expt_config))
+        self.energies = rate_engine.bin_centers(self.nbins, self.settings["emin"], self.settings["emax"])
+        self.samp_energies = rate_engine.bin_centers(self.nsamp, self.settings["sampling_min"], self.settings["sampling_max"])
+        self.glb_key = stamp("glb/preamble.glb", "glb/flux.glb")
+
+        self.responses = {}
+        for chan_name, index, cpstate, inflav, factor in self.channels:
+            files = ("smear/smear_" + chan_name + "_" + expt_config + ".dat", "xscns/xs_" + chan_name + ".dat",
+                     "effic/effic_" + chan_name + "_" + expt_config + ".dat")
+            self.responses[chan_name] = (rate_engine.flavor_columns[(cpstate, inflav)], self._load(files, cpstate, inflav))
+
+        self.background = None
+        bg_file = "backgrounds/" + rate_engine.bg_chan_name + "_" + expt_config + ".dat"
+        if os.path.exists(bg_file):
+            files = ("smear/smear_" + rate_engine.bg_chan_name + "_" + expt_config + ".dat", bg_file, None)
+            self.background = self._load(files, None, None)
+
+    #(weights, weight slopes, response, response slopes) of a channel, through the cache
+    def _load(self, files, cpstate, inflav):
+        key = stamp(*[filename for filename in files if filename]) + self.glb_key
+        table = np.asarray(table_cache.load(files[0], read_coarse_channel, files[1], files[2], cpstate, inflav,
+                                            self.factor_bins, self.factor_samp, key))
+        size = self.nbins * self.nsamp
+        return (table[:self.nsamp], table[self.nsamp:2 * self.nsamp],
+                table[2 * self.nsamp:2 * self.nsamp + size].reshape(self.nbins, self.nsamp),
+                table[2 * self.nsamp + size:].reshape(self.nbins, self.nsamp))
+
+    #fluxes/<fluxname>.dat on the coarse sampling points, through the cache
+    def flux(self, fluxname):
+        filename = "fluxes/" + fluxname + ".dat"
+        return table_cache.load(filename, read_coarse_flux, self.factor_samp, stamp(filename) + self.glb_key)
+
+    #{chan_name: (pre, post)} like rate_engine.compute_rates, at the coarse resolution
+    def rates(self, flux):
+        results = {}
+        for chan_name, (column, (weights, slopes, response, response_slopes)) in self.responses.items():
+            mean, slope = flux[:, column], flux[:, column + 6]
+            pre = self.target_mass * (weights * mean + slopes * slope)
+            post = self.target_mass * (response.dot(mean) + response_slopes.dot(slope))
+            results[chan_name] = (pre, post)
+        if self.background is not None:
+            #The background rates are the weights themselves, for a flux of 1
+            pre, slopes, response, response_slopes = self.background
+            results[rate_engine.bg_chan_name] = (pre.copy(), response.sum(axis=1))
+        return results
+
+    #Write the spectra of a flux as rate_engine.run does, weighted or unweighted
+    def write(self, fluxname, results, expt_config, outdir, weight=False):
+        os.makedirs(os.path.dirname(os.path.join(outdir, fluxname)), exist_ok=True)
+        factors = {channel[0]: channel[4] for channel in self.channels}
+        for chan_name, (pre, post) in results.items():
+            #The background channel is not in the channel file and is never weighted
+            suffix = "" if weight and chan_name in factors else "_unweighted"
+            scale = factors[chan_name] if suffix == "" else 1.
+            outfile = outdir + "/" + fluxname + "_" + chan_name + "_" + expt_config + "_events"
+            rate_engine.write_rates(outfile + suffix + ".dat", self.samp_energies, scale * pre)
+            rate_engine.write_rates(outfile + "_smeared" + suffix + ".dat", self.energies, scale * post)
+
+#Preview rates of a flux or flux series. Returns the Preview, the unweighted totals summed
+#over the fluxes as {chan_name: (pre total, post total)} and the output directory.
+def run(fluxname, channame, expt_config, nbins, outdir=None, weight=False):
+    preview = Preview("channels/channels_" + channame + ".dat", expt_config, nbins)
+    if outdir is None:
+        outdir = "out/preview_{0}".format(preview.nbins)
+    totals = {}
+    for name in scenarios.flux_names(fluxname):
+        results = preview.rates(preview.flux(name))
+        preview.write(name, results, expt_config, outdir, weight)
+        for chan_name, (pre, post) in results.items():
+            previous = totals.get(chan_name, (0., 0.))
+            totals[chan_name] = (previous[0] + pre.sum(), previous[1] + post.sum())
+    return preview, totals, outdir
+
+#Totals of the same fluxes at full resolution with the NumPy engine, without writing any files
+def full_totals(fluxname, channame, expt_config, target_mass):
+    settings = rate_engine.read_glb_settings()
+    totals = {}
+    for name in scenarios.flux_names(fluxname):
+        flux = rate_engine.read_flux("fluxes/" + name + ".dat")
+        for chan_name, (pre, post) in rate_engine.compute_rates(flux, "channels/channels_" + channame + ".dat", expt_config, target_mass, settings).items():
+            previous = totals.get(chan_name, (0., 0.))
+            totals[chan_name] = (previous[0] + pre.sum(), previous[1] + post.sum())
+    return totals
+
+#Print the preview and full-resolution totals per channel and return the largest relative difference.
+#Channels and the sum over all of them are compared unsmeared and smeared; channels with no
+#events at full resolution are compared absolutely.
+def compare(totals, reference):
+    print("{0:<28} {1:<9} {2:>14} {3:>14} {4:>11}".format("channel", "", "preview", "full", "difference"))
+    rows = [(chan_name, totals[chan_name], reference[chan_name]) for chan_name in reference]
+    rows.append(("all", tuple(np.sum([totals[c] for c in reference], axis=0)), tuple(np.sum(list(reference.values()), axis=0))))
+    worst = 0.
+    for chan_name, coarse, full in rows:
+        for kind, a, b in (("unsmeared", coarse[0], full[0]), ("smeared", coarse[1], full[1])):
+            diff = abs(a - b) / abs(b) if b else abs(a)
+            worst = max(worst, diff)
+            print("{0:<28} {1:<9} {2:14.6g} {3:14.6g} {4:11.2e}".format(chan_name, kind, a, b, diff))
+    return worst
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Coarse-resolution preview of the rates, checked against the full-resolution totals')
+    parser.add_argument('fluxname', type=str, help='Name of flux, or of a directory of time-dependent fluxes. \n (eg. livermore or td_fluxes/chimera)')
+    parser.add_argument('channelname', type=str, help='Name of channel. \n (eg. argon)')
+    parser.add_argument('experimentname', type=str, help='Name of experiment. \n (eg. ar17kt)')
+    parser.add_argument('--bins', type=int, default=50, help='Number of preview bins and sampling points; has to divide the full ones. \n (eg. 50 or 100)')
+    parser.add_argument('--weight', action='store_true', help='Apply the channel weighting factors')
+    parser.add_argument('--outdir', type=str, default=None, help='Directory of the preview spectra. \n (default: out/preview_<bins>)')
+    parser.add_argument('--tolerance', type=float, default=default_tolerance, help='Largest accepted relative difference of the totals to the full-resolution run. \n (eg. 0.01)')
+    parser.add_argument('--no-check', action='store_true', help='Skip the comparison with the full-resolution run')
+    args = parser.parse_args()
+
+    manifest = preflight.check(scenarios.flux_names(args.fluxname), args.channelname, args.experimentname, "numpy")
+    if manifest["problems"]:
+        raise SystemExit("Preflight check failed:\n  " + "\n  ".join(manifest["problems"]))
+
+    start = time.time()
+    try:
+        preview, totals, outdir = run(args.fluxname, args.channelname, args.experimentname, args.bins, args.outdir, args.weight)
+    except ValueError as error:
+        raise SystemExit(str(error))
+    elapsed = time.time() - start
+    print("Preview of {0} at {1} bins x {2} sampling points in {3:.3f} s, spectra in {4}".format(
+        args.fluxname, preview.nbins, preview.nsamp, elapsed, outdir))
+
+    if not args.no_check:
+        start = time.time()
+        reference = full_totals(args.fluxname, args.channelname, args.experimentname, preview.target_mass)
+        print("Full resolution in {0:.3f} s (unweighted totals)".format(time.time() - start))
+        worst = compare(totals, reference)
+        if worst > args.tolerance:
+            raise SystemExit("Preview totals differ from the full-resolution run by {0:.2e}, more than the tolerance {1:g}".format(worst, args.tolerance))
+        print("Preview totals within {0:g} of the full-resolution run (largest difference {1:.2e})".format(args.tolerance, worst))
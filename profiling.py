@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+
+#Stage timing for supernova.py, td_supernova.py, interpolate.py and bin/supernova.
+#With --profile <file> (or SNOWGLOBES_PROFILE=<file> in the environment) every stage
+#appends one JSON line to <file>:
+#   {"script": ..., "stage": ..., "pid": ..., "time": ..., "wall": s, "cpu": s,
+#    "child_cpu": s, "read_bytes": n, "write_bytes": n, "files_read": n, "files_written": n, ...}
+#The path is exported to the environment, so the bin/supernova runs started by td_supernova.py
+#(whose timesteps run supernova.run_flux in-process) append to the same file and a whole
+#time-dependent run can be summed with python profiling.py <file>. Bytes come from /proc/self/io (null where it does not exist);
+#files are counted by an audit hook on the "open" event, by mode, leaving open() itself untouched. With --pstats <dir> each Python process also dumps its
+#cProfile statistics to <dir>/<script>.<pid>.prof, which python profiling.py --pstats <dir> merges.
+
+import os
+import sys
+import json
+import time
+import glob
+import atexit
+import pstats
+import cProfile
+import resource
+import argparse
+import contextlib
+from collections import OrderedDict
+
+profile_env = "SNOWGLOBES_PROFILE"
+pstats_env = "SNOWGLOBES_PSTATS"
+
+_state = {"path": None, "script": None, "context": {}, "last": None, "files_read": 0, "files_written": 0, "counting": False}
+
+#Audit hook counting the files opened for reading and for writing (open() gives a mode, os.open only flags)
+def _audit(event, args):
+    if event != "open" or not _state["counting"]:
+        return
+    path, mode, flags = args
+    if mode is not None:
+        writing = any(c in mode for c in "wax+")
+    else:
+        writing = bool(flags & (os.O_WRONLY | os.O_RDWR))
+    _state["files_written" if writing else "files_read"] += 1
+
+#Files the profiler opens itself are not counted
+@contextlib.contextmanager
+def _uncounted():
+    counting = _state["counting"]
+    _state["counting"] = False
+    try:
+        yield
+    finally:
+        _state["counting"] = counting
+
+def _open(*args, **kwargs):
+    with _uncounted():
+        return open(*args, **kwargs)
+
+#(rchar, wchar) of this process, or (None, None) where /proc/self/io does not exist
+def io_counters():
+    try:
+        with _open("/proc/self/io") as IOFILE:
+            counters = dict(line.split(":") for line in IOFILE)
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+def _snapshot():
+    read_bytes, write_bytes = io_counters()
+    return {"wall": time.perf_counter(), "cpu": time.process_time(),
+            "child_cpu": sum(resource.getrusage(resource.RUSAGE_CHILDREN)[:2]),
+            "read_bytes": read_bytes, "write_bytes": write_bytes,
+            "files_read": _state["files_read"], "files_written": _state["files_written"]}
+
+def _delta(start, end):
+    return None if start is None or end is None else end - start
+
+def enabled():
+    return _state["path"] is not None
+
+def _write(record):
+    line = json.dumps(record) + "\n"
+    #One short append per record, so processes sharing the file do not interleave lines
+    with _open(_state["path"], 'a') as PROFILE:
+        PROFILE.write(line)
+
+#Wall and CPU time of this process from its start to now (Python startup and imports)
+def _startup_record():
+    record = {"wall": None, "cpu": time.process_time()}
+    try:
+        with _open("/proc/self/stat") as STATFILE:
+            start_ticks = float(STATFILE.read().rsplit(")", 1)[1].split()[19])
+        with _open("/proc/stat") as STATFILE:
+            boot_time = float([line.split()[1] for line in STATFILE if line.startswith("btime")][0])
+        record["wall"] = time.time() - (boot_time + start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, IndexError, ValueError):
+        pass
+    return record
+
+#Start profiling this script if a path is given or SNOWGLOBES_PROFILE is set, and cProfile if a
+#pstats directory is given or SNOWGLOBES_PSTATS is set. context is added to every record (e.g. the flux).
+def init(script, path=None, pstats_dir=None, **context):
+    path = path or os.environ.get(profile_env)
+    pstats_dir = pstats_dir or os.environ.get(pstats_env)
+    if pstats_dir:
+        pstats_dir = os.path.abspath(pstats_dir)
+        os.makedirs(pstats_dir, exist_ok=True)
+        os.environ[pstats_env] = pstats_dir
+        profiler = cProfile.Profile()
+        profiler.enable()
+        atexit.register(_dump_pstats, profiler, os.path.join(pstats_dir, "%s.%d.prof" % (os.path.basename(script), os.getpid())))
+    if not path:
+        return
+    _state["path"] = os.path.abspath(path)
+    os.environ[profile_env] = _state["path"]
+    _state["script"] = script
+    _state["context"] = context
+    #Audit hooks cannot be removed, so there is one per process, idle until now
+    if not _state.get("hooked"):
+        sys.addaudithook(_audit)
+        _state["hooked"] = True
+    _state["counting"] = True
+    startup = _startup_record()
+    _write(OrderedDict([("script", script), ("stage", "startup"), ("pid", os.getpid()), ("time", time.time()),
+                        ("wall", startup["wall"]), ("cpu", startup["cpu"])] + list(context.items())))
+    _state["last"] = _snapshot()
+
+def _dump_pstats(profiler, filename):
+    profiler.disable()
+    profiler.dump_stats(filename)
+
+#Record the stage that ran since the previous record (for scripts that run top to bottom)
+def checkpoint(stage, **extra):
+    if not enabled():
+        return
+    now = _snapshot()
+    start = _state["last"]
+    record = OrderedDict([("script", _state["script"]), ("stage", stage), ("pid", os.getpid()), ("time", time.time())])
+    for key in ("wall", "cpu", "child_cpu", "read_bytes", "write_bytes", "files_read", "files_written"):
+        record[key] = _delta(start[key], now[key])
+    record.update(_state["context"])
+    record.update(extra)
+    _write(record)
+    _state["last"] = _snapshot()
+
+#Record the stage run inside the with block
+@contextlib.contextmanager
+def stage(name, **extra):
+    if enabled():
+        _state["last"] = _snapshot()
+    yield
+    checkpoint(name, **extra)
+
+#Sum the records of a JSON lines file per (script, stage)
+def summarize(filename):
+    totals = OrderedDict()
+    keys = ("wall", "cpu", "child_cpu", "read_bytes", "write_bytes", "files_read", "files_written")
+    with _open(filename) as PROFILE:
+        for line in PROFILE:
+            record = json.loads(line)
+            total = totals.setdefault((record["script"], record["stage"]), dict({key: 0 for key in keys}, count=0))
+            total["count"] += 1
+            for key in keys:
+                total[key] += record.get(key) or 0
+    return totals
+
+def print_summary(totals):
+    print("{0:<18} {1:<14} {2:>7} {3:>11} {4:>11} {5:>11} {6:>12} {7:>12} {8:>7} {9:>7}".format(
+        "script", "stage", "count", "wall (s)", "cpu (s)", "child (s)", "read (MB)", "written (MB)", "f.read", "f.wrote"))
+    for (script, stage_name), total in totals.items():
+        print("{0:<18} {1:<14} {2:7d} {3:11.3f} {4:11.3f} {5:11.3f} {6:12.3f} {7:12.3f} {8:7d} {9:7d}".format(
+            script, stage_name, total["count"], total["wall"], total["cpu"], total["child_cpu"],
+            total["read_bytes"] / 1e6, total["write_bytes"] / 1e6, total["files_read"], total["files_written"]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Summarizes the --profile JSON lines of a run, or merges its cProfile dumps')
+    parser.add_argument('profile', type=str, nargs='?', help='JSON lines file written with --profile. \n (eg. profile.jsonl)')
+    parser.add_argument('--pstats', type=str, default=None, help='Directory of cProfile dumps written with --pstats to merge and print')
+    parser.add_argument('--sort', type=str, default='cumulative', help='pstats sort key for --pstats. \n (eg. tottime)')
+    parser.add_argument('--top', type=int, default=30, help='Number of functions printed for --pstats')
+    args = parser.parse_args()
+
+    if args.profile:
+        print_summary(summarize(args.profile))
+    if args.pstats:
+        filenames = sorted(glob.glob(os.path.join(args.pstats, "*.prof")))
+        if not filenames:
+            sys.exit("No cProfile dumps in " + args.pstats)
+        stats = pstats.Stats(*filenames)
+        stats.sort_stats(args.sort).print_stats(args.top)
+    if not args.profile and not args.pstats:
+        parser.print_help()
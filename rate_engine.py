@@ -0,0 +1,314 @@
+#!/usr/bin/python3
+
+#In-process NumPy version of bin/supernova (src/supernova.c).
+#It reads the same flux, cross-section, smearing, efficiency and background
+#files that supernova.py pastes into supernova.glb, and writes the same
+#out/<flux>_<chan>_<config>_events[_smeared]_unweighted.dat files.
+
+import os
+import io
+import re
+import shutil
+import argparse
+import tempfile
+import contextlib
+import numpy as np
+import table_cache
+import smearing
+import preflight
+
+#Column of the flux and cross-section tables for each (cpstate, inflav)
+flavor_columns = {("+", "e"): 1, ("+", "m"): 2, ("+", "t"): 3,
+                  ("-", "e"): 4, ("-", "m"): 5, ("-", "t"): 6}
+
+bg_chan_name = "bg_chan"
+
+#Read the numeric $/@ settings (bins, energy window, baseline, flux norm) from the GLoBES templates
+def read_glb_settings(preamble="glb/preamble.glb", flux="glb/flux.glb"):
+    settings = {}
+    p = re.compile(r"[$@](\w+)\s*=\s*([-+]?[0-9.]+(?:[eE][-+]?[0-9]+)?)")
+    for filename in (preamble, flux):
+        with open(filename) as GLB:
+            for name, value in p.findall(GLB.read()):
+                settings[name] = float(value)
+    return settings
+
+#Central energies of n equal bins between emin and emax
+def bin_centers(n, emin, emax):
+    width = (emax - emin) / n
+    return emin + (np.arange(n) + 0.5) * width
+
+def read_flux(filename):
+    return np.loadtxt(filename, ndmin=2)
+
+def read_xsec(filename):
+    return np.loadtxt(filename, comments="#", ndmin=2)
+
+#Read a {v0,v1,...} list, as used by the efficiency and background files
+def read_list(filename):
+    with open(filename) as LISTFILE:
+        contents = LISTFILE.read()
+    return np.array(contents.strip().strip("{}").split(","), dtype=float)
+
+#Read a GLoBES @energy matrix. Each row is {start,end,values...} with
+#values for the sampling points start..end of that reconstructed bin.
+def read_smear(filename, nbins=200, nsamp=200):
+    with open(filename) as SMEARFILE:
+        contents = SMEARFILE.read()
+    rows = re.findall(r"\{([^}]*)\}", contents)
+    matrix = np.zeros((nbins, nsamp))
+    for i, row in enumerate(rows[:nbins]):
+        values = np.array(row.split(","), dtype=float)
+        start = int(values[0])
+        end = int(values[1])
+        matrix[i, start:end + 1] = values[2:end - start + 3]
+    return matrix
+
+#Un-smeared rates at the sampling points for one channel.
+#GLoBES: N_k = target_mass * time * power * norm / L^2 * flux(E_k) * E_k * xsec(E_k) * dE,
+#with the cross-section tabulated as sigma/E in log10(E).
+def presmear_rates(flux, xsec, cpstate, inflav, target_mass, settings):
+    column = flavor_columns[(cpstate, inflav)]
+    nsamp = int(settings["sampling_points"])
+    energies = bin_centers(nsamp, settings["sampling_min"], settings["sampling_max"])
+    width = (settings["sampling_max"] - settings["sampling_min"]) / nsamp
+    phi = np.interp(energies, flux[:, 0], flux[:, column], left=0., right=0.)
+    sigma = np.interp(np.log10(energies), xsec[:, 0], xsec[:, column], left=0., right=0.) * energies
+    norm = target_mass * settings["time"] * settings["power"] * settings["norm"] / settings["baseline"]**2
+    return norm * phi * sigma * width
+
+#Smear the sampling-point rates into reconstructed bins and apply the post-smearing efficiencies
+def smear_rates(pre, matrix, effic=None):
+    post = matrix.dot(pre)
+    if effic is not None:
+        post = post * effic
+    return post
+
+#A spectrum in the layout of glbShowChannelRates
+def rates_text(energies, rates):
+    lines = ["%12.6g \t %12.6g \n" % (e, r) for e, r in zip(energies, rates)]
+    lines.append("----------------------\n")
+    lines.append("Total:\t%12.6g\n" % rates.sum())
+    return "".join(lines)
+
+def write_rates(filename, energies, rates):
+    with open(filename, 'w') as OUTFILE:
+        OUTFILE.write(rates_text(energies, rates))
+
+#Apply the channel weighting factors to the texts of unweighted output files.
+#All rates of all files are scaled in one array operation; each weighted line
+#is "<enbin> <evrate*factor>", blank and comment lines are dropped and the
+#separator bar is kept, as the old line-by-line apply_weights did.
+def weight_texts(texts, factors):
+    files = []
+    values = []
+    counts = []
+    for text in texts:
+        rows = [line.split() for line in text.splitlines()]
+        rows = [row for row in rows if row and not row[0].startswith("#")]
+        files.append(rows)
+        data = [row[1] for row in rows if row[0] != "----------------------"]
+        values.extend(data)
+        counts.append(len(data))
+    weighted = (np.array(values, dtype=float) * np.repeat(np.asarray(factors, dtype=float), counts)).tolist()
+
+    outputs = []
+    k = 0
+    for rows in files:
+        lines = []
+        for row in rows:
+            if row[0] == "----------------------":
+                lines.append("----------------------\n")
+            else:
+                lines.append("{0} {1}\n".format(row[0], weighted[k]))
+                k += 1
+        outputs.append("".join(lines))
+    return outputs
+
+#Apply the channel weighting factors to the unweighted <flux>_<chan>_<config>_events<suffix>_unweighted.dat
+#files of a run. Every file is read in one go, all channels are scaled by their num_target_factor
+#in one array operation, and each weighted file is written in a single write.
+def apply_weights(fluxname, chanfilename, expt_config, suffixes, keep_unweighted=True, outdir="out"):
+    #Create the unweighted and weighted file names for each channel and output type
+    unweightedfilenames = []
+    weightedfilenames = []
+    factors = []
+    for suffix in suffixes:
+        for chan_name, index, cpstate, inflav, num_target_factor in preflight.registry().require_channels(chanfilename):
+            unweightedfilenames.append(outdir + "/" + fluxname + "_" + chan_name + "_" + expt_config + "_events" + suffix + "_unweighted.dat")
+            weightedfilenames.append(outdir + "/" + fluxname + "_" + chan_name + "_" + expt_config + "_events" + suffix + ".dat")
+            factors.append(num_target_factor)
+
+    texts = []
+    for unweightedfilename in unweightedfilenames:
+        with open(unweightedfilename, 'r') as UNWEIGHTED:
+            texts.append(UNWEIGHTED.read())
+
+    for weightedfilename, text in zip(weightedfilenames, weight_texts(texts, factors)):
+        with open(weightedfilename, 'w') as WEIGHTED:
+            WEIGHTED.write(text)
+
+    if not keep_unweighted:
+        for unweightedfilename in unweightedfilenames:
+            os.remove(unweightedfilename)
+
+#Read the energies and rates back from a glbShowChannelRates style file
+def read_rates(filename):
+    energies = []
+    rates = []
+    with open(filename) as RATEFILE:
+        for line in RATEFILE:
+            stuff = line.split()
+            if not stuff or stuff[0].startswith("#"):
+                continue
+            if stuff[0].startswith("---"):
+                break
+            energies.append(float(stuff[0]))
+            rates.append(float(stuff[1]))
+    return np.array(energies), np.array(rates)
+
+#Compute {chan_name: (pre, post)} for every channel of the file, plus the
+#background channel when backgrounds/bg_chan_<config>.dat exists
+def compute_rates(flux, chanfilename, expt_config, target_mass, settings=None):
+    if settings is None:
+        settings = read_glb_settings()
+    nbins = int(settings["bins"])
+    nsamp = int(settings["sampling_points"])
+    results = {}
+    for chan_name, index, cpstate, inflav, factor in preflight.registry().require_channels(chanfilename):
+        xsec = table_cache.load("xscns/xs_" + chan_name + ".dat", read_xsec)
+        matrix = smearing.load("smear/smear_" + chan_name + "_" + expt_config + ".dat", nbins, nsamp)
+        effic = table_cache.load("effic/effic_" + chan_name + "_" + expt_config + ".dat", read_list)
+        pre = presmear_rates(flux, xsec, cpstate, inflav, target_mass, settings)
+        results[chan_name] = (pre, smear_rates(pre, matrix, effic))
+
+    #The fake background channel has a zero cross-section, so only the pre-smearing background (added as-is) contributes
+    bg_file = "backgrounds/" + bg_chan_name + "_" + expt_config + ".dat"
+    if os.path.exists(bg_file):
+        pre = read_list(bg_file)
+        matrix = smearing.load("smear/smear_" + bg_chan_name + "_" + expt_config + ".dat", nbins, nsamp)
+        results[bg_chan_name] = (pre, smear_rates(pre, matrix))
+    return results
+
+#Same as bin/supernova: write the unweighted unsmeared and smeared spectra for every channel.
+#With weight=True the channel weighting factors are applied before writing, so only the
+#weighted <flux>_<chan>_<config>_events[_smeared].dat files are created, plus the
+#unweighted ones too with keep_unweighted=True (the files supernova.py --weight leaves).
+#A flux table already read with read_flux can be passed in to skip reading it again.
+def run(fluxname, chanfilename, expt_config, target_mass, outdir="out", weight=False, flux=None, keep_unweighted=False):
+    settings = read_glb_settings()
+    print("Channels from %s" % chanfilename)
+    if flux is None:
+        flux = read_flux("fluxes/" + fluxname + ".dat")
+    results = compute_rates(flux, chanfilename, expt_config, target_mass, settings)
+
+    energies = bin_centers(int(settings["bins"]), settings["emin"], settings["emax"])
+    samp_energies = bin_centers(int(settings["sampling_points"]), settings["sampling_min"], settings["sampling_max"])
+    os.makedirs(os.path.dirname(os.path.join(outdir, fluxname)), exist_ok=True)
+    factors = {channel[0]: channel[4] for channel in preflight.registry().require_channels(chanfilename)}
+    for ifile, (chan_name, (pre, post)) in enumerate(results.items()):
+        texts = [rates_text(samp_energies, pre), rates_text(energies, post)]
+        outputs = []
+        #The background channel is not in the channel file and is never weighted
+        if weight and chan_name in factors:
+            outputs.append(("", weight_texts(texts, [factors[chan_name]] * 2)))
+        if not weight or keep_unweighted or chan_name not in factors:
+            outputs.append(("_unweighted", texts))
+        for suffix, suffix_texts in outputs:
+            outfile = outdir + "/" + fluxname + "_" + chan_name + "_" + expt_config + "_events" + suffix + ".dat"
+            outfile_smeared = outdir + "/" + fluxname + "_" + chan_name + "_" + expt_config + "_events_smeared" + suffix + ".dat"
+            for outname, text in zip((outfile, outfile_smeared), suffix_texts):
+                print("%i %s" % (ifile, outname))
+                with open(outname, 'w') as OUTFILE:
+                    OUTFILE.write(text)
+    if bg_chan_name not in results:
+        print("No background file")
+    return results
+
+#Compare the NumPy rates with the unweighted files bin/supernova left in outdir
+def crosscheck(fluxname, chanfilename, expt_config, target_mass, outdir="out", rtol=1e-3):
+    flux = read_flux("fluxes/" + fluxname + ".dat")
+    results = compute_rates(flux, chanfilename, expt_config, target_mass)
+    return compare_rates(results, fluxname, expt_config, outdir, rtol)
+
+#Compare {chan_name: (pre, post)} with the unweighted glbShowChannelRates files in outdir
+def compare_rates(results, fluxname, expt_config, outdir, rtol=1e-3):
+    ok = True
+    for chan_name, (pre, post) in results.items():
+        for suffix, rates in (("", pre), ("_smeared", post)):
+            globesfile = outdir + "/" + fluxname + "_" + chan_name + "_" + expt_config + "_events" + suffix + "_unweighted.dat"
+            if not os.path.exists(globesfile):
+                print("GLoBES output " + globesfile + " not found")
+                ok = False
+                continue
+            globes_rates = read_rates(globesfile)[1]
+            #GLoBES prints 6 significant digits, so compare per bin relative to the spectrum peak
+            scale = max(np.abs(globes_rates).max(), 1e-300)
+            maxdiff = np.abs(rates - globes_rates).max() / scale
+            totaldiff = abs(rates.sum() - globes_rates.sum()) / max(abs(globes_rates.sum()), 1e-300)
+            passed = maxdiff <= rtol and totaldiff <= rtol
+            ok = ok and passed
+            print("{0:<28} {1:<9} total {2:12.6g} vs {3:12.6g}  max bin diff {4:.2e}  {5}".format(
+                chan_name, suffix.strip("_") or "unsmeared", rates.sum(), globes_rates.sum(), maxdiff, "ok" if passed else "FAIL"))
+    return ok
+
+#Reference output of bin/supernova, committed so the NumPy engine can be checked without GLoBES installed
+reference_dir = "reference"
+
+#Run bin/supernova on a flux and copy its unweighted output into reference_dir
+def make_reference(fluxname, channame, expt_config, refdir=reference_dir):
+    import supernova
+    if supernova.run_flux(fluxname, channame, expt_config, engine="globes") != 0:
+        raise SystemExit("bin/supernova failed, no reference written")
+    os.makedirs(refdir, exist_ok=True)
+    copied = 0
+    for chan_name in [channel[0] for channel in preflight.registry().require_channels("channels/channels_" + channame + ".dat")] + [bg_chan_name]:
+        for suffix in ("", "_smeared"):
+            filename = fluxname + "_" + chan_name + "_" + expt_config + "_events" + suffix + "_unweighted.dat"
+            if os.path.exists(os.path.join("out", filename)):
+                shutil.copy(os.path.join("out", filename), os.path.join(refdir, filename))
+                copied += 1
+    print("Copied {0} files to {1}".format(copied, refdir))
+
+#Run the NumPy engine (rate_engine.run) into a temporary directory and compare the written
+#files with the reference output of bin/supernova, per bin and in total within rtol
+def check_reference(fluxname, channame, expt_config, target_mass, refdir=reference_dir, rtol=1e-3):
+    chanfilename = "channels/channels_" + channame + ".dat"
+    if not os.path.isdir(refdir):
+        print("No reference output in " + refdir + ": run python rate_engine.py " + " ".join((fluxname, channame, expt_config)) + " --make-reference where bin/supernova runs")
+        return False
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with contextlib.redirect_stdout(io.StringIO()):
+            run(fluxname, chanfilename, expt_config, target_mass, outdir=tmpdir)
+        results = {}
+        for chan_name in [channel[0] for channel in preflight.registry().require_channels(chanfilename)] + [bg_chan_name]:
+            outfile = tmpdir + "/" + fluxname + "_" + chan_name + "_" + expt_config + "_events"
+            if os.path.exists(outfile + "_unweighted.dat"):
+                results[chan_name] = (read_rates(outfile + "_unweighted.dat")[1], read_rates(outfile + "_smeared_unweighted.dat")[1])
+    return compare_rates(results, fluxname, expt_config, refdir, rtol)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'NumPy rate engine for SNOwGLoBES. Writes the same unweighted output as bin/supernova.')
+    parser.add_argument('fluxname', type=str, help='Name of flux. \n (eg. livermore)')
+    parser.add_argument('channelname', type=str, help='Name of channel. \n (eg. argon)')
+    parser.add_argument('experimentname', type=str, help='Name of experiment. \n (eg. ar17kt)')
+    parser.add_argument('--crosscheck', action='store_true', help='Compare against the bin/supernova output already in out/ instead of writing files. \n (run python supernova.py <flux> <channel> <experiment> first)')
+    parser.add_argument('--reference', action='store_true', help='Compare the output of the NumPy engine with the bin/supernova output committed in reference/. \n (eg. python rate_engine.py livermore argon ar17kt --reference)')
+    parser.add_argument('--make-reference', action='store_true', help='Run bin/supernova and copy its unweighted output to reference/')
+    parser.add_argument('--rtol', type=float, default=1e-3, help='Relative tolerance for --crosscheck and --reference, per bin (relative to the spectrum peak) and in total')
+    args = parser.parse_args()
+
+    chanfilename = "channels/channels_" + args.channelname + ".dat"
+    target_mass = float(preflight.registry().target_mass(args.experimentname))
+
+    if args.make_reference:
+        make_reference(args.fluxname, args.channelname, args.experimentname)
+    elif args.reference:
+        if not check_reference(args.fluxname, args.channelname, args.experimentname, target_mass, rtol=args.rtol):
+            raise SystemExit(1)
+        print("NumPy engine matches the bin/supernova reference within {0:g}".format(args.rtol))
+    elif args.crosscheck:
+        if not crosscheck(args.fluxname, chanfilename, args.experimentname, target_mass, rtol=args.rtol):
+            raise SystemExit(1)
+    else:
+        run(args.fluxname, chanfilename, args.experimentname, target_mass)
@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+
+#Monte Carlo event realizations for trigger and burst-alert studies.
+#The expected counts are the weighted smeared spectra of a run (supernova.py --weight, or a
+#time-dependent run through its time-window index), plus the unweighted smeared bg_chan
+#spectrum when backgrounds/bg_chan_<config>.dat exists. Every realization draws an independent
+#Poisson count per (time bin, channel, energy bin) with numpy.random.Generator.
+#Realizations are drawn in chunks sized to a memory budget, each from its own child of
+#SeedSequence(seed), and the chunks run on a process pool, so the same seed and chunk size
+#give the same realizations whatever the number of jobs. Only running sums are kept per bin;
+#per realization the channel totals and the peak time bin are kept, and --dump writes the
+#(realization x time bin x channel) counts summed over energy to a memory-mapped .npy file.
+
+import os
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from numpy.lib.format import open_memmap
+import rate_engine
+import preflight
+import time_index
+
+#Expected counts of a single flux: (None, channels, energies, 1 x channel x bin)
+def expected_single(fluxname, channame, expt_config, outdir="out"):
+    channels = [channel[0] for channel in preflight.registry().require_channels("channels/channels_" + channame + ".dat")]
+    if os.path.exists("backgrounds/" + rate_engine.bg_chan_name + "_" + expt_config + ".dat"):
+        channels.append(rate_engine.bg_chan_name)
+    spectra = []
+    for chan_name in channels:
+        #The background is never weighted
+        suffix = "_smeared_unweighted" if chan_name == rate_engine.bg_chan_name else "_smeared"
+        filename = outdir + "/" + fluxname + "_" + chan_name + "_" + expt_config + "_events" + suffix + ".dat"
+        if not os.path.exists(filename):
+            raise SystemExit(filename + " not found: run supernova.py " + fluxname + " " + channame + " " + expt_config + " --weight first")
+        energies, rates = rate_engine.read_rates(filename)
+        spectra.append(rates)
+    return None, channels, energies, np.array(spectra)[None]
+
+#Expected counts of a time-dependent run per timestep, or per dt seconds:
+#(post-bounce times or left bin edges, channels, energies, time x channel x bin)
+def expected_td(fluxname, channame, expt_config, dt=None, outdir="out"):
+    time_index.update(fluxname, channame, expt_config, outdir)
+    index = time_index.TimeIndex(time_index.index_path(fluxname, channame, expt_config, outdir))
+    if not len(index):
+        raise SystemExit("No timesteps of " + fluxname + " to sample: run td_supernova.py first")
+    edges = None
+    if dt:
+        edges = np.arange(index.times[0], index.times[-1] + dt + dt / 2, dt)
+    times, spectra = index.grid("smeared", edges)
+    background = index.grid("smeared_unweighted", edges)[1]
+    for c, chan_name in enumerate(index.channels):
+        if chan_name == rate_engine.bg_chan_name:
+            spectra[:, c] = background[:, c]
+    return times, index.channels, index.energies["smeared"], spectra
+
+_means = None
+
+def _init_worker(means):
+    global _means
+    _means = means
+
+#count realizations from one child seed: per-bin sum and sum of squares, per-realization channel
+#totals and peak time-bin total, and the (realization x time x channel) counts when dump is set
+def _draw(seed, count, dump):
+    rng = np.random.default_rng(seed)
+    counts = rng.poisson(_means, size=(count,) + _means.shape)
+    per_time = counts.sum(axis=3)
+    return (counts.sum(axis=0), np.einsum('i...,i...->...', counts, counts), per_time.sum(axis=1),
+            per_time.sum(axis=2).max(axis=1), per_time.astype(np.int32) if dump else None)
+
+#Draw n realizations of the (time x channel x bin) expected counts means. Returns a dict of the
+#per-bin "mean" and "var", the (n x channel) "totals" and the (n) "peaks" (largest total of a time bin).
+def realize(means, n, seed=0, jobs=1, chunk=None, memory=256e6, dump=None):
+    means = np.clip(np.nan_to_num(np.asarray(means, dtype=float)), 0., None)
+    if chunk is None:
+        #The drawn counts and their squares dominate the memory of a chunk
+        chunk = max(1, int(memory // (2 * 8 * means.size)))
+    counts = [min(chunk, n - start) for start in range(0, n, chunk)]
+    offsets = np.cumsum([0] + counts)
+    seeds = np.random.SeedSequence(seed).spawn(len(counts))
+
+    total = np.zeros(means.shape)
+    total_sq = np.zeros(means.shape)
+    totals = np.empty((n, means.shape[1]), dtype=np.int64)
+    peaks = np.empty(n, dtype=np.int64)
+    dumpfile = None
+    if dump:
+        dumpfile = open_memmap(dump, mode='w+', dtype=np.int32, shape=(n, means.shape[0], means.shape[1]))
+
+    def collect(start, future):
+        chunk_sum, chunk_sq, chunk_totals, chunk_peaks, per_time = future.result()
+        total[...] += chunk_sum
+        total_sq[...] += chunk_sq
+        totals[start:start + len(chunk_peaks)] = chunk_totals
+        peaks[start:start + len(chunk_peaks)] = chunk_peaks
+        if dumpfile is not None:
+            dumpfile[start:start + len(chunk_peaks)] = per_time
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(means,)) as pool:
+        #At most 2*jobs chunks are in flight, so memory does not grow with n
+        pending = deque()
+        for start, child, count in zip(offsets, seeds, counts):
+            if len(pending) >= 2 * jobs:
+                collect(*pending.popleft())
+            pending.append((start, pool.submit(_draw, child, count, dumpfile is not None)))
+        while pending:
+            collect(*pending.popleft())
+    if dumpfile is not None:
+        dumpfile.flush()
+        del dumpfile
+
+    mean = total / n
+    var = (total_sq - n * mean**2) / max(n - 1, 1)
+    return {"mean": mean, "var": var, "totals": totals, "peaks": peaks, "chunk": chunk}
+
+def print_summary(channels, means, stats, threshold=None):
+    print("{0:<22} {1:>12} {2:>12} {3:>10} {4:>10} {5:>10} {6:>10}".format("channel", "expected", "mean", "std", "5%", "50%", "95%"))
+    rows = [(name, means[:, c].sum(), stats["totals"][:, c]) for c, name in enumerate(channels)]
+    rows.append(("all", means.sum(), stats["totals"].sum(axis=1)))
+    for name, expected, totals in rows:
+        q5, q50, q95 = np.percentile(totals, [5, 50, 95])
+        print("{0:<22} {1:12.6g} {2:12.6g} {3:10.4g} {4:10.6g} {5:10.6g} {6:10.6g}".format(name, expected, totals.mean(), totals.std(ddof=1) if len(totals) > 1 else 0., q5, q50, q95))
+    if means.shape[0] > 1:
+        q5, q50, q95 = np.percentile(stats["peaks"], [5, 50, 95])
+        print("{0:<22} {1:12.6g} {2:12.6g} {3:10.4g} {4:10.6g} {5:10.6g} {6:10.6g}".format("peak time bin", means.sum(axis=(1, 2)).max(),
+              stats["peaks"].mean(), stats["peaks"].std(ddof=1) if len(stats["peaks"]) > 1 else 0., q5, q50, q95))
+    if threshold is not None:
+        print("P(peak time bin >= {0:g} events) = {1:.6g}".format(threshold, np.mean(stats["peaks"] >= threshold)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Draws Poisson realizations of the weighted smeared event counts of a run')
+    parser.add_argument('fluxname', type=str, help='Name of flux, or of a time-dependent run in out/td_fluxes. \n (eg. livermore or chimera)')
+    parser.add_argument('channelname', type=str, help='Name of channel. \n (eg. argon)')
+    parser.add_argument('experimentname', type=str, help='Name of experiment. \n (eg. ar17kt)')
+    parser.add_argument('-n', '--realizations', type=int, default=10000, help='Number of realizations. \n (eg. 1000000)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the SeedSequence the chunks are drawn from')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='Number of processes drawing chunks. \n (eg. 4)')
+    parser.add_argument('--chunk', type=int, default=None, help='Realizations per chunk. \n (default: as many as fit in --memory)')
+    parser.add_argument('--memory', type=float, default=256, help='Memory budget of one chunk in MB')
+    parser.add_argument('--dt', type=float, default=None, help='Time bin width in s for time-dependent runs. \n (default: one bin per timestep)')
+    parser.add_argument('--threshold', type=float, default=None, help='Print the probability that the peak time bin has at least this many events')
+    parser.add_argument('--output', type=str, default=None, help='Save the summary statistics to this .npz file')
+    parser.add_argument('--dump', type=str, default=None, help='Write the per-realization counts per time bin and channel to this .npy file (int32)')
+    args = parser.parse_args()
+
+    if os.path.isdir("out/td_fluxes/" + args.fluxname):
+        times, channels, energies, means = expected_td(args.fluxname, args.channelname, args.experimentname, args.dt)
+    else:
+        times, channels, energies, means = expected_single(args.fluxname, args.channelname, args.experimentname)
+
+    start = time.time()
+    stats = realize(means, args.realizations, args.seed, args.jobs, args.chunk, args.memory * 1e6, args.dump)
+    print("{0} realizations of {1} time bins x {2} channels x {3} energy bins in {4:.1f} s ({5} per chunk, {6} workers)".format(
+        args.realizations, means.shape[0], means.shape[1], means.shape[2], time.time() - start, stats["chunk"], args.jobs))
+    print_summary(channels, means, stats, args.threshold)
+
+    if args.output:
+        #np.savez appends .npz to other names, so the name printed is the file written
+        if not args.output.endswith(".npz"):
+            args.output += ".npz"
+        np.savez(args.output, times=np.array([]) if times is None else times, channels=channels, energies=energies, expected=means,
+                 mean=stats["mean"], var=stats["var"], totals=stats["totals"].astype(np.int32), peaks=stats["peaks"].astype(np.int32),
+                 seed=args.seed, chunk=stats["chunk"])
+        print("Saved " + args.output)
+    if args.dump:
+        print("Saved " + args.dump)
@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+
+#Content-addressed cache of per-channel results for time-dependent runs.
+#The key of a (timestep, channel, config) result is a hash of everything that
+#affects it: the flux file, the channel file entry, the detector configuration
+#row, the cross-section, smearing, efficiency and background files, the
+#glb/*.glb templates and the engine. Entries are saved as soon as a timestep
+#is merged, so the cache doubles as the checkpoint of an interrupted run.
+
+import os
+import json
+import glob
+import hashlib
+import argparse
+import rate_engine
+import preflight
+import table_cache
+
+cache_dir = os.path.join(table_cache.cache_dir, "results")
+
+#Output suffixes cached per channel
+suffixes = ("_unweighted", "_smeared_unweighted", "", "_smeared")
+
+#Code each engine computes the rates with
+engine_files = {"globes": ("bin/supernova",), "numpy": ("rate_engine.py", "smearing.py", "table_cache.py"), "worker": ("bin/supernova",)}
+
+_digests = {}
+
+#Content hash of a file, remembered per (path, mtime, size)
+def file_digest(filename):
+    if not os.path.exists(filename):
+        return "missing"
+    st = os.stat(filename)
+    memo = (os.path.realpath(filename), st.st_mtime_ns, st.st_size)
+    if memo not in _digests:
+        with open(filename, 'rb') as INFILE:
+            _digests[memo] = hashlib.sha256(INFILE.read()).hexdigest()
+    return _digests[memo]
+
+def _key(*parts):
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+#{chan_name: key} for one timestep. variant covers run options that change the output (e.g. weighting).
+def result_keys(fluxfile, chanfilename, expt_config, engine, variant=""):
+    common = [file_digest("fluxes/" + fluxfile + ".dat"),
+              preflight.registry().configs.get(expt_config),
+              [file_digest(filename) for filename in sorted(glob.glob("glb/*.glb")) if not filename.endswith("detector.glb")],
+              engine, [file_digest(filename) for filename in engine_files.get(engine, ())], file_digest("supernova.py"), variant]
+    keys = {}
+    for chan_name, index, cpstate, inflav, factor in preflight.registry().require_channels(chanfilename):
+        keys[chan_name] = _key(common, [chan_name, index, cpstate, inflav, factor],
+                               file_digest("xscns/xs_" + chan_name + ".dat"),
+                               file_digest("smear/smear_" + chan_name + "_" + expt_config + ".dat"),
+                               file_digest("effic/effic_" + chan_name + "_" + expt_config + ".dat"))
+    bg_file = "backgrounds/" + rate_engine.bg_chan_name + "_" + expt_config + ".dat"
+    if os.path.exists(bg_file):
+        keys[rate_engine.bg_chan_name] = _key(common, rate_engine.bg_chan_name, file_digest(bg_file),
+                                              file_digest("xscns/xs_zero.dat"),
+                                              file_digest("smear/smear_" + rate_engine.bg_chan_name + "_" + expt_config + ".dat"))
+    return keys
+
+def entry_path(key):
+    return os.path.join(cache_dir, key[:2], key + ".json")
+
+#Cached {chan_name: {suffix: text}} for every key, or None if any channel is missing
+def lookup(keys):
+    entries = {}
+    for chan_name, key in keys.items():
+        path = entry_path(key)
+        if not os.path.exists(path):
+            return None
+        with open(path) as ENTRY:
+            entries[chan_name] = json.load(ENTRY)
+        #Mark as recently used for the eviction
+        os.utime(path)
+    return entries
+
+def output_name(outdir, fluxfile, chan_name, expt_config, suffix):
+    return outdir + "/" + fluxfile + "_" + chan_name + "_" + expt_config + "_events" + suffix + ".dat"
+
+#Save the output files of one timestep found in outdir
+def save(keys, outdir, fluxfile, expt_config):
+    texts = {}
+    for chan_name in keys:
+        for suffix in suffixes:
+            filename = output_name(outdir, fluxfile, chan_name, expt_config, suffix)
+            if os.path.exists(filename):
+                with open(filename) as OUTFILE:
+                    texts[filename] = OUTFILE.read()
+    save_texts(keys, texts, outdir, fluxfile, expt_config)
+
+#Save one timestep from the texts of its output files, {output file name under outdir: text}
+def save_texts(keys, texts, outdir, fluxfile, expt_config):
+    for chan_name, key in keys.items():
+        entry = {}
+        for suffix in suffixes:
+            filename = output_name(outdir, fluxfile, chan_name, expt_config, suffix)
+            if filename in texts:
+                entry[suffix] = texts[filename]
+        path = entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".%d.tmp" % os.getpid()
+        with open(tmp, 'w') as ENTRY:
+            json.dump(entry, ENTRY)
+        os.replace(tmp, path)
+
+#Cached results as {output file name under outdir: text}
+def entry_texts(entries, outdir, fluxfile, expt_config):
+    return {output_name(outdir, fluxfile, chan_name, expt_config, suffix): text
+            for chan_name, entry in entries.items() for suffix, text in entry.items()}
+
+#Write cached results back out as the timestep's output files
+def restore(entries, outdir, fluxfile, expt_config):
+    os.makedirs(os.path.dirname(os.path.join(outdir, fluxfile)), exist_ok=True)
+    for filename, text in entry_texts(entries, outdir, fluxfile, expt_config).items():
+        with open(filename, 'w') as OUTFILE:
+            OUTFILE.write(text)
+
+#Remove the least recently used entries until the cache is below max_bytes
+def evict(max_bytes):
+    entries = []
+    for path in glob.glob(os.path.join(cache_dir, "*", "*.json")):
+        st = os.stat(path)
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(entry[1] for entry in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+    return total
+
+#The cache as seen by one run (channel file, detector configuration, engine and output options)
+class ResultCache:
+    def __init__(self, chanfilename, expt_config, engine, variant="", max_bytes=None):
+        self.chanfilename = chanfilename
+        self.expt_config = expt_config
+        self.engine = engine
+        self.variant = variant
+        self.max_bytes = max_bytes
+
+    #Returns (keys, entries); entries is None unless every channel of the timestep is cached
+    def lookup(self, fluxfile):
+        keys = result_keys(fluxfile, self.chanfilename, self.expt_config, self.engine, self.variant)
+        return keys, lookup(keys)
+
+    def save(self, keys, outdir, fluxfile):
+        save(keys, outdir, fluxfile, self.expt_config)
+
+    def save_texts(self, keys, texts, outdir, fluxfile):
+        save_texts(keys, texts, outdir, fluxfile, self.expt_config)
+
+    def restore(self, entries, outdir, fluxfile):
+        restore(entries, outdir, fluxfile, self.expt_config)
+
+    def texts(self, entries, outdir, fluxfile):
+        return entry_texts(entries, outdir, fluxfile, self.expt_config)
+
+    def evict(self):
+        if self.max_bytes is not None:
+            evict(self.max_bytes)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Manages the time-dependent result cache')
+    parser.add_argument('--clear', action='store_true', help='Remove every cached result')
+    parser.add_argument('--max-size', type=float, default=None, help='Evict least recently used results down to this size in MB')
+    args = parser.parse_args()
+
+    if args.clear:
+        evict(0)
+    elif args.max_size is not None:
+        evict(args.max_size * 1e6)
+    paths = glob.glob(os.path.join(cache_dir, "*", "*.json"))
+    print("{0}: {1} results, {2:.1f} MB".format(cache_dir, len(paths), sum(os.path.getsize(p) for p in paths) / 1e6))
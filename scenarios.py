@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+
+#Linear-response scenario engine.
+#The event rates are linear in the six flux columns (nue, numu, nutau, nuebar, numubar,
+#nutaubar), and each channel sees only the column of its (cpstate, inflav). So the
+#rates of every channel are computed once per flux for each of the six columns taken
+#as the channel's flavor; an oscillation scenario (a 6x6 matrix M, flux'_i = sum_j M_ij flux_j,
+#the same at all energies) and a distance d then only take a batched linear combination:
+#   rates'_c = (10 kpc / d)^2 * sum_j M[column_c, j] * rates_c(flux_j)
+#The fluxes (e.g. interpolate.py output) are taken to be at 10 kpc. The background channel
+#does not depend on the flux or the distance and is added unscaled.
+#Totals only need the flavor rates summed over time and energy; the full
+#(scenario x distance x time x channel x bin) spectra are streamed to --output one
+#(scenario, distance) at a time and never held in memory.
+
+import os
+import json
+import zipfile
+import argparse
+import numpy as np
+from numpy.lib import format as npformat
+import rate_engine
+import smearing
+import table_cache
+import preflight
+
+flavors = ("nue", "numu", "nutau", "nuebar", "numubar", "nutaubar")
+
+#Distance the flux files are normalized to, in kpc
+reference_distance = 10.
+
+sin2_theta12 = 0.307
+
+#Adiabatic MSW conversion in the supernova envelope, with numu and nutau taken as one heavy flavor x:
+#normal ordering: nue = x0, nuebar = cos^2(theta12) nuebar0 + sin^2(theta12) xbar0
+#inverted:        nue = sin^2(theta12) nue0 + cos^2(theta12) x0, nuebar = xbar0
+#and the heavy flavors take the rest, so the total flux of each cpstate is unchanged.
+def msw_matrix(ordering, sin2_12=sin2_theta12):
+    if ordering == "normal":
+        p, pbar = 0., 1. - sin2_12
+    else:
+        p, pbar = sin2_12, 0.
+    matrix = np.zeros((6, 6))
+    for offset, survival in ((0, p), (3, pbar)):
+        e, m, t = offset, offset + 1, offset + 2
+        matrix[e, e] = survival
+        matrix[e, m] = matrix[e, t] = (1. - survival) / 2.
+        for x in (m, t):
+            matrix[x, e] = (1. - survival) / 2.
+            matrix[x, m] = matrix[x, t] = (1. + survival) / 4.
+    return matrix
+
+presets = {"none": np.eye(6), "msw_normal": msw_matrix("normal"), "msw_inverted": msw_matrix("inverted")}
+
+#Scenarios from preset names or a JSON file of {name: 6x6 matrix}
+def read_scenarios(names):
+    scenarios = {}
+    for name in names:
+        if name in presets:
+            scenarios[name] = presets[name]
+            continue
+        with open(name) as SCENFILE:
+            for scenario, matrix in json.load(SCENFILE).items():
+                matrix = np.array(matrix, dtype=float)
+                if matrix.shape != (6, 6):
+                    raise ValueError("Scenario {0} in {1}: expected a 6x6 matrix, got {2}".format(scenario, name, matrix.shape))
+                scenarios[scenario] = matrix
+    return scenarios
+
+#Flux names of a single flux (fluxes/<name>.dat) or a time-dependent series (every .dat in fluxes/<name>/)
+def flux_names(fluxname):
+    if os.path.isdir("fluxes/" + fluxname):
+        return sorted(fluxname + "/" + os.path.splitext(filename)[0] for filename in os.listdir("fluxes/" + fluxname) if filename.endswith(".dat"))
+    return [fluxname]
+
+#Per-flavor response of the channels of one (channel file, detector configuration)
+class Response:
+    def __init__(self, chanfilename, expt_config, settings=None):
+        self.settings = settings or rate_engine.read_glb_settings()
+        self.channels = preflight.registry().require_channels(chanfilename)
+        target_mass = float(preflight.registry().target_mass(expt_config))
+        nsamp = int(self.settings["sampling_points"])
+        nbins = int(self.settings["bins"])
+        self.samp_energies = rate_engine.bin_centers(nsamp, self.settings["sampling_min"], self.settings["sampling_max"])
+        self.energies = rate_engine.bin_centers(nbins, self.settings["emin"], self.settings["emax"])
+
+        #Everything of presmear_rates but the flux: rate = weight * flux at the sampling points
+        unit_flux = np.column_stack([self.samp_energies] + [np.ones(nsamp)] * 6)
+        self.weights = []
+        self.matrices = []
+        self.effics = []
+        self.columns = []
+        for chan_name, index, cpstate, inflav, factor in self.channels:
+            xsec = table_cache.load("xscns/xs_" + chan_name + ".dat", rate_engine.read_xsec)
+            self.weights.append(rate_engine.presmear_rates(unit_flux, xsec, cpstate, inflav, target_mass, self.settings))
+            self.matrices.append(smearing.load("smear/smear_" + chan_name + "_" + expt_config + ".dat", nbins, nsamp))
+            self.effics.append(table_cache.load("effic/effic_" + chan_name + "_" + expt_config + ".dat", rate_engine.read_list))
+            self.columns.append(rate_engine.flavor_columns[(cpstate, inflav)] - 1)
+        self.factors = np.array([channel[4] for channel in self.channels])
+
+        self.background = None
+        bg_file = "backgrounds/" + rate_engine.bg_chan_name + "_" + expt_config + ".dat"
+        if os.path.exists(bg_file):
+            pre = rate_engine.read_list(bg_file)
+            matrix = smearing.load("smear/smear_" + rate_engine.bg_chan_name + "_" + expt_config + ".dat", nbins, nsamp)
+            self.background = (pre, rate_engine.smear_rates(pre, matrix))
+
+    #Rates of every channel for every flux column: (time x channel x flavor x sampling point) unsmeared
+    #and (time x channel x flavor x bin) smeared, from a list of flux tables as read by read_flux
+    def flavor_rates(self, fluxes):
+        phi = np.array([[np.interp(self.samp_energies, flux[:, 0], flux[:, j + 1], left=0., right=0.) for j in range(6)] for flux in fluxes])
+        pre = phi[:, None, :, :] * np.array(self.weights)[None, :, None, :]
+        post = np.stack([self.matrices[c].smear(pre[:, c]) * self.effics[c] for c in range(len(self.channels))], axis=1)
+        return pre, post
+
+    #Row of each scenario matrix that feeds each channel, (scenario x channel x flavor), with the
+    #channel weighting factors when weight is set. matrices is (scenario x 6 x 6).
+    def _rows(self, matrices, weight):
+        rows = np.asarray(matrices)[:, self.columns, :]
+        if weight:
+            rows = rows * self.factors[None, :, None]
+        return rows
+
+    #Events summed over time, channels and energy: (scenario x distance). distances in kpc.
+    def totals(self, rates, matrices, distances, weight=False):
+        scale = (reference_distance / np.asarray(distances, dtype=float))**2
+        summed = rates.sum(axis=(0, 3))
+        return np.einsum('scj,cj->s', self._rows(matrices, weight), summed)[:, None] * scale[None, :]
+
+    #(time x channel x bin) spectra of one scenario and distance at a time, scenario-major
+    def spectra(self, rates, matrices, distances, weight=False):
+        rows = self._rows(matrices, weight)
+        for s in range(len(rows)):
+            combined = np.einsum('cj,tcjb->tcb', rows[s], rates)
+            for distance in distances:
+                yield (reference_distance / distance)**2 * combined
+
+#Write a .npy member of shape (batches x batch shape) to an open .npz (zip) file, one batch at a time
+def write_member(NPZFILE, name, shape, batches):
+    with NPZFILE.open(name + ".npy", 'w', force_zip64=True) as MEMBER:
+        npformat.write_array_header_2_0(MEMBER, {"descr": npformat.dtype_to_descr(np.dtype(float)), "fortran_order": False, "shape": shape})
+        for batch in batches:
+            MEMBER.write(np.ascontiguousarray(batch, dtype=float).tobytes())
+
+#Run every scenario and distance on a flux or flux series. Returns the response, the scenario names,
+#the unsmeared and smeared (scenario x distance) totals and the flux names. With output, the
+#(scenario x distance x time x channel x bin) spectra are also streamed to that .npz file.
+def run(fluxname, chanfilename, expt_config, scenarios, distances, weight=False, output=None):
+    response = Response(chanfilename, expt_config)
+    names = flux_names(fluxname)
+    pre, post = response.flavor_rates([rate_engine.read_flux("fluxes/" + name + ".dat") for name in names])
+    matrices = np.array(list(scenarios.values()))
+    if output:
+        arrays = {"scenarios": list(scenarios), "distances": distances, "fluxes": names, "channels": [channel[0] for channel in response.channels],
+                  "samp_energies": response.samp_energies, "energies": response.energies}
+        with zipfile.ZipFile(output, 'w', allowZip64=True) as NPZFILE:
+            for name, value in arrays.items():
+                with NPZFILE.open(name + ".npy", 'w', force_zip64=True) as MEMBER:
+                    npformat.write_array(MEMBER, np.asanyarray(value))
+            for name, rates in (("unsmeared", pre), ("smeared", post)):
+                shape = (len(matrices), len(distances), rates.shape[0], rates.shape[1], rates.shape[3])
+                write_member(NPZFILE, name, shape, response.spectra(rates, matrices, distances, weight))
+    return (response, list(scenarios), response.totals(pre, matrices, distances, weight),
+            response.totals(post, matrices, distances, weight), names)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Evaluates flavor-transformation scenarios and distances from one set of per-flavor rates')
+    parser.add_argument('fluxname', type=str, help='Name of flux, or of a directory of time-dependent fluxes. \n (eg. livermore or td_fluxes/chimera)')
+    parser.add_argument('channelname', type=str, help='Name of channel. \n (eg. argon)')
+    parser.add_argument('experimentname', type=str, help='Name of experiment. \n (eg. ar17kt)')
+    parser.add_argument('--scenario', type=str, nargs='+', default=list(presets), help='Preset names ({0}) or JSON files of {{name: 6x6 matrix}}. \n (eg. none msw_normal my_scenarios.json)'.format(", ".join(presets)))
+    parser.add_argument('--distance', type=float, nargs='+', default=[reference_distance], help='Distances in kpc. \n (eg. 1 10 50)')
+    parser.add_argument('--weight', action='store_true', help='Apply the channel weighting factors')
+    parser.add_argument('--output', type=str, default=None, help='Save the spectra of every scenario, distance, timestep and channel to this .npz file')
+    args = parser.parse_args()
+
+    chanfilename = "channels/channels_" + args.channelname + ".dat"
+    response, names, pre, post, fluxes = run(args.fluxname, chanfilename, args.experimentname, read_scenarios(args.scenario), args.distance, args.weight, args.output)
+
+    background = "-"
+    if response.background is not None:
+        background = "%.6g" % (len(fluxes) * response.background[1].sum())
+    print("{0} fluxes, {1} channels, {2} scenarios x {3} distances ({4})".format(len(fluxes), len(response.channels), len(names), len(args.distance), "weighted" if args.weight else "unweighted"))
+    print("{0:<20} {1:>10} {2:>14} {3:>14} {4:>12}".format("scenario", "kpc", "unsmeared", "smeared", "background"))
+    for s, name in enumerate(names):
+        for d, distance in enumerate(args.distance):
+            print("{0:<20} {1:10.4g} {2:14.6g} {3:14.6g} {4:>12}".format(name, distance, pre[s, d], post[s, d], background))
+
+    if args.output:
+        print("Saved " + args.output)
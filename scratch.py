@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+
+#Private working directories for runs that must not share files with other runs:
+#td_supernova.py timesteps, GLoBES worker runs and shard roots. The entries of the
+#repository root are symlinked in, except out/, supernova.glb and shards/, which every
+#directory gets for itself. Directories listed in linked_dirs are made private too,
+#with their entries symlinked, so files can be added to them without touching the repository.
+
+import os
+import shutil
+import tempfile
+
+root = os.path.dirname(os.path.realpath(__file__))
+
+private_entries = ("out", "supernova.glb", "shards")
+
+#Link the repository into path (created if needed); entries already there are kept, so a directory can be reused
+def populate(path, linked_dirs=()):
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(root):
+        target = os.path.join(path, name)
+        if name in private_entries or os.path.lexists(target):
+            continue
+        if name in linked_dirs:
+            os.makedirs(target)
+            for entry in os.listdir(os.path.join(root, name)):
+                os.symlink(os.path.join(root, name, entry), os.path.join(target, entry))
+        else:
+            os.symlink(os.path.join(root, name), target)
+    os.makedirs(os.path.join(path, "out"), exist_ok=True)
+    return path
+
+#New private directory under scratch_root (the system temporary directory by default)
+def make(scratch_root=None, prefix="td_supernova_", linked_dirs=()):
+    return populate(tempfile.mkdtemp(prefix=prefix, dir=scratch_root), linked_dirs)
+
+#Move the files of path/out into outdir, keeping their subdirectories
+def merge_out(path, outdir="out"):
+    staged = os.path.join(path, "out")
+    for dirpath, dirnames, filenames in os.walk(staged):
+        destdir = os.path.join(outdir, os.path.relpath(dirpath, staged))
+        os.makedirs(destdir, exist_ok=True)
+        for filename in filenames:
+            shutil.move(os.path.join(dirpath, filename), os.path.join(destdir, filename))
@@ -0,0 +1,241 @@
+#!/usr/bin/python3
+
+#Sharded execution of time-dependent runs across nodes.
+#td_supernova.py --shard i/N runs a deterministic subset of the timesteps of
+#fluxes/td_fluxes/<flux> (every N-th, starting at the i-th, or the timesteps a plan
+#assigns to shard i) in a shard root: a copy of the repository like the td_supernova.py
+#scratch areas, with its inputs symlinked and its own out/ and supernova.glb, under
+#shards/<flux>_<chan>_<config>/shard_<i>_of_<N>. When the shard finishes it writes
+#shard.json there. python shards.py merge then checks that every timestep was run
+#exactly once, moves the shard outputs into out/, writes the timesteps table and
+#optionally fills the event store and the time-window index in timestep order.
+#python shards.py local runs all shards as separate processes on this machine and merges.
+
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import argparse
+import subprocess
+import pandas as pd
+import preflight
+import event_store
+import time_index
+import scratch
+
+#Parse "i/N" into (i, N)
+def parse_shard(text):
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise ValueError("Shard must be given as i/N, e.g. 0/4, not " + text)
+    if count < 1 or not 0 <= index < count:
+        raise ValueError("Shard {0} out of range: i must be in 0..N-1".format(text))
+    return index, count
+
+#Timesteps of a time-dependent run (fluxes relative to fluxes/, without .dat), as td_supernova.py selects them
+def timestep_fluxfiles(fluxname):
+    files = [os.path.splitext(filename)[0] for filename in os.listdir("./fluxes/td_fluxes/" + fluxname)]
+    files.sort()
+    return ["td_fluxes/" + fluxname + "/" + fluxes for fluxes in files if "00" in fluxes]
+
+#Split the timesteps into count shards, every count-th timestep going to the same shard
+def split(fluxfiles, count):
+    return [fluxfiles[index::count] for index in range(count)]
+
+#Timesteps of shard index out of count, from the plan if one is given
+def select(fluxfiles, index, count, plan=None):
+    if plan is None:
+        return split(fluxfiles, count)[index]
+    if len(plan["shards"]) != count:
+        raise ValueError("The plan has {0} shards, not {1}".format(len(plan["shards"]), count))
+    return plan["shards"][index]
+
+def write_plan(fluxname, channame, expt_config, count, filename):
+    fluxfiles = timestep_fluxfiles(fluxname)
+    plan = {"flux": fluxname, "channels": channame, "config": expt_config, "count": count,
+            "timesteps": fluxfiles, "shards": split(fluxfiles, count)}
+    with open(filename, 'w') as OUTFILE:
+        json.dump(plan, OUTFILE, indent=1)
+    return plan
+
+def read_plan(filename):
+    with open(filename) as PLANFILE:
+        return json.load(PLANFILE)
+
+def run_dir(fluxname, channame, expt_config, shard_dir="shards"):
+    return os.path.join(shard_dir, fluxname + "_" + channame + "_" + expt_config)
+
+def shard_root(fluxname, channame, expt_config, index, count, shard_dir="shards"):
+    return os.path.join(run_dir(fluxname, channame, expt_config, shard_dir), "shard_{0}_of_{1}".format(index, count))
+
+#Create (or reuse, to resume a shard) the shard root: inputs symlinked, out/ and supernova.glb private (see scratch.py)
+def make_root(path, fluxname):
+    path = scratch.populate(os.path.abspath(path))
+    os.makedirs(os.path.join(path, "out", "td_fluxes", fluxname), exist_ok=True)
+    return path
+
+#Record a finished shard in its root (the current directory of the shard run)
+def write_record(fluxname, channame, expt_config, index, count, fluxfiles):
+    record = {"flux": fluxname, "channels": channame, "config": expt_config, "index": index, "count": count,
+              "timesteps": fluxfiles, "finished": time.strftime("%Y-%m-%d %H:%M:%S")}
+    with open("shard.json", 'w') as OUTFILE:
+        json.dump(record, OUTFILE, indent=1)
+
+#Output files a timestep must have left in outdir: the weighted spectra of every channel
+def expected_outputs(outdir, fluxfile, chanfilename, expt_config):
+    return [outdir + "/" + fluxfile + "_" + channel[0] + "_" + expt_config + "_events" + smeared + ".dat"
+            for channel in preflight.registry().require_channels(chanfilename) for smeared in ("", "_smeared")]
+
+#Check the shards of a run: returns ({timestep: shard root}, problems). Every expected timestep
+#must have been run by exactly one finished shard and have its output files there.
+def check(fluxname, channame, expt_config, shard_dir="shards", plan=None):
+    problems = []
+    directory = run_dir(fluxname, channame, expt_config, shard_dir)
+    roots = sorted(os.path.join(directory, name) for name in os.listdir(directory)) if os.path.isdir(directory) else []
+    if not roots:
+        return {}, ["No shards in " + directory]
+    expected = plan["timesteps"] if plan is not None else timestep_fluxfiles(fluxname)
+
+    owners = {}
+    counts = set()
+    finished = set()
+    for path in roots:
+        if not os.path.exists(os.path.join(path, "shard.json")):
+            problems.append(path + " did not finish (no shard.json)")
+            continue
+        with open(os.path.join(path, "shard.json")) as RECORD:
+            record = json.load(RECORD)
+        counts.add(record["count"])
+        finished.add(record["index"])
+        for fluxfile in record["timesteps"]:
+            owners.setdefault(fluxfile, []).append(path)
+    if len(counts) > 1:
+        problems.append("Shards of different splits: N = " + ", ".join(str(count) for count in sorted(counts)))
+    elif counts:
+        count = counts.pop()
+        missing_shards = sorted(set(range(count)) - finished)
+        if missing_shards:
+            problems.append("Shards not finished: " + ", ".join("{0}/{1}".format(index, count) for index in missing_shards))
+
+    chanfilename = "channels/channels_" + channame + ".dat"
+    for fluxfile in expected:
+        paths = owners.get(fluxfile, [])
+        if not paths:
+            problems.append("Timestep " + fluxfile + " is in no shard")
+        elif len(paths) > 1:
+            problems.append("Timestep " + fluxfile + " is in {0} shards: {1}".format(len(paths), ", ".join(paths)))
+        else:
+            for filename in expected_outputs(os.path.join(paths[0], "out"), fluxfile, chanfilename, expt_config):
+                if not os.path.exists(filename):
+                    problems.append("Timestep " + fluxfile + ": " + filename + " not found")
+                    break
+    for fluxfile in sorted(set(owners) - set(expected)):
+        problems.append("Timestep " + fluxfile + " was run but is not part of the run")
+    return {fluxfile: paths[0] for fluxfile, paths in owners.items() if len(paths) == 1}, problems
+
+#Timesteps table of a merged run: timestep, post-bounce time (when the timesteps file matches) and shard
+def write_table(fluxname, channame, expt_config, owners, outdir="out"):
+    fluxfiles = sorted(owners)
+    times = {}
+    try:
+        names, pb_times = time_index.read_timesteps(fluxname)
+        times = dict(zip(names, pb_times))
+    except (OSError, ValueError):
+        pass
+    d = {"Timestep": [os.path.basename(fluxfile) for fluxfile in fluxfiles],
+         "Post Bounce Time (s)": [times.get(os.path.basename(fluxfile), float("nan")) for fluxfile in fluxfiles],
+         "Shard": [os.path.basename(owners[fluxfile]) for fluxfile in fluxfiles]}
+    df = pd.DataFrame(data=d, columns = ["Timestep", "Post Bounce Time (s)", "Shard"])
+    filename = outdir + "/td_fluxes/" + fluxname + "/" + fluxname + "_" + channame + "_" + expt_config + "_timesteps.dat"
+    with open(filename, 'w') as fo:
+        print(df.to_string(index=False), file=fo)
+    return filename
+
+#Check the shards and merge them into outdir. With output "store" or "both" every timestep is
+#added to the event store in timestep order, replacing the rows of earlier runs, straight from its
+#shard (and its .dat files dropped there for "store"); the remaining shard output is then moved into
+#outdir. With index the time-window index is updated. Returns the problems found; nothing is merged
+#if there are any.
+def merge(fluxname, channame, expt_config, shard_dir="shards", plan=None, output="dat", index=False, keep_shards=False, outdir="out"):
+    owners, problems = check(fluxname, channame, expt_config, shard_dir, plan)
+    if problems:
+        return problems
+    if output != "dat":
+        store = event_store.store_path(fluxname, channame, expt_config, outdir)
+        if not os.path.exists(store):
+            event_store.create(store, "channels/channels_" + channame + ".dat", expt_config)
+        for fluxfile in sorted(owners):
+            event_store.ingest(store, os.path.join(owners[fluxfile], "out"), fluxfile, expt_config, remove = output == "store")
+    for path in sorted(set(owners.values())):
+        scratch.merge_out(path, outdir)
+    table = write_table(fluxname, channame, expt_config, owners, outdir)
+    print("Merged {0} timesteps from {1} shards; timesteps table in {2}".format(len(owners), len(set(owners.values())), table))
+
+    if index:
+        print("Added or rebuilt {0} timesteps in the time-window index".format(time_index.update(fluxname, channame, expt_config, outdir)))
+    if not keep_shards:
+        shutil.rmtree(run_dir(fluxname, channame, expt_config, shard_dir))
+    return []
+
+#Run all count shards as separate td_supernova.py processes on this machine, then merge them
+def run_local(fluxname, channame, expt_config, count, td_args, shard_dir="shards"):
+    processes = []
+    for index in range(count):
+        cmd = [sys.executable, "td_supernova.py", channame, expt_config, fluxname, "-", "--shard", "{0}/{1}".format(index, count),
+               "--shard-dir", shard_dir] + td_args
+        log = open(os.path.join(shard_dir, "{0}_{1}_{2}_shard_{3}.log".format(fluxname, channame, expt_config, index)), 'w')
+        processes.append((subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT), log))
+    failed = []
+    for index, (process, log) in enumerate(processes):
+        if process.wait() != 0:
+            failed.append("Shard {0}/{1} exited with status {2} (see {3})".format(index, count, process.returncode, log.name))
+        log.close()
+    return failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Plans, runs locally and merges the shards of a sharded td_supernova.py run')
+    parser.add_argument('command', type=str, choices=['plan', 'merge', 'local'], help='plan = write the timesteps of each shard to --plan, merge = check and merge finished shards, local = run every shard here as its own process, then merge')
+    parser.add_argument('channelname', type=str, help='Name of channel. \n (eg. argon)')
+    parser.add_argument('experimentname', type=str, help='Name of experiment. \n (eg. ar17kt)')
+    parser.add_argument('fluxname', type=str, help='Name of flux. \n (eg. chimera)')
+    parser.add_argument('--shards', type=int, default=None, help='Number of shards for plan and local. \n (eg. 4)')
+    parser.add_argument('--plan', type=str, default=None, help='Shard plan file written by plan and read by merge (and td_supernova.py --shard-plan). \n (eg. plan.json)')
+    parser.add_argument('--shard-dir', type=str, default="shards", help='Directory holding the shard roots. \n (must be shared by all nodes)')
+    parser.add_argument('--output', type=str, choices=['dat', 'store', 'both'], default='dat', help='Output backend of the merged run')
+    parser.add_argument('--index', action='store_true', help='Update the time-window index after merging')
+    parser.add_argument('--keep-shards', action='store_true', help='Do not remove the shard roots after merging')
+    parser.add_argument('--td-args', type=str, default="", help='With local, further td_supernova.py arguments for every shard. \n (eg. "--engine numpy --jobs 2")')
+    args = parser.parse_args()
+
+    td_args = shlex.split(args.td_args)
+    if args.command in ("plan", "local") and not args.shards:
+        parser.error(args.command + " needs --shards")
+
+    if args.command == "plan":
+        if not args.plan:
+            parser.error("plan needs --plan")
+        plan = write_plan(args.fluxname, args.channelname, args.experimentname, args.shards, args.plan)
+        print("Split {0} timesteps into {1} shards; saved {2}".format(len(plan["timesteps"]), args.shards, args.plan))
+        sys.exit(0)
+
+    plan = read_plan(args.plan) if args.plan else None
+    if args.command == "local":
+        os.makedirs(args.shard_dir, exist_ok=True)
+        if args.plan:
+            td_args = td_args + ["--shard-plan", args.plan]
+        start = time.time()
+        failed = run_local(args.fluxname, args.channelname, args.experimentname, args.shards, td_args, args.shard_dir)
+        for line in failed:
+            print(line)
+        if failed:
+            sys.exit(1)
+        print("Ran {0} shards in {1:.1f} s".format(args.shards, time.time() - start))
+
+    problems = merge(args.fluxname, args.channelname, args.experimentname, args.shard_dir, plan, args.output, args.index, args.keep_shards)
+    for problem in problems:
+        print(problem)
+    if problems:
+        sys.exit("Merge failed with {0} problems; nothing was merged".format(len(problems)))
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+
+#Sparse (CSR) smearing matrices.
+#Each smear/smear_<chan>_<config>.dat row is {start,end,values...}; only the
+#part of that window between the first and last non-zero value is kept, so a
+#row is one contiguous band of columns. The matrices are cached as
+#(row, column, value) triplets through table_cache. Batched smearing uses the
+#sparse product for sparse matrices and BLAS for the nearly dense ones.
+
+import re
+import glob
+import argparse
+import numpy as np
+import scipy.sparse
+import table_cache
+
+#Above this fraction of non-zeros a dense BLAS product beats the sparse one at these sizes
+dense_threshold = 0.05
+
+class SmearMatrix:
+    def __init__(self, indptr, indices, data, shape):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.shape = shape
+        self.csr = scipy.sparse.csr_matrix((data, indices, indptr), shape=shape)
+        self._dense = None
+
+    @classmethod
+    def from_triplets(cls, triplets, shape):
+        rows = triplets[0].astype(int)
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=shape[0]))])
+        return cls(indptr, triplets[1].astype(int), np.array(triplets[2]), shape)
+
+    @classmethod
+    def from_dense(cls, matrix):
+        rows, cols = np.nonzero(matrix)
+        return cls.from_triplets(np.array([rows, cols, matrix[rows, cols]]), matrix.shape)
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    @property
+    def density(self):
+        return self.nnz / float(self.shape[0] * self.shape[1])
+
+    def todense(self):
+        return self.csr.toarray()
+
+    #Matrix-vector product for one spectrum of sampling-point rates
+    def dot(self, x):
+        return self.csr.dot(np.asarray(x))
+
+    #Smear many spectra at once: (..., sampling points) -> (..., bins)
+    def smear(self, spectra):
+        spectra = np.asarray(spectra)
+        flat = spectra.reshape(-1, self.shape[1])
+        if self.density > dense_threshold:
+            if self._dense is None:
+                self._dense = self.todense()
+            out = flat.dot(self._dense.T)
+        else:
+            out = np.asarray(self.csr.dot(flat.T)).T
+        return out.reshape(spectra.shape[:-1] + (self.shape[0],))
+
+#Parse a smearing file straight into (row, column, value) triplets, without a dense matrix
+def read_smear_triplets(filename, nbins=200, nsamp=200):
+    with open(filename) as SMEARFILE:
+        contents = SMEARFILE.read()
+    rows = []
+    cols = []
+    values = []
+    for i, row in enumerate(re.findall(r"\{([^}]*)\}", contents)[:nbins]):
+        stuff = np.array(row.split(","), dtype=float)
+        start = int(stuff[0])
+        end = min(int(stuff[1]), nsamp - 1)
+        window = stuff[2:end - start + 3]
+        nonzero = np.nonzero(window)[0]
+        if len(nonzero) == 0:
+            continue
+        #Keep the band from the first to the last non-zero value
+        band = np.arange(nonzero[0], nonzero[-1] + 1)
+        rows.append(np.full(len(band), i))
+        cols.append(start + band)
+        values.append(window[band])
+    if not rows:
+        return np.zeros((3, 0))
+    return np.array([np.concatenate(rows), np.concatenate(cols), np.concatenate(values)])
+
+#Load a smearing matrix in CSR form through the compiled-table cache
+def load(filename, nbins=200, nsamp=200):
+    triplets = table_cache.load(filename, read_smear_triplets, nbins, nsamp)
+    return SmearMatrix.from_triplets(triplets, (nbins, nsamp))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Lists the sparse smearing matrices and their fill. \n (the check against the dense reading is tests/test_smearing.py)')
+    args = parser.parse_args()
+
+    for filename in sorted(glob.glob("smear/smear_*.dat")):
+        sparse = load(filename)
+        print("{0:<48} nnz {1:6d} ({2:.1%})".format(filename, sparse.nnz, sparse.density))
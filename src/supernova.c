@@ -30,6 +30,8 @@
 #include <math.h>
 #include <string.h>
 #include <sys/stat.h>
+#include <time.h>
+#include <unistd.h>
 
 #include <globes/globes.h>   /* GLoBES library */
 #include "myio.h"             /* my input-output routines */
@@ -51,11 +53,264 @@ char bgfile[256];
 
 struct stat buf;
 
+/* ------------------------------------------------------------------ */
+/* Profiling: if SNOWGLOBES_PROFILE names a file (supernova.py and     */
+/* td_supernova.py --profile set it), one JSON line per stage is       */
+/* appended to it, in the same format as profiling.py.  Bytes come     */
+/* from /proc/self/io; only the output files written here are counted. */
+/* ------------------------------------------------------------------ */
+
+static double prof_wall, prof_cpu;
+static long prof_rchar, prof_wchar;
+static int prof_files;
+
+static double wall_seconds(int clock_id)
+{
+  struct timespec ts;
+  clock_gettime(clock_id,&ts);
+  return ts.tv_sec + 1e-9*ts.tv_nsec;
+}
+
+static void io_counters(long *rchar, long *wchar)
+{
+  char key[64];
+  long value;
+  FILE *fp = fopen("/proc/self/io","r");
+  *rchar = *wchar = -1;
+  if (fp == NULL) return;
+  while (fscanf(fp,"%63s %ld",key,&value) == 2) {
+    if (strcmp(key,"rchar:") == 0) *rchar = value;
+    if (strcmp(key,"wchar:") == 0) *wchar = value;
+  }
+  fclose(fp);
+}
+
+static void profile_start(void)
+{
+  prof_wall = wall_seconds(CLOCK_MONOTONIC);
+  prof_cpu = (double)clock()/CLOCKS_PER_SEC;
+  io_counters(&prof_rchar,&prof_wchar);
+  prof_files = 0;
+}
+
+/* Append the record of the stage since the last profile_start, and start the next one */
+static void profile_stage(const char *stage, const char *flux)
+{
+  const char *path = getenv("SNOWGLOBES_PROFILE");
+  long rchar, wchar;
+  FILE *fp;
+  if (path == NULL || path[0] == 0) return;
+  io_counters(&rchar,&wchar);
+  fp = fopen(path,"a");
+  if (fp == NULL) return;
+  fprintf(fp,"{\"script\": \"bin/supernova\", \"stage\": \"%s\", \"pid\": %d, \"time\": %.6f, "
+	  "\"wall\": %.6f, \"cpu\": %.6f, ",
+	  stage,(int)getpid(),wall_seconds(CLOCK_REALTIME),
+	  wall_seconds(CLOCK_MONOTONIC)-prof_wall,(double)clock()/CLOCKS_PER_SEC-prof_cpu);
+  if (rchar >= 0 && prof_rchar >= 0)
+    fprintf(fp,"\"read_bytes\": %ld, \"write_bytes\": %ld, ",rchar-prof_rchar,wchar-prof_wchar);
+  else
+    fprintf(fp,"\"read_bytes\": null, \"write_bytes\": null, ");
+  fprintf(fp,"\"files_read\": null, \"files_written\": %d, \"flux\": \"%s\"}\n",prof_files,flux);
+  fclose(fp);
+  profile_start();
+}
+
+/* ------------------------------------------------------------------ */
+/* Worker mode: supernova --worker <channels filename> <config name>   */
+/*                                                                     */
+/* The experiment is initialised once from supernova.glb, which must   */
+/* use a flux file that is 1 in every column (supernova.py --glb-only  */
+/* with the worker_unit_flux flux).  Flux names are then read from     */
+/* stdin, one per line.  GLoBES has no call to swap a flux table, so   */
+/* the current flux enters through a registered probability engine:    */
+/* P[i][i] = flux of flavour i, which times the unit flux gives the    */
+/* same rates as the flux file itself.  For every flux the channel     */
+/* rates are streamed to stdout as                                     */
+/*   #FILE out/<flux>_<chan>_<config>_events[_smeared]_unweighted.dat  */
+/*   <glbShowChannelRates output>                                      */
+/* followed by #DONE (or #ERROR <message>).                            */
+/* ------------------------------------------------------------------ */
+
+#define MAX_FLUX_ROWS 2001
+
+static int flux_rows = 0;
+static double flux_table[MAX_FLUX_ROWS][7];
+
+/* Read a 7 column flux file (energy, nue, numu, nutau, nuebar, numubar, nutaubar) */
+static int read_flux_table(const char *filename)
+{
+  FILE *fp = fopen(filename,"r");
+  int rows = 0;
+
+  if (fp == NULL) return -1;
+  while (rows < MAX_FLUX_ROWS &&
+	 fscanf(fp,"%lf %lf %lf %lf %lf %lf %lf",&flux_table[rows][0],&flux_table[rows][1],
+		&flux_table[rows][2],&flux_table[rows][3],&flux_table[rows][4],
+		&flux_table[rows][5],&flux_table[rows][6]) == 7) {
+    rows++;
+  }
+  fclose(fp);
+  flux_rows = rows;
+  return rows > 1 ? 0 : -1;
+}
+
+/* Linear interpolation of one flux column, zero outside the table */
+static double flux_interp(int column, double E)
+{
+  int lo = 0, hi = flux_rows-1, mid;
+
+  if (flux_rows < 2 || E < flux_table[0][0] || E > flux_table[hi][0]) return 0.0;
+  while (hi-lo > 1) {
+    mid = (lo+hi)/2;
+    if (flux_table[mid][0] > E) hi = mid;
+    else lo = mid;
+  }
+  return flux_table[lo][column] + (flux_table[hi][column]-flux_table[lo][column])
+    *(E-flux_table[lo][0])/(flux_table[hi][0]-flux_table[lo][0]);
+}
+
+/* No oscillations; the diagonal carries the current flux of each flavour */
+static int worker_probability_matrix(double P[3][3], int cp_sign, double E,
+				     int psteps, const double *length, const double *density,
+				     double filter_sigma, void *user_data)
+{
+  int i, j;
+  int first_column = (cp_sign > 0) ? 1 : 4;
+
+  for (i=0;i<3;i++)
+    for (j=0;j<3;j++)
+      P[i][j] = 0.0;
+  for (i=0;i<3;i++)
+    P[i][i] = flux_interp(first_column+i,E);
+  return 0;
+}
+
+static int worker_set_oscillation_parameters(glb_params p, void *user_data)
+{
+  return 0;
+}
+
+static int worker_get_oscillation_parameters(glb_params p, void *user_data)
+{
+  int i;
+  for (i=0;i<6;i++)
+    glbSetOscParams(p,0.0,i);
+  return 0;
+}
+
+/* Read the channel names and GLoBES channel numbers from the channel file */
+static int read_channel_file(const char *filename, char chan_name[][256], int *chan_num, int max)
+{
+  FILE* fp_chans = fopen(filename,"r");
+  char chbuf[1000];
+  char cp[16];
+  char flav[16];
+  double num_target_factor;
+  int num_chans = 0;
+
+  if (fp_chans == NULL) return -1;
+  while (num_chans < max && fgets(chbuf,1000,fp_chans) != NULL) {
+    if (sscanf(chbuf,"%255s %i %15s %15s %lf",chan_name[num_chans],&chan_num[num_chans],cp,flav,&num_target_factor) >= 2)
+      num_chans++;
+  }
+  fclose(fp_chans);
+  return num_chans;
+}
+
+static void stream_channel_rates(const char *filename, int channel, int smearing, int effi, int bgi)
+{
+  printf("#FILE %s\n",filename);
+  glbShowChannelRates(stdout,0,channel,smearing,effi,bgi);
+}
+
+static int run_worker(int argc, char *argv[])
+{
+  char name[256][256];
+  int num[256];
+  char line[1024];
+  char fluxpath[1100];
+  char wfile[1400];
+  int num_chans, ichan, do_bg;
+  size_t len;
+
+  if (argc<4) {
+    fprintf(stderr,"Arguments required: --worker channels filename, detector configuration name\n");
+    return 1;
+  }
+
+  num_chans = read_channel_file(argv[2],name,num,maxchans);
+  if (num_chans < 0) {
+    fprintf(stderr,"Cannot open file %s\n",argv[2]);
+    return 1;
+  }
+  fprintf(stderr,"Channels from %s: %i\n",argv[2],num_chans);
+
+  sprintf(bgfile,"backgrounds/bg_chan_%s.dat",argv[3]);
+  do_bg = (stat(bgfile,&buf) == 0);
+
+  glbRegisterProbabilityEngine(6,&worker_probability_matrix,&worker_set_oscillation_parameters,
+			       &worker_get_oscillation_parameters,NULL);
+
+  /* The experiment (smearing, efficiencies, cross sections) is parsed only here */
+  glbInitExperiment("supernova.glb",&glb_experiment_list[0],&glb_num_of_exps);
+  profile_stage("worker_init","");
+
+  glb_params true_values = glbAllocParams();
+  glbDefineParams(true_values,0.,0.,0.,0.,0.,0.);
+  glbSetDensityParams(true_values,1.0,GLB_ALL);
+
+  printf("#READY\n");
+  fflush(stdout);
+
+  while (fgets(line,sizeof(line),stdin) != NULL) {
+    len = strlen(line);
+    while (len > 0 && (line[len-1] == '\n' || line[len-1] == '\r' || line[len-1] == ' ')) line[--len] = 0;
+    if (len == 0) continue;
+
+    sprintf(fluxpath,"fluxes/%s.dat",line);
+    if (read_flux_table(fluxpath) != 0) {
+      printf("#ERROR cannot read flux file %s\n",fluxpath);
+      fflush(stdout);
+      continue;
+    }
+
+    /* The probability engine now returns the new flux, so this recomputes all rates */
+    glbSetOscillationParameters(true_values);
+    glbSetRates();
+
+    for (ichan=0;ichan<num_chans;ichan++) {
+      sprintf(wfile,"out/%s_%s_%s_events_unweighted.dat",line,name[ichan],argv[3]);
+      stream_channel_rates(wfile,num[ichan],GLB_PRE,GLB_WO_EFF,GLB_WO_BG);
+      sprintf(wfile,"out/%s_%s_%s_events_smeared_unweighted.dat",line,name[ichan],argv[3]);
+      stream_channel_rates(wfile,num[ichan],GLB_POST,GLB_W_EFF,GLB_W_BG);
+    }
+    if (do_bg) {
+      sprintf(wfile,"out/%s_bg_chan_%s_events_unweighted.dat",line,argv[3]);
+      stream_channel_rates(wfile,num_chans,GLB_PRE,GLB_WO_EFF,GLB_W_BG);
+      sprintf(wfile,"out/%s_bg_chan_%s_events_smeared_unweighted.dat",line,argv[3]);
+      stream_channel_rates(wfile,num_chans,GLB_POST,GLB_W_EFF,GLB_W_BG);
+    }
+    printf("#DONE\n");
+    fflush(stdout);
+    profile_stage("worker_rates",line);
+  }
+
+  glbFreeParams(true_values);
+  return 0;
+}
+
 int main(int argc, char *argv[])
 { 
+  profile_start();
+
   /* Initialize libglobes */
   glbInit(argv[0]);
 
+  if (argc>1 && strcmp(argv[1],"--worker") == 0) {
+    exit(run_worker(argc,argv));
+  }
+
   if (argc<2) {
     printf("Arguments required: flux filename, channels filename, detector configuration name\n");
     exit(0);
@@ -102,6 +357,7 @@ int main(int argc, char *argv[])
 
   /* Initialize experiment NFstandard.glb */
   glbInitExperiment("supernova.glb",&glb_experiment_list[0],&glb_num_of_exps); 
+  profile_stage("init",flux_file_name);
  
   /* Intitialize output */
   /*  InitOutput(MYFILE,"Format: Log(10,s22th13)   deltacp   chi^2 \n"); */
@@ -135,6 +391,7 @@ int main(int argc, char *argv[])
   /* The simulated data are computed */
   glbSetOscillationParameters(true_values);
   glbSetRates();
+  profile_stage("rates",flux_file_name);
 
 
   int ifile;
@@ -150,6 +407,7 @@ int main(int argc, char *argv[])
     ret = glbShowChannelRates(f_out,0,chan_num[ifile],GLB_PRE,GLB_WO_EFF,GLB_WO_BG);
 
     fclose(f_out);
+    prof_files++;
 
     sprintf(outfile_smeared,"out/%s_%s_%s_events_smeared_unweighted.dat",flux_file_name,chan_name[ifile],expt_config_name);
     printf("%i %s\n",ifile,outfile_smeared);
@@ -160,6 +418,7 @@ int main(int argc, char *argv[])
     ret = glbShowChannelRates(f_out_smeared,0,chan_num[ifile],GLB_POST,GLB_W_EFF,GLB_W_BG);
 
     fclose(f_out_smeared);
+    prof_files++;
 
 
   }
@@ -191,6 +450,7 @@ int main(int argc, char *argv[])
 	ret = glbShowChannelRates(f_out,0,num_chans,GLB_PRE,GLB_WO_EFF,GLB_W_BG);
 
 	fclose(f_out);
+	prof_files++;
 
 	sprintf(outfile_smeared,"out/%s_bg_chan_%s_events_smeared_unweighted.dat",flux_file_name,expt_config_name);
 	printf("%i %s\n",ifile,outfile_smeared);
@@ -202,12 +462,15 @@ int main(int argc, char *argv[])
 	ret = glbShowChannelRates(f_out_smeared,0,num_chans,GLB_POST,GLB_W_EFF,GLB_W_BG);
 
 	fclose(f_out_smeared);
+	prof_files++;
       } else {
       printf("No background file\n");
     }
 
 
   
+  profile_stage("output",flux_file_name);
+
   /* Destroy parameter vector(s) */
   glbFreeParams(true_values);
   glbFreeParams(test_values); 
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+
+#Sweep mode for supernova.py: every valid (flux, channel file, detector configuration)
+#combination in one invocation. Each argument is a comma-separated list of names or
+#glob patterns, e.g. supernova.py --sweep livermore,gvkm '*' 'wc100kt*,ar17kt'.
+#A channel file and configuration are valid together when every channel of the file
+#has its smearing and efficiency files for that configuration.
+
+import io
+import os
+import glob
+import time
+import fnmatch
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+import rate_engine
+import preflight
+import event_store
+import td_supernova
+
+#Expand a comma-separated list of names or globs against the available names, keeping the order given
+def expand(patterns, available):
+    names = []
+    for pattern in patterns.split(","):
+        if glob.has_magic(pattern):
+            matches = sorted(fnmatch.filter(available, pattern))
+        else:
+            matches = [pattern]
+        for name in matches:
+            if name not in names:
+                names.append(name)
+    return names
+
+def available_fluxes():
+    return [os.path.relpath(filename, "fluxes")[:-len(".dat")] for filename in glob.glob("fluxes/*.dat")]
+
+def available_channels():
+    return [os.path.basename(filename)[len("channels_"):-len(".dat")] for filename in glob.glob("channels/channels_*.dat")]
+
+def is_valid(channame, expt_config):
+    for channel in preflight.registry().channels(channame)[0]:
+        if not (os.path.exists("smear/smear_" + channel[0] + "_" + expt_config + ".dat")
+                and os.path.exists("effic/effic_" + channel[0] + "_" + expt_config + ".dat")):
+            return False
+    return True
+
+#[(flux, channel file, config)] for the valid combinations, plus the skipped (channel file, config) pairs
+def combinations(fluxnames, channames, expt_configs):
+    fluxes = expand(fluxnames, available_fluxes())
+    channels = expand(channames, available_channels())
+    reg = preflight.registry()
+    configs = expand(expt_configs, list(reg.configs))
+    for name in fluxes:
+        if not os.path.exists("fluxes/" + name + ".dat"):
+            raise SystemExit("Flux file name fluxes/" + name + ".dat not found")
+    #Malformed or duplicate lines stop the sweep instead of skipping combinations
+    for name in channels:
+        problems = reg.channels(name)[1]
+        if problems:
+            raise SystemExit("\n".join(problems))
+    if reg.config_problems:
+        raise SystemExit("\n".join(reg.config_problems))
+    for name in configs:
+        if name not in reg.configs:
+            raise SystemExit("Detector configuration " + name + " not found in " + reg.detfilename)
+    valid = []
+    skipped = []
+    for channame in channels:
+        for expt_config in configs:
+            if is_valid(channame, expt_config):
+                valid.append((channame, expt_config))
+            else:
+                skipped.append((channame, expt_config))
+    return [(fluxname, channame, expt_config) for fluxname in fluxes for channame, expt_config in valid], skipped
+
+#One combination with the NumPy engine, on a flux table the parent has already read
+def run_numpy(fluxname, flux, channame, expt_config, weight):
+    with contextlib.redirect_stdout(io.StringIO()):
+        rate_engine.run(fluxname, "channels/channels_" + channame + ".dat", expt_config, float(preflight.registry().target_mass(expt_config)), weight = weight, flux = flux)
+    return 0, ""
+
+#Sum of the "Total:" lines of one combination's output in outdir, as (unsmeared, smeared, smeared background).
+#None if an output file is missing, i.e. the run failed.
+def summarize(fluxname, channame, expt_config, weight, outdir="out"):
+    suffix = "" if weight else "_unweighted"
+    totals = [0., 0.]
+    for channel in preflight.registry().require_channels("channels/channels_" + channame + ".dat"):
+        for k, smeared in enumerate(("", "_smeared")):
+            filename = outdir + "/" + fluxname + "_" + channel[0] + "_" + expt_config + "_events" + smeared + suffix + ".dat"
+            if not os.path.exists(filename):
+                return None
+            totals[k] += event_store.read_total(filename)
+    bg_file = outdir + "/" + fluxname + "_" + rate_engine.bg_chan_name + "_" + expt_config + "_events_smeared_unweighted.dat"
+    background = event_store.read_total(bg_file) if os.path.exists(bg_file) else None
+    return totals[0], totals[1], background
+
+def print_summary(rows, weight):
+    print("\nTotal events ({0}):".format("weighted" if weight else "unweighted"))
+    print("{0:<20} {1:<12} {2:<14} {3:>14} {4:>14} {5:>12}".format("flux", "channels", "config", "unsmeared", "smeared", "background"))
+    for fluxname, channame, expt_config, totals in rows:
+        if totals is None:
+            print("{0:<20} {1:<12} {2:<14} {3:>14}".format(fluxname, channame, expt_config, "FAILED"))
+            continue
+        unsmeared, smeared, background = totals
+        print("{0:<20} {1:<12} {2:<14} {3:14.6g} {4:14.6g} {5:>12}".format(
+            fluxname, channame, expt_config, unsmeared, smeared, "-" if background is None else "%.6g" % background))
+
+#Evaluate every valid combination on jobs processes and print the summary table.
+#With the numpy engine each flux file is read once and shared by all its combinations;
+#the globes engine runs supernova.run_flux per combination in its own scratch directory.
+def run_sweep(fluxnames, channames, expt_configs, engine="globes", jobs=1, weight=False, no_unweighted=False, scratch_root=None):
+    combos, skipped = combinations(fluxnames, channames, expt_configs)
+    if skipped:
+        print("Skipping {0} channel/configuration pairs without smearing or efficiency files: {1}".format(
+            len(skipped), ", ".join(channame + "/" + expt_config for channame, expt_config in skipped)))
+    if not combos:
+        raise SystemExit("No valid flux, channel and configuration combinations")
+    if scratch_root is not None:
+        os.makedirs(scratch_root, exist_ok=True)
+
+    start = time.time()
+    rows = []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        pending = []
+        fluxes = {}
+        for fluxname, channame, expt_config in combos:
+            if engine == "numpy":
+                if fluxname not in fluxes:
+                    fluxes[fluxname] = rate_engine.read_flux("fluxes/" + fluxname + ".dat")
+                future = pool.submit(run_numpy, fluxname, fluxes[fluxname], channame, expt_config, weight)
+            else:
+                future = pool.submit(td_supernova.run_timestep, fluxname, channame, expt_config, engine, scratch_root, weight, no_unweighted)
+            pending.append((fluxname, channame, expt_config, future))
+        for fluxname, channame, expt_config, future in pending:
+            if engine == "numpy":
+                returncode, log = future.result()
+                totals = summarize(fluxname, channame, expt_config, weight)
+            else:
+                #Summarize the worker's own output before it is merged, so stale files in out/ are never counted
+                scratch, returncode, log = future.result()
+                totals = summarize(fluxname, channame, expt_config, weight, os.path.join(scratch, "out"))
+                td_supernova.merge_scratch(scratch)
+            if returncode != 0 or totals is None:
+                print(log)
+                print(fluxname + " " + channame + " " + expt_config + " failed")
+                totals = None
+            rows.append((fluxname, channame, expt_config, totals))
+    print_summary(rows, weight)
+    print("Evaluated {0} combinations in {1:.1f} s with {2} workers".format(len(combos), time.time() - start, jobs))
+    return all(row[3] is not None for row in rows)
@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+
+#Compiled cache for the smear/, effic/ and xscns/ text tables.
+#Each table is parsed once and saved as a .npy file under cache/, named after
+#the source path and reader and keyed by a stamp of its mtime and size and by the reader
+#arguments, so editing a table invalidates its entries automatically while the entries of
+#different arguments (e.g. --bins) live side by side. Entries are opened memory-mapped.
+
+import os
+import glob
+import hashlib
+import argparse
+import numpy as np
+
+#Anchored at the repository, so td_supernova.py scratch directories share it
+cache_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "cache")
+
+def _hash(key):
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+#Cache file prefix of a table as parsed by reader, <cache>/<source path>.<reader>.<stamp>.,
+#where the stamp covers the source file only
+def stamp_prefix(filename, reader):
+    realname = os.path.realpath(filename)
+    st = os.stat(realname)
+    base = os.path.normpath(filename).replace(os.sep, "_") + "." + reader.__name__
+    return os.path.join(cache_dir, base + "." + _hash("%s|%d|%d" % (realname, st.st_mtime_ns, st.st_size)) + ".")
+
+#Cache file for a table as parsed by reader(filename, *args): <stamp prefix><args key>.npy
+def cache_path(filename, reader, *args):
+    return stamp_prefix(filename, reader) + _hash(repr(args)) + ".npy"
+
+#Load a table through the cache, parsing it with reader(filename, *args) on a miss
+def load(filename, reader, *args):
+    path = cache_path(filename, reader, *args)
+    if os.path.exists(path):
+        return np.load(path, mmap_mode='r')
+    table = np.asarray(reader(filename, *args), dtype=float)
+    os.makedirs(cache_dir, exist_ok=True)
+    #Drop the entries of older versions of this table before saving the new one; entries of the
+    #current version with other arguments are kept. Concurrent workers miss together after an
+    #edit, so another one may remove the same entry first.
+    prefix = stamp_prefix(filename, reader)
+    for stale in glob.glob(glob.escape(prefix.rsplit(".", 2)[0]) + ".*.npy"):
+        if not stale.startswith(prefix):
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                pass
+    #Write to a private name and rename, so concurrent workers never read a partial file
+    tmp = path + ".%d.tmp" % os.getpid()
+    with open(tmp, 'wb') as TMPFILE:
+        np.save(TMPFILE, table)
+    os.replace(tmp, path)
+    try:
+        return np.load(path, mmap_mode='r')
+    except (FileNotFoundError, ValueError):
+        return table
+
+def clear():
+    for path in glob.glob(os.path.join(cache_dir, "*.npy")):
+        os.remove(path)
+
+#Compile every table in the repository
+def compile_all():
+    import rate_engine
+    import smearing
+    settings = rate_engine.read_glb_settings()
+    nbins = int(settings["bins"])
+    nsamp = int(settings["sampling_points"])
+    count = 0
+    for filename in sorted(glob.glob("smear/smear_*.dat")):
+        load(filename, smearing.read_smear_triplets, nbins, nsamp)
+        count += 1
+    for filename in sorted(glob.glob("effic/effic_*.dat")):
+        load(filename, rate_engine.read_list)
+        count += 1
+    for filename in sorted(glob.glob("xscns/xs_*.dat")):
+        load(filename, rate_engine.read_xsec)
+        count += 1
+    print("Compiled {0} tables into {1}".format(count, cache_dir))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Compiles the smearing, efficiency and cross-section tables into the binary cache')
+    parser.add_argument('--clear', action='store_true', help='Remove all cached tables instead')
+    args = parser.parse_args()
+
+    if args.clear:
+        clear()
+    else:
+        compile_all()
@@ -1,52 +1,400 @@
 #/usr/bin/python3
 
-import subprocess
 import sys
 import os
-import linecache as lc
-import pandas as pd
+import time
+import shutil
 import argparse
-import numpy as np
+import event_store
+import globes_worker
+import result_cache
+import profiling
+import time_index
+import interpolate
+import rate_engine
+import supernova
+import preflight
+import shards
+import scratch
+import io
+import traceback
+import contextlib
+import threading
+from collections import deque
+from queue import Queue
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 
-parser = argparse.ArgumentParser(description = 'Loops time-dependent fluence files through SNOwGLoBES')
-parser.add_argument('channelname', type=str, help='Name of channel. \n (eg. argon)')
-parser.add_argument('experimentname', type=str, help='Name of experiment. \n (eg. ar17kt)')
-parser.add_argument('fluxname', type=str, help='Name of flux. \n (eg. chimera)')
-parser.add_argument('fluxpath', type=str, help='Directory containing flux files. \n (eg. /lustre/atlas1/stf006/proj-shared/bronson/2D_lumspec/)')
-parser.add_argument('--interpolate', action='store_true', help='option to interpolate raw data')
+#Build an isolated scratch copy of the repository for one timestep (see scratch.py).
+#Inputs are symlinked; supernova.glb and out/ are private to the worker.
+def make_scratch(scratch_root, fluxfile):
+    path = scratch.make(scratch_root)
+    #bin/supernova writes out/<fluxfile>_..., so the flux subdirectory has to exist
+    os.makedirs(os.path.dirname(os.path.join(path, "out", fluxfile)))
+    return path
 
-args = parser.parse_args()
+#Run one timestep in-process inside its own scratch directory. Called in a pool worker,
+#which runs one timestep at a time, so changing its working directory is safe.
+#The inputs are not checked again: the caller runs the preflight check for the whole batch.
+def run_timestep(fluxfile, channame, expt_config, engine, scratch_root, weight=True, no_unweighted=False):
+    scratch = make_scratch(scratch_root, fluxfile)
+    cwd = os.getcwd()
+    log = io.StringIO()
+    returncode = 1
+    try:
+        os.chdir(scratch)
+        with contextlib.redirect_stdout(log):
+            returncode = supernova.run_flux(fluxfile, channame, expt_config, engine, weight, no_unweighted, check = False)
+    except Exception:
+        log.write(traceback.format_exc())
+    finally:
+        os.chdir(cwd)
+    return scratch, returncode, log.getvalue()
 
-	
-channame = args.channelname
-expt_config = args.experimentname
-fluxname = args.fluxname
-fluxpath = args.fluxpath
-interpolate = args.interpolate
+#Move a worker's staged output into out/ and remove its scratch directory
+def merge_scratch(path):
+    scratch.merge_out(path)
+    shutil.rmtree(path)
 
+def print_progress(done, total, start):
+    elapsed = time.time() - start
+    eta = elapsed / done * (total - done)
+    print("[{0}/{1}] elapsed {2:.1f} s, ETA {3:.1f} s".format(done, total, elapsed, eta))
 
-if interpolate:
-    interpcmd = "python interpolate.py " + fluxname + " " + fluxpath + " /fluxes/td_fluxes/" + fluxname 
-    subprocess.run(interpcmd, shell=True)
+#Run the timesteps on a pool of workers, merging their output into out/ in timestep order.
+#With an event store, each timestep's spectra are appended to it (and the .dat files
+#dropped unless keep_dat) as the timestep is merged. Timesteps found in the result
+#cache are restored instead of recomputed, and new results are saved to it.
+def run_parallel(fluxfiles, channame, expt_config, engine, jobs, scratch_root, no_unweighted=False, store=None, keep_dat=True, cache=None):
+    if scratch_root is not None:
+        os.makedirs(scratch_root, exist_ok=True)
+    start = time.time()
+    failed = []
+    restored = 0
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        pending = []
+        for fluxfile in fluxfiles:
+            keys, entries = cache.lookup(fluxfile) if cache is not None else (None, None)
+            future = None if entries is not None else pool.submit(run_timestep, fluxfile, channame, expt_config, engine, scratch_root, True, no_unweighted)
+            pending.append((fluxfile, keys, entries, future))
+        #Timesteps are consumed in submission order, so the merge is ordered even though the workers finish out of order
+        for done, (fluxfile, keys, entries, future) in enumerate(pending, 1):
+            if future is None:
+                #Restored results go into the store from memory; only .dat output is written to out/
+                if store is None or keep_dat:
+                    cache.restore(entries, "out", fluxfile)
+                if store is not None:
+                    event_store.ingest_texts(store, cache.texts(entries, "out", fluxfile), "out", fluxfile, expt_config)
+                restored += 1
+            else:
+                scratch, returncode, log = future.result()
+                staged = os.path.join(scratch, "out")
+                if returncode != 0:
+                    print(log)
+                    print("Timestep " + fluxfile + " failed with exit code " + str(returncode))
+                    failed.append(fluxfile)
+                else:
+                    if cache is not None:
+                        cache.save(keys, staged, fluxfile)
+                    if store is not None:
+                        event_store.ingest(store, staged, fluxfile, expt_config, remove = not keep_dat)
+                merge_scratch(scratch)
+            print_progress(done, len(fluxfiles), start)
+    print("Processed {0} timesteps in {1:.1f} s with {2} workers ({3} restored from the result cache)".format(len(fluxfiles), time.time() - start, jobs, restored))
+    return failed
 
-path1 = "./fluxes/td_fluxes/" + fluxname
-path2 = sys.argv[4]
+#Run the timesteps through persistent GLoBES workers: supernova.glb is parsed once per worker,
+#not once per timestep. Output is written (and added to the store) in timestep order.
+#The workers run in a private directory with their own supernova.glb and unit flux, so concurrent runs do not share them.
+def run_workers(fluxfiles, channame, expt_config, jobs, keep_unweighted, store=None, keep_dat=True, cache=None, scratch_root=None):
+    chanfilename = "channels/channels_" + channame + ".dat"
+    rundir = globes_worker.make_rundir(channame, expt_config, scratch_root)
+    try:
+        run_worker_pool(fluxfiles, chanfilename, expt_config, jobs, keep_unweighted, store, keep_dat, cache, rundir)
+    finally:
+        shutil.rmtree(rundir)
 
-files = [os.path.splitext(filename)[0] for filename in os.listdir(path1)]
-files.sort()
+def run_worker_pool(fluxfiles, chanfilename, expt_config, jobs, keep_unweighted, store, keep_dat, cache, rundir):
+    workers = Queue()
+    for i in range(jobs):
+        workers.put(globes_worker.GlobesWorker(chanfilename, expt_config, rundir))
 
+    #Each thread borrows an idle worker for one timestep
+    def process(fluxfile):
+        worker = workers.get()
+        try:
+            return worker.run(fluxfile)
+        finally:
+            workers.put(worker)
 
-overall_time = []
-pb_time = []
+    start = time.time()
+    restored = 0
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = []
+        for fluxfile in fluxfiles:
+            keys, entries = cache.lookup(fluxfile) if cache is not None else (None, None)
+            future = None if entries is not None else pool.submit(process, fluxfile)
+            pending.append((fluxfile, keys, entries, future))
+        #The spectra go into the store from memory; .dat files are only written when they are kept
+        for done, (fluxfile, keys, entries, future) in enumerate(pending, 1):
+            if future is None:
+                outputs = cache.texts(entries, "out", fluxfile)
+                restored += 1
+            else:
+                texts = future.result()
+                outputs = globes_worker.output_texts(texts, fluxfile, chanfilename, expt_config, keep_unweighted = keep_unweighted)
+                if cache is not None:
+                    cache.save_texts(keys, outputs, "out", fluxfile)
+                #The store also takes the unweighted spectra when their files are not kept
+                if store is not None:
+                    outputs = dict(texts, **outputs)
+            if store is None or keep_dat:
+                globes_worker.write_outputs(outputs, fluxfile)
+            if store is not None:
+                event_store.ingest_texts(store, outputs, "out", fluxfile, expt_config)
+            print_progress(done, len(fluxfiles), start)
+    for i in range(jobs):
+        workers.get().close()
+    print("Processed {0} timesteps in {1:.1f} s with {2} GLoBES workers ({3} restored from the result cache)".format(len(fluxfiles), time.time() - start, jobs, restored))
 
-for fluxes in files:
-	if "00" in fluxes:
-		fluxfile = "td_fluxes/" + fluxname + "/"+ fluxes
-		cmd = "python supernova.py " + fluxfile + " " + channame + " " + expt_config + " " + "--weight"
-		subprocess.run(cmd, shell=True)
+#Run the timesteps one after another in this process
+def run_serial(fluxfiles, channame, expt_config, engine, no_unweighted=False, cache=None):
+    start = time.time()
+    failed = []
+    for done, fluxfile in enumerate(fluxfiles, 1):
+        keys, entries = cache.lookup(fluxfile) if cache is not None else (None, None)
+        if entries is not None:
+            cache.restore(entries, "out", fluxfile)
+        else:
+            try:
+                returncode = supernova.run_flux(fluxfile, channame, expt_config, engine, weight = True, no_unweighted = no_unweighted, check = False)
+            except Exception:
+                traceback.print_exc()
+                returncode = 1
+            if returncode != 0:
+                print("Timestep " + fluxfile + " failed with exit code " + str(returncode))
+                failed.append(fluxfile)
+            elif cache is not None:
+                cache.save(keys, "out", fluxfile)
+        print_progress(done, len(fluxfiles), start)
+    return failed
 
-	"""	fluxfilename = fluxpath + fluxes + ".dat"
+#Rates of one in-memory fluence (streaming mode). With keep_dat they are written straight to the
+#final output files; the results are returned for the event store either way.
+def stream_timestep(fluxfile, fluence, chanfilename, expt_config, target_mass, keep_unweighted, keep_fluence, keep_dat=True):
+    if keep_fluence:
+        interpolate.write_fluence("fluxes/" + fluxfile + ".dat", fluence)
+    flux = interpolate.fluence_table(fluence)
+    if not keep_dat:
+        return fluxfile, rate_engine.compute_rates(flux, chanfilename, expt_config, target_mass)
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = rate_engine.run(fluxfile, chanfilename, expt_config, target_mass, weight = True, flux = flux, keep_unweighted = keep_unweighted)
+    return fluxfile, results
+
+#Interpolate the luminosity files in rawpath and compute their rates without intermediate fluence files.
+#A reader thread parses and converts chunk files at a time into a bounded queue (it blocks while the
+#queue is full), and at most 2*jobs timesteps are computed at once, so memory stays bounded however
+#many timesteps there are. Output is written (and added to the store) in timestep order.
+def run_stream(rawpath, fluxname, channame, expt_config, jobs, keep_unweighted, store=None, keep_dat=True, keep_fluences=False, chunk=64):
+    chanfilename = "channels/channels_" + channame + ".dat"
+    target_mass = float(preflight.registry().target_mass(expt_config))
+
+    lumfiles = sorted(flux for flux in os.listdir(rawpath) if flux.endswith(".dat"))
+    names = [os.path.splitext(lumfile)[0] for lumfile in lumfiles]
+    times = [interpolate.read_times(os.path.join(rawpath, lumfile)) for lumfile in lumfiles]
+    os.makedirs("fluxes/td_fluxes/timesteps", exist_ok=True)
+    interpolate.write_timesteps("./fluxes/td_fluxes/timesteps/" + fluxname + "_timesteps.dat", [t[0] for t in times], [t[1] for t in times])
+    #Without the fluence files, the timestep names go next to the timesteps file (see time_index.py)
+    with open(time_index.names_file(fluxname), 'w') as NAMESFILE:
+        NAMESFILE.write("".join(name + "\n" for name in names))
+    if keep_fluences:
+        os.makedirs("fluxes/td_fluxes/" + fluxname, exist_ok=True)
+    os.makedirs("out/td_fluxes/" + fluxname, exist_ok=True)
+
+    fluences = Queue(maxsize=chunk)
+    failure = []
+    def reader():
+        try:
+            for item in interpolate.iter_fluences([os.path.join(rawpath, lumfile) for lumfile in lumfiles], [t[1] for t in times], chunk):
+                fluences.put(item)
+        except Exception as error:
+            failure.append(error)
+        finally:
+            fluences.put(None)
+    threading.Thread(target=reader, daemon=True).start()
+
+    #Same selection of timesteps as the fluence file loop
+    selected = [name for name in names if "00" in name]
+    start = time.time()
+    done = 0
+    pending = deque()
+    factors = {channel[0]: channel[4] for channel in preflight.registry().require_channels(chanfilename)}
+    def finish():
+        fluxfile, results = pending.popleft().result()
+        if store is not None:
+            event_store.ingest_results(store, fluxfile, results, factors)
+        return fluxfile
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        while True:
+            item = fluences.get()
+            if item is None:
+                break
+            i, fluence = item
+            fluxfile = "td_fluxes/" + fluxname + "/" + names[i]
+            if "00" not in names[i]:
+                if keep_fluences:
+                    interpolate.write_fluence("fluxes/" + fluxfile + ".dat", fluence)
+                continue
+            if len(pending) >= 2 * jobs:
+                finish()
+                done += 1
+                print_progress(done, len(selected), start)
+            pending.append(pool.submit(stream_timestep, fluxfile, fluence, chanfilename, expt_config, target_mass, keep_unweighted, keep_fluences,
+                                            store is None or keep_dat))
+        while pending:
+            finish()
+            done += 1
+            print_progress(done, len(selected), start)
+    if failure:
+        raise failure[0]
+    print("Streamed {0} timesteps in {1:.1f} s with {2} workers".format(done, time.time() - start, jobs))
+
+#Check every input of the run before anything is computed and write the job manifest next to its output.
+#Exits listing every problem found.
+def run_preflight(fluxname, fluxfiles, channame, expt_config, engine, extra_files=()):
+    manifest = preflight.check(fluxfiles, channame, expt_config, engine, extra_files = extra_files)
+    manifest_file = "out/td_fluxes/" + fluxname + "/" + fluxname + "_" + channame + "_" + expt_config + ".manifest.json"
+    preflight.write_manifest(manifest, manifest_file)
+    for problem in manifest["problems"]:
+        print(problem)
+    if manifest["problems"]:
+        sys.exit("Preflight check failed with {0} problems, nothing was run (see {1})".format(len(manifest["problems"]), manifest_file))
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description = 'Loops time-dependent fluence files through SNOwGLoBES')
+    parser.add_argument('channelname', type=str, help='Name of channel. \n (eg. argon)')
+    parser.add_argument('experimentname', type=str, help='Name of experiment. \n (eg. ar17kt)')
+    parser.add_argument('fluxname', type=str, help='Name of flux. \n (eg. chimera)')
+    parser.add_argument('fluxpath', type=str, help='Directory containing flux files. \n (eg. /lustre/atlas1/stf006/proj-shared/bronson/2D_lumspec/)')
+    parser.add_argument('--interpolate', action='store_true', help='option to interpolate raw data')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of timesteps to run at the same time. \n (each worker gets its own scratch GLoBES file and output staging)')
+    parser.add_argument('--scratch', type=str, default=None, help='Directory for the per-worker scratch areas. \n (default: system temporary directory)')
+    parser.add_argument('--no-unweighted', action='store_true', help='Do not keep the _unweighted intermediate files')
+    parser.add_argument('--output', type=str, choices=['dat', 'store', 'both'], default='dat', help='Output backend. \n (dat = out/*.dat files, store = one memory-mapped event store per run, both = both)')
+    #The persistent-worker engine (run_workers) stays out of the choices until bin/supernova is rebuilt
+    #with --worker and python globes_worker.py <flux> <channel> <experiment> matches the per-flux output
+    parser.add_argument('--engine', type=str, choices=['globes', 'numpy'], default='globes', help='Rate engine. \n (globes/numpy run each timestep through supernova.run_flux in-process)')
+    parser.add_argument('--no-cache', action='store_true', help='Do not read or write the result cache. \n (by default unchanged timesteps are restored from it, which also resumes an interrupted run)')
+    parser.add_argument('--cache-size', type=float, default=2000., help='Size limit of the result cache in MB. \n (least recently used results are evicted)')
+    parser.add_argument('--stream', action='store_true', help='Interpolate the luminosity files in fluxpath and compute the rates in memory, without writing fluence files. \n (needs --engine numpy; the result cache is not used)')
+    parser.add_argument('--keep-fluences', action='store_true', help='With --stream, also write the fluence files to fluxes/td_fluxes/<flux>')
+    parser.add_argument('--chunk', type=int, default=64, help='With --stream, number of luminosity files parsed at a time and held in the queue')
+    parser.add_argument('--shard', type=str, default=None, help='Run only shard i of N of the timesteps, into shards/<flux>_<chan>_<config>/shard_<i>_of_<N>. \n (eg. 0/4; merge with python shards.py merge)')
+    parser.add_argument('--shard-plan', type=str, default=None, help='With --shard, take the timesteps of the shard from this plan (python shards.py plan)')
+    parser.add_argument('--shard-dir', type=str, default="shards", help='With --shard, directory holding the shard roots. \n (must be shared by all nodes)')
+    parser.add_argument('--index', action='store_true', help='Add the new and rerun timesteps to the time-window index after the run. \n (query it with python time_index.py)')
+    parser.add_argument('--profile', type=str, default=None, help='Append per-stage timing and I/O records of this run and every timestep to this JSON lines file. \n (eg. profile.jsonl; summarize with python profiling.py profile.jsonl)')
+    parser.add_argument('--pstats', type=str, default=None, help='Dump cProfile statistics of this and every Python child process into this directory. \n (eg. pstats)')
+
+    args = parser.parse_args(argv)
+    if args.stream and args.engine != "numpy":
+        parser.error("--stream computes the rates in memory and needs --engine numpy")
+    #Interpolation, the store and the index belong to the whole run: do them before sharding or when merging
+    if args.shard and (args.interpolate or args.stream or args.index or args.output != "dat"):
+        parser.error("--shard runs the fluence files as they are into .dat output: interpolate first, and use --output/--index with python shards.py merge")
+    profiling.init("td_supernova.py", args.profile, args.pstats, flux = args.fluxname, channels = args.channelname, config = args.experimentname, engine = args.engine)
+
+    channame = args.channelname
+    expt_config = args.experimentname
+    fluxname = args.fluxname
+    fluxpath = args.fluxpath
+    jobs = args.jobs
+
+    #A shard runs in its own root, so everything below writes to the shard-local out/
+    if args.shard:
+        try:
+            shard_index, shard_count = shards.parse_shard(args.shard)
+        except ValueError as error:
+            parser.error(str(error))
+        #Paths given on the command line are relative to where the run was started
+        args.shard_plan = args.shard_plan and os.path.abspath(args.shard_plan)
+        args.scratch = args.scratch and os.path.abspath(args.scratch)
+        os.chdir(shards.make_root(shards.shard_root(fluxname, channame, expt_config, shard_index, shard_count, args.shard_dir), fluxname))
+        #Not finished until the record is written again at the end
+        if os.path.exists("shard.json"):
+            os.remove("shard.json")
+
+    #Check the channels, detector and (for --stream) luminosity files before creating any output
+    lumfiles = []
+    if args.stream:
+        if not os.path.isdir(fluxpath):
+            sys.exit("Luminosity file directory " + fluxpath + " not found")
+        lumfiles = [(os.path.join(fluxpath, lumfile), "luminosity") for lumfile in sorted(os.listdir(fluxpath)) if lumfile.endswith(".dat")]
+    run_preflight(fluxname, [], channame, expt_config, args.engine, lumfiles)
+    profiling.checkpoint("preflight")
+
+    store = None
+    if args.output != "dat":
+        store = event_store.store_path(fluxname, channame, expt_config)
+        if not os.path.exists(store):
+            event_store.create(store, "channels/channels_" + channame + ".dat", expt_config)
+
+    if args.stream:
+        run_stream(fluxpath, fluxname, channame, expt_config, jobs, not args.no_unweighted, store, keep_dat = args.output != "store",
+                   keep_fluences = args.keep_fluences, chunk = args.chunk)
+        profiling.checkpoint("stream", jobs = jobs)
+    else:
+        if args.interpolate:
+            interpolate.interpolate_series(fluxname, fluxpath, "/fluxes/td_fluxes/" + fluxname)
+
+        fluxfiles = shards.timestep_fluxfiles(fluxname)
+        if args.shard:
+            fluxfiles = shards.select(fluxfiles, shard_index, shard_count, shards.read_plan(args.shard_plan) if args.shard_plan else None)
+        run_preflight(fluxname, fluxfiles, channame, expt_config, args.engine)
+
+        profiling.checkpoint("setup", timesteps = len(fluxfiles))
+
+        cache = None
+        if not args.no_cache:
+            #Every timestep is weighted, so the cache variant only depends on --no-unweighted
+            variant = "--weight --no-unweighted" if args.no_unweighted else "--weight"
+            cache = result_cache.ResultCache("channels/channels_" + channame + ".dat", expt_config, args.engine, variant, args.cache_size * 1e6)
+
+        if args.engine == "worker":
+            run_workers(fluxfiles, channame, expt_config, jobs, not args.no_unweighted, store, keep_dat = args.output != "store", cache = cache,
+                        scratch_root = args.scratch)
+        #The store is filled while merging worker output, so it always goes through the worker pool
+        elif jobs > 1 or store is not None:
+            failed = run_parallel(fluxfiles, channame, expt_config, args.engine, jobs, args.scratch, args.no_unweighted, store, keep_dat = args.output != "store", cache = cache)
+            if failed:
+                return 1
+        else:
+            failed = run_serial(fluxfiles, channame, expt_config, args.engine, args.no_unweighted, cache)
+            if failed:
+                return 1
+
+        profiling.checkpoint("timesteps", timesteps = len(fluxfiles), jobs = jobs)
+
+        if cache is not None:
+            cache.evict()
+            profiling.checkpoint("evict")
+
+        if args.shard:
+            shards.write_record(fluxname, channame, expt_config, shard_index, shard_count, fluxfiles)
+            print("Shard {0}/{1} finished {2} timesteps".format(shard_index, shard_count, len(fluxfiles)))
+
+    if args.index:
+        print("Added or rebuilt {0} timesteps in the time-window index".format(time_index.update(fluxname, channame, expt_config)))
+        profiling.checkpoint("index")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+"""	fluxfilename = fluxpath + fluxes + ".dat"
 		times = lc.getline(fluxfilename, 9)
 		split_times = times.split()
 		overall_time.append(split_times[0])
@@ -54,7 +402,7 @@ for fluxes in files:
 
 time_outputfile = "./fluxes/td_fluxes/timesteps/"+ fluxname + "_timesteps.dat"
 
-d = {"Overall Time (s)": overall_time, "Post Bounce Time (s)": pb_time}	
+d = {"Overall Time (s)": overall_time, "Post Bounce Time (s)": pb_time}
 df = pd.DataFrame(data=d, columns = ["Overall Time (s)", "Post Bounce Time (s)"])
 txt = df.to_string(index=False)
 with open(time_outputfile, 'w') as fo:
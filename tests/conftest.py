@@ -0,0 +1,15 @@
+#The modules are flat and read their inputs relative to the repository root, so the tests
+#import them from there and run with it as the working directory.
+
+import os
+import sys
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+if root not in sys.path:
+    sys.path.insert(0, root)
+
+@pytest.fixture(autouse=True)
+def repo_root(monkeypatch):
+    monkeypatch.chdir(root)
+    return root
@@ -0,0 +1,11 @@
+#Persistent GLoBES worker against a single bin/supernova run of the same flux
+
+import pytest
+import globes_worker
+import preflight
+
+@pytest.mark.parametrize("fluxname,channame,expt_config", [("livermore", "argon", "ar17kt")])
+def test_worker_matches_single_run(fluxname, channame, expt_config):
+    if not preflight.supports_worker(globes_worker.exename):
+        pytest.skip(globes_worker.exename + " was built without worker mode: rebuild it with make -C src install")
+    assert globes_worker.validate(fluxname, channame, expt_config)
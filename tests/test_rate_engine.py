@@ -0,0 +1,34 @@
+#NumPy engine against the bin/supernova output committed in reference/ (see reference/README)
+
+import glob
+import os
+import numpy as np
+import pytest
+import preflight
+import rate_engine
+
+#(flux, channels, detector configuration) with committed reference output
+references = [("livermore", "argon", "ar17kt")]
+
+#GLoBES prints 6 significant digits; rates are compared per bin relative to the spectrum peak
+rtol = 1e-3
+
+@pytest.mark.parametrize("fluxname,channame,expt_config", references)
+def test_matches_reference(fluxname, channame, expt_config, tmp_path):
+    pattern = os.path.join(rate_engine.reference_dir, fluxname + "_*_" + expt_config + "_events*_unweighted.dat")
+    reffiles = sorted(glob.glob(pattern))
+    if not reffiles:
+        pytest.skip("no reference output for {0} {1} {2}: run python rate_engine.py {0} {1} {2} --make-reference where bin/supernova runs".format(fluxname, channame, expt_config))
+
+    target_mass = float(preflight.registry().target_mass(expt_config))
+    rate_engine.run(fluxname, "channels/channels_" + channame + ".dat", expt_config, target_mass, outdir=str(tmp_path))
+    written = sorted(os.path.basename(filename) for filename in glob.glob(str(tmp_path / (fluxname + "_*_unweighted.dat"))))
+    assert written == [os.path.basename(filename) for filename in reffiles]
+
+    for reffile in reffiles:
+        ref_energies, ref_rates = rate_engine.read_rates(reffile)
+        energies, rates = rate_engine.read_rates(str(tmp_path / os.path.basename(reffile)))
+        np.testing.assert_allclose(energies, ref_energies, rtol=1e-5)
+        scale = max(np.abs(ref_rates).max(), 1e-300)
+        assert np.abs(rates - ref_rates).max() / scale <= rtol, reffile
+        assert abs(rates.sum() - ref_rates.sum()) <= rtol * max(abs(ref_rates.sum()), 1e-300), reffile
@@ -0,0 +1,74 @@
+#Sharded td_supernova.py runs (numpy engine) of a synthetic timestep series: a clean merge into the
+#event store, and the check refusing a duplicate and a missing timestep
+
+import os
+import shutil
+import subprocess
+import sys
+import pytest
+import benchmark
+import event_store
+import interpolate
+import shards
+
+#Shard roots link the real fluxes/, so the series goes there under its own name
+fluxname, channame, expt_config = "shardtest", "argon", "ar17kt"
+td_args = ["--engine", "numpy", "--no-cache"]
+
+@pytest.fixture
+def series(tmp_path):
+    rawdir = str(tmp_path / "raw")
+    os.makedirs(rawdir)
+    benchmark.write_lumspecs(rawdir, 6)
+    fluxdir = "fluxes/td_fluxes/" + fluxname
+    timesteps = "fluxes/td_fluxes/timesteps"
+    made_timesteps = not os.path.isdir(timesteps)
+    os.makedirs(fluxdir)
+    os.makedirs(timesteps, exist_ok=True)
+    try:
+        interpolate.interpolate_series(fluxname, rawdir, "/" + fluxdir)
+        shard_dir = str(tmp_path / "shards")
+        os.makedirs(shard_dir)
+        yield shard_dir, str(tmp_path / "out")
+    finally:
+        shutil.rmtree(fluxdir)
+        if made_timesteps:
+            shutil.rmtree(timesteps)
+        else:
+            for filename in os.listdir(timesteps):
+                if filename.startswith(fluxname + "_"):
+                    os.remove(os.path.join(timesteps, filename))
+
+def run_shard(index, count, shard_dir):
+    cmd = [sys.executable, "td_supernova.py", channame, expt_config, fluxname, "-", "--shard", "{0}/{1}".format(index, count),
+           "--shard-dir", shard_dir] + td_args
+    assert subprocess.run(cmd, stdout=subprocess.DEVNULL).returncode == 0
+
+def test_clean_merge(series):
+    shard_dir, outdir = series
+    assert shards.run_local(fluxname, channame, expt_config, 3, td_args, shard_dir) == []
+    owners, problems = shards.check(fluxname, channame, expt_config, shard_dir)
+    assert problems == []
+    assert owners and sorted(owners) == shards.timestep_fluxfiles(fluxname)
+
+    assert shards.merge(fluxname, channame, expt_config, shard_dir, output="store", outdir=outdir) == []
+    store = event_store.store_path(fluxname, channame, expt_config, outdir)
+    assert len(event_store.read_meta(store)["timesteps"]) == len(owners)
+    assert not any(filename.endswith(".dat") and "_events" in filename for _, _, filenames in os.walk(outdir) for filename in filenames)
+    assert not os.path.exists(shards.run_dir(fluxname, channame, expt_config, shard_dir))
+
+def test_duplicate_timestep(series):
+    shard_dir, outdir = series
+    for index, count in [(0, 2), (1, 2), (0, 3)]:
+        run_shard(index, count, shard_dir)
+    problems = shards.merge(fluxname, channame, expt_config, shard_dir, outdir=outdir)
+    assert any("is in 2 shards" in problem for problem in problems)
+    assert not os.path.exists(outdir)
+
+def test_missing_timestep(series):
+    shard_dir, outdir = series
+    run_shard(0, 2, shard_dir)
+    problems = shards.merge(fluxname, channame, expt_config, shard_dir, outdir=outdir)
+    assert "Shards not finished: 1/2" in problems
+    assert any("is in no shard" in problem for problem in problems)
+    assert not os.path.exists(outdir)
@@ -0,0 +1,63 @@
+#Sparse smearing matrices against the dense GLoBES reading of the same files
+
+import numpy as np
+import pytest
+import rate_engine
+import smearing
+import table_cache
+
+rtol = 1e-12
+
+#Identity-like and banded matrices (CSR products) and nearly dense ones (BLAS products),
+#including the background and the identity-like nuebar_Ar40 matrix
+sparse_files = ["smear/smear_nc_nue_Pb208_1n_halo1.dat", "smear/smear_nue_e_novaND.dat", "smear/smear_ibd_scint50kt.dat"]
+dense_files = ["smear/smear_bg_chan_ar17kt.dat", "smear/smear_nuebar_Ar40_ar17kt.dat", "smear/smear_nue_Ar40_ar17kt.dat",
+               "smear/smear_nue_e_ar17kt.dat", "smear/smear_ibd_wc100kt30prct.dat"]
+
+def check_products(sparse, dense):
+    rng = np.random.default_rng(0)
+    scale = np.abs(dense).sum(axis=1).max() or 1.
+    np.testing.assert_allclose(sparse.todense(), dense, rtol=0, atol=rtol * scale)
+    for x in rng.random((3, dense.shape[1])):
+        np.testing.assert_allclose(sparse.dot(x), dense @ x, rtol=0, atol=rtol * scale)
+    spectra = rng.random((50, dense.shape[1]))
+    np.testing.assert_allclose(sparse.smear(spectra), spectra @ dense.T, rtol=0, atol=rtol * scale)
+    #Leading axes are kept, e.g. (time x flavor x sampling points)
+    batched = rng.random((4, 6, dense.shape[1]))
+    np.testing.assert_allclose(sparse.smear(batched), batched @ dense.T, rtol=0, atol=rtol * scale)
+
+@pytest.mark.parametrize("filename", sparse_files)
+def test_sparse_branch(filename):
+    sparse = smearing.load(filename)
+    assert sparse.density <= smearing.dense_threshold
+    check_products(sparse, rate_engine.read_smear(filename))
+
+@pytest.mark.parametrize("filename", dense_files)
+def test_dense_branch(filename):
+    sparse = smearing.load(filename)
+    assert sparse.density > smearing.dense_threshold
+    check_products(sparse, rate_engine.read_smear(filename))
+
+#A row ending at the number of sampling points is clamped to the last one
+@pytest.mark.parametrize("nbins,nsamp", [(20, 20), (20, 30)])
+def test_clamped_row(nbins, nsamp, tmp_path, monkeypatch):
+    monkeypatch.setattr(table_cache, "cache_dir", str(tmp_path / "cache"))
+    rng = np.random.default_rng(1)
+    dense = np.zeros((nbins, nsamp))
+    rows = []
+    for i in range(nbins):
+        start = max(0, i - 2)
+        end = nsamp if i == nbins - 1 else min(i + 2, nsamp - 1)
+        values = rng.random(end - start + 1)
+        #Zeros at the window edges are trimmed from the band
+        values[0] = 0.
+        rows.append("{" + ",".join([str(start), str(end)] + ["%r" % float(v) for v in values]) + "}")
+        width = min(end, nsamp - 1) - start + 1
+        dense[i, start:start + width] = values[:width]
+    filename = tmp_path / "smear_clamped.dat"
+    filename.write_text("energy(#clamped)<\n@energy =\n" + ",\n".join(rows) + "\n>\n")
+
+    sparse = smearing.load(str(filename), nbins, nsamp)
+    assert sparse.shape == (nbins, nsamp)
+    assert sparse.indices.max() == nsamp - 1
+    check_products(sparse, dense)
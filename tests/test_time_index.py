@@ -0,0 +1,57 @@
+#Time-window index queries against the per-timestep spectra of a synthetic event store
+
+import numpy as np
+import pytest
+import event_store
+import time_index
+
+fluxname, channame, expt_config = "synthetic", "argon", "ar17kt"
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    outdir = str(tmp_path)
+    store = event_store.store_path(fluxname, channame, expt_config, outdir)
+    meta = event_store.create(store, "channels/channels_" + channame + ".dat", expt_config)
+    nbins = max(len(e) for e in meta["energies"].values())
+    rng = np.random.default_rng(0)
+    names = ["step%03d" % i for i in range(10)]
+    times = np.linspace(0., 0.45, len(names))
+    spectra = rng.random((len(names), len(event_store.kinds), len(meta["channels"]), nbins))
+    for name, step in zip(names, spectra):
+        event_store.append(store, name, step, step.sum(axis=2))
+    monkeypatch.setattr(time_index, "read_timesteps", lambda name: (names, list(times)))
+    assert time_index.update(fluxname, channame, expt_config, outdir) == len(names)
+    return time_index.TimeIndex(time_index.index_path(fluxname, channame, expt_config, outdir)), times, spectra
+
+def test_light_curve_per_timestep(index):
+    index, times, spectra = index
+    k = event_store.kinds.index("smeared")
+    curve_times, events = index.light_curve()
+    assert curve_times.shape == events.shape == times.shape
+    np.testing.assert_allclose(events, spectra[:, k].sum(axis=(1, 2)))
+
+def test_light_curve_edges(index):
+    index, times, spectra = index
+    k = event_store.kinds.index("smeared")
+    edges = np.array([0., 0.12, 0.3, 0.5])
+    curve_times, events = index.light_curve(edges=edges)
+    assert curve_times.shape == events.shape == (len(edges) - 1,)
+    np.testing.assert_array_equal(curve_times, edges[:-1])
+    per_step = spectra[:, k].sum(axis=(1, 2))
+    for lo, hi, value in zip(edges[:-1], edges[1:], events):
+        window = (times >= lo) & (times < hi)
+        np.testing.assert_allclose(value, per_step[window].sum())
+        np.testing.assert_allclose(index.counts(t0=lo, t1=hi), value)
+    grid_times, grid = index.grid(edges=edges)
+    np.testing.assert_array_equal(grid_times, curve_times)
+    np.testing.assert_allclose(grid.sum(axis=(1, 2)), events)
+
+def test_rerun_timestep_is_rebuilt(index, tmp_path):
+    index, times, spectra = index
+    store = event_store.store_path(fluxname, channame, expt_config, str(tmp_path))
+    step = spectra[3] * 2
+    event_store.append(store, "step003", step, step.sum(axis=2))
+    assert time_index.update(fluxname, channame, expt_config, str(tmp_path)) == 1
+    index = time_index.TimeIndex(time_index.index_path(fluxname, channame, expt_config, str(tmp_path)))
+    k = event_store.kinds.index("smeared")
+    np.testing.assert_allclose(index.light_curve()[1][3], step[k].sum())
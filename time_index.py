@@ -0,0 +1,303 @@
+#!/usr/bin/python3
+
+#Time-window aggregation index for time-dependent runs.
+#For one (flux series, channel file, detector configuration) the index keeps the
+#summed-area table of the per-timestep spectra along post-bounce time and energy:
+#   cumulative[i, kind, channel, j] = events of the first i timesteps in the first j bins
+#so the events in any time window and energy range are four lookups, and a time-integrated
+#spectrum, a rebinned spectrum or a light curve costs a constant number of lookups per bin.
+#Timesteps are ordered by the post-bounce times of fluxes/td_fluxes/timesteps/<flux>_timesteps.dat
+#(row i belongs to the i-th fluence file of fluxes/td_fluxes/<flux>/ in sorted order, or the i-th
+#name of fluxes/td_fluxes/timesteps/<flux>_names.dat after a --stream run), and a
+#timestep belongs to a window [t0, t1) when its post-bounce time does. Spectra are read from
+#the event store when the run has one and from the out/td_fluxes/<flux>/*.dat files otherwise.
+#Every indexed timestep keeps a stamp of its source (the store row's stamp, or the newest mtime of
+#its .dat files); update() adds the timesteps that are not indexed yet and rebuilds the ones whose
+#stamp changed, so it can be run after every (partial) run or rerun. The index lives in
+#out/td_fluxes/<flux>/<flux>_<chan>_<config>.index.
+
+import os
+import json
+import argparse
+import numpy as np
+from numpy.lib.format import open_memmap
+import rate_engine
+import event_store
+
+kinds = event_store.kinds
+
+#Index directory of a time-dependent run
+def index_path(fluxname, channame, expt_config, outdir="out"):
+    return outdir + "/td_fluxes/" + fluxname + "/" + fluxname + "_" + channame + "_" + expt_config + ".index"
+
+#Timestep names (fluence files without .dat, in sorted order) and their post-bounce times
+#File of timestep names written by td_supernova.py --stream, which leaves no fluence files to list
+def names_file(fluxname):
+    return "fluxes/td_fluxes/timesteps/" + fluxname + "_names.dat"
+
+def read_timesteps(fluxname):
+    fluxdir = "fluxes/td_fluxes/" + fluxname
+    names = []
+    if os.path.isdir(fluxdir):
+        names = sorted(os.path.splitext(filename)[0] for filename in os.listdir(fluxdir) if filename.endswith(".dat"))
+    if not names and os.path.exists(names_file(fluxname)):
+        with open(names_file(fluxname)) as NAMESFILE:
+            names = [line.strip() for line in NAMESFILE if line.strip()]
+    times = []
+    with open("fluxes/td_fluxes/timesteps/" + fluxname + "_timesteps.dat") as TIMEFILE:
+        #Skip the column header
+        next(TIMEFILE)
+        for line in TIMEFILE:
+            stuff = line.split()
+            if stuff:
+                times.append(float(stuff[1]))
+    if len(times) != len(names):
+        raise ValueError("{0} timesteps in the timesteps file but {1} fluence files in fluxes/td_fluxes/{2}".format(len(times), len(names), fluxname))
+    return names, times
+
+def read_meta(path):
+    with open(os.path.join(path, "meta.json")) as METAFILE:
+        return json.load(METAFILE)
+
+#Create an empty index with room for capacity timesteps
+def create(path, chanfilename, expt_config, capacity=64):
+    channels, energies = event_store.layout(chanfilename, expt_config)
+    nbins = max(len(e) for e in energies.values())
+    os.makedirs(path, exist_ok=True)
+    cumulative = open_memmap(os.path.join(path, "cumulative.npy"), mode='w+', shape=(capacity + 1, len(kinds), len(channels), nbins + 1))
+    cumulative[0] = 0.
+    del cumulative
+    meta = {"channels": channels, "kinds": list(kinds), "energies": energies, "timesteps": [], "times": [], "stamps": {},
+            "present": np.zeros((len(kinds), len(channels)), dtype=bool).tolist()}
+    event_store.write_meta(path, meta)
+    return meta
+
+#(kind x channel x bin) spectra of one timestep, with NaN where a file does not exist, or None if it was not run yet
+def timestep_spectra(meta, fluxname, timestep, expt_config, outdir="out", store=None):
+    if store is not None and timestep in store.timesteps:
+        t = store.timesteps.index(timestep)
+        return np.array(store._events[t])[:, [store.channels.index(c) for c in meta["channels"]]]
+    spectra, totals, filenames = event_store.read_timestep(meta, outdir, "td_fluxes/" + fluxname + "/" + timestep, expt_config)
+    return spectra if filenames else None
+
+#Stamp of a timestep's source, or None if it was not run yet: the stamp of its store row, or the
+#newest mtime of its .dat files. Store rows written before stamps existed fall back to the store's mtime.
+def timestep_stamp(meta, fluxname, timestep, expt_config, outdir="out", store=None):
+    if store is not None and timestep in store.timesteps:
+        t = store.timesteps.index(timestep)
+        if t < len(store.stamps) and store.stamps[t] is not None:
+            return store.stamps[t]
+        return os.stat(os.path.join(store.path, "events.npy")).st_mtime_ns
+    mtimes = []
+    for kind in kinds:
+        for chan_name in meta["channels"]:
+            filename = outdir + "/td_fluxes/" + fluxname + "/" + timestep + "_" + chan_name + "_" + expt_config + "_events" + event_store.suffixes[kind] + ".dat"
+            if os.path.exists(filename):
+                mtimes.append(os.stat(filename).st_mtime_ns)
+    return max(mtimes) if mtimes else None
+
+#Add the timesteps that have been run since the last update and rebuild the ones that were rerun.
+#Returns the number added or rebuilt.
+def update(fluxname, channame, expt_config, outdir="out"):
+    chanfilename = "channels/channels_" + channame + ".dat"
+    path = index_path(fluxname, channame, expt_config, outdir)
+    meta = read_meta(path) if os.path.exists(path) else create(path, chanfilename, expt_config)
+    storefile = event_store.store_path(fluxname, channame, expt_config, outdir)
+    store = event_store.EventStore(storefile) if os.path.exists(storefile) else None
+
+    #Indexes written before stamps existed are refreshed once
+    stamps = meta.setdefault("stamps", {})
+    indexed = set(meta["timesteps"])
+    new = []
+    for timestep, time in zip(*read_timesteps(fluxname)):
+        stamp = timestep_stamp(meta, fluxname, timestep, expt_config, outdir, store)
+        if stamp is None or stamps.get(timestep) == stamp:
+            continue
+        spectra = timestep_spectra(meta, fluxname, timestep, expt_config, outdir, store)
+        if spectra is not None:
+            new.append((time, timestep, spectra))
+            stamps[timestep] = stamp
+    if not new:
+        return 0
+    added = sum(1 for time, timestep, spectra in new if timestep not in indexed)
+
+    cumfile = os.path.join(path, "cumulative.npy")
+    n = len(meta["timesteps"])
+    capacity = np.load(cumfile, mmap_mode='r').shape[0] - 1
+    while n + added > capacity:
+        event_store.grow(cumfile, 2 * capacity + 1)
+        capacity = 2 * capacity
+    cumulative = np.load(cumfile, mmap_mode='r+')
+    present = np.array(meta["present"])
+
+    new.sort(key=lambda step: step[0])
+    if added < len(new) or (meta["times"] and new[0][0] < meta["times"][-1]):
+        #A timestep was rerun or lands before the end of the index: recover the indexed steps
+        #that did not change and rebuild in time order
+        renewed = set(timestep for time, timestep, spectra in new)
+        old = np.diff(cumulative[:n + 1], axis=0)
+        steps = [(time, timestep, step) for time, timestep, step in zip(meta["times"], meta["timesteps"], old) if timestep not in renewed]
+        steps += [(time, timestep, None) for time, timestep, spectra in new]
+        spectra_of = {timestep: spectra for time, timestep, spectra in new}
+        steps.sort(key=lambda step: step[0])
+        start = 0
+    else:
+        steps = [(time, timestep, None) for time, timestep, spectra in new]
+        spectra_of = {timestep: spectra for time, timestep, spectra in new}
+        start = n
+
+    for i, (time, timestep, step) in enumerate(steps, start):
+        if step is None:
+            spectra = spectra_of[timestep]
+            present |= ~np.isnan(spectra).all(axis=2)
+            #Running sum along energy with a leading zero column
+            step = np.zeros(spectra.shape[:2] + (spectra.shape[2] + 1,))
+            np.cumsum(np.nan_to_num(spectra), axis=2, out=step[:, :, 1:])
+        cumulative[i + 1] = cumulative[i] + step
+    cumulative.flush()
+    del cumulative
+
+    if start == 0:
+        meta["times"] = [step[0] for step in steps]
+        meta["timesteps"] = [step[1] for step in steps]
+    else:
+        meta["times"] += [step[0] for step in steps]
+        meta["timesteps"] += [step[1] for step in steps]
+    meta["present"] = present.tolist()
+    #The metadata is replaced last, so a reader never sees rows that are not written yet
+    event_store.write_meta(path, meta)
+    return len(new)
+
+#Read-only queries on an index. channel=None sums every channel except the background channel.
+class TimeIndex:
+    def __init__(self, path):
+        meta = read_meta(path)
+        self.channels = meta["channels"]
+        self.timesteps = meta["timesteps"]
+        self.times = np.array(meta["times"])
+        self.energies = {kind: np.array(e) for kind, e in meta["energies"].items()}
+        self.present = np.array(meta["present"])
+        self._cumulative = np.load(os.path.join(path, "cumulative.npy"), mmap_mode='r')[:len(self.timesteps) + 1]
+
+    def __len__(self):
+        return len(self.timesteps)
+
+    def _energy_key(self, kind):
+        return "smeared" if kind.startswith("smeared") else "unsmeared"
+
+    #(time rows + 1 x energy columns + 1) summed-area table of one kind and channel (or the channel sum)
+    def _table(self, kind, channel, rows, cols):
+        k = kinds.index(kind)
+        if channel is None:
+            chans = [c for c, name in enumerate(self.channels) if name != rate_engine.bg_chan_name]
+        else:
+            chans = [self.channels.index(channel)]
+        if not self.present[k, chans].any():
+            raise ValueError("No {0} output for {1} in this index".format(kind, channel or "any channel"))
+        return self._cumulative[np.ix_(rows, [k], chans, cols)].sum(axis=(1, 2))
+
+    #First and last+1 timestep of [t0, t1)
+    def window(self, t0=None, t1=None):
+        i0 = 0 if t0 is None else int(np.searchsorted(self.times, t0))
+        i1 = len(self.times) if t1 is None else int(np.searchsorted(self.times, t1))
+        return i0, max(i0, i1)
+
+    #First and last+1 energy bin of [e0, e1) (bin centers, GeV)
+    def bins(self, kind, e0=None, e1=None):
+        centers = self.energies[self._energy_key(kind)]
+        j0 = 0 if e0 is None else int(np.searchsorted(centers, e0))
+        j1 = len(centers) if e1 is None else int(np.searchsorted(centers, e1))
+        return j0, max(j0, j1)
+
+    #Events in the time window [t0, t1) and energy range [e0, e1)
+    def counts(self, kind="smeared", channel=None, t0=None, t1=None, e0=None, e1=None):
+        i0, i1 = self.window(t0, t1)
+        j0, j1 = self.bins(kind, e0, e1)
+        table = self._table(kind, channel, [i0, i1], [j0, j1])
+        return table[1, 1] - table[0, 1] - table[1, 0] + table[0, 0]
+
+    #Time-integrated spectrum over [t0, t1): (energies, events per bin)
+    def spectrum(self, kind="smeared", channel=None, t0=None, t1=None):
+        i0, i1 = self.window(t0, t1)
+        energies = self.energies[self._energy_key(kind)]
+        table = self._table(kind, channel, [i0, i1], range(len(energies) + 1))
+        return energies, np.diff(table[1] - table[0])
+
+    #Time-integrated spectrum over [t0, t1) in coarser bins: events between consecutive edges (GeV)
+    def rebin(self, edges, kind="smeared", channel=None, t0=None, t1=None):
+        i0, i1 = self.window(t0, t1)
+        cols = np.searchsorted(self.energies[self._energy_key(kind)], edges)
+        table = self._table(kind, channel, [i0, i1], cols)
+        return np.diff(table[1] - table[0])
+
+    #Events per timestep in [e0, e1) as (post-bounce times, events), or per time bin when edges (s)
+    #are given as (left bin edges, events)
+    def light_curve(self, kind="smeared", channel=None, e0=None, e1=None, edges=None):
+        j0, j1 = self.bins(kind, e0, e1)
+        if edges is None:
+            rows = range(len(self.times) + 1)
+            times = self.times
+        else:
+            rows = np.searchsorted(self.times, edges)
+            times = np.asarray(edges)[:-1]
+        table = self._table(kind, channel, rows, [j0, j1])
+        return times, np.diff(table[:, 1] - table[:, 0])
+
+    #Events of every channel per timestep, or per time bin when edges (s) are given, as
+    #(post-bounce times or left bin edges, time x channel x energy bin)
+    def grid(self, kind="smeared", edges=None):
+        nbins = len(self.energies[self._energy_key(kind)])
+        if edges is None:
+            rows = np.arange(len(self.times) + 1)
+            times = self.times
+        else:
+            rows = np.searchsorted(self.times, edges)
+            times = np.asarray(edges)[:-1]
+        table = self._cumulative[rows, kinds.index(kind), :, :nbins + 1]
+        return times, np.diff(np.diff(table, axis=0), axis=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Updates and queries the time-window index of a time-dependent run')
+    parser.add_argument('channelname', type=str, help='Name of channel. \n (eg. argon)')
+    parser.add_argument('experimentname', type=str, help='Name of experiment. \n (eg. ar17kt)')
+    parser.add_argument('fluxname', type=str, help='Name of flux. \n (eg. chimera)')
+    parser.add_argument('--no-update', action='store_true', help='Query the index as it is, without adding new timesteps first')
+    parser.add_argument('--kind', type=str, choices=kinds, default='smeared', help='Spectra to query')
+    parser.add_argument('--channel', type=str, default=None, help='Channel to query. \n (default: sum of all channels except the background)')
+    parser.add_argument('--window', type=float, nargs=2, default=[None, None], metavar=('T0', 'T1'), help='Post-bounce time window in s. \n (eg. 0 0.05)')
+    parser.add_argument('--energy', type=float, nargs=2, default=[None, None], metavar=('E0', 'E1'), help='Energy range in GeV. \n (eg. 0.005 0.05)')
+    parser.add_argument('--spectrum', action='store_true', help='Print the time-integrated spectrum of the window')
+    parser.add_argument('--rebin', type=int, default=None, help='With --spectrum, merge this many energy bins. \n (eg. 10)')
+    parser.add_argument('--light-curve', type=float, default=None, nargs='?', const=0., metavar='DT', help='Print the events per timestep, or per DT seconds. \n (eg. 0.01)')
+    args = parser.parse_args()
+
+    if not args.no_update:
+        added = update(args.fluxname, args.channelname, args.experimentname)
+        print("Added or rebuilt {0} timesteps in the index".format(added))
+    index = TimeIndex(index_path(args.fluxname, args.channelname, args.experimentname))
+    t0, t1 = args.window
+    e0, e1 = args.energy
+
+    if args.spectrum:
+        energies = index.energies[index._energy_key(args.kind)]
+        if args.rebin:
+            step = energies[1] - energies[0]
+            edges = np.append(energies[::args.rebin] - step / 2, energies[-1] + step / 2)
+            for lo, hi, events in zip(edges[:-1], edges[1:], index.rebin(edges, args.kind, args.channel, t0, t1)):
+                print("%12.6g %12.6g %14.6g" % (lo, hi, events))
+        else:
+            for energy, events in zip(*index.spectrum(args.kind, args.channel, t0, t1)):
+                print("%12.6g %14.6g" % (energy, events))
+    elif args.light_curve is not None:
+        edges = None
+        if args.light_curve > 0:
+            start = index.times[0] if t0 is None else t0
+            stop = index.times[-1] + args.light_curve if t1 is None else t1
+            edges = np.arange(start, stop + args.light_curve / 2, args.light_curve)
+        times, events = index.light_curve(args.kind, args.channel, e0, e1, edges)
+        for time, value in zip(times, events):
+            print("%12.6g %14.6g" % (time, value))
+    else:
+        print("{0} timesteps indexed; {1} events ({2}) in [{3}, {4}) s".format(
+            len(index), "%.6g" % index.counts(args.kind, args.channel, t0, t1, e0, e1), args.kind,
+            "start" if t0 is None else t0, "end" if t1 is None else t1))